@@ -1,13 +1,19 @@
 from agent.dst import DST
 from models.model import ModelLoader, LLMTask
+from models.batching import BatchScheduler
+from models.pool import MODEL_POOL
 from data.kb import KnowledgeBase
 from collections import deque
-from typing import Deque, Dict
+from concurrent.futures import Future, ThreadPoolExecutor
+from copy import deepcopy
+from typing import Any, Callable, Deque, Dict, Iterator, List, Tuple
+import threading
 import yaml
 import os
 import re
 from agent.preproc import Preproc
 from agent.nlu import NLU
+from agent.rule_nlu import RuleNLU, refers_to_earlier_turn
 from agent.dm import DM, RuleBasedDM
 from agent.nlg import NLG
 from agent.sa import SA
@@ -15,38 +21,69 @@ from typing import Optional
 from dotenv import load_dotenv
 from models.utils import login_to_hub
 
+# Components of the agent, built in this order
+COMPONENTS = ["kb", "preproc", "nlu", "dm", "nlg", "sa"]
+# Components used to build another one, built before taking the lock of the dependent one
+COMPONENT_DEPENDENCIES = {"nlu": ["kb"]}
+
+
 class DialogueAgent:
-  def __init__(self, model: Dict[str, str], device: str = "cuda", n_exchanges: int = 3) -> None:
+  def __init__(
+      self,
+      model: Dict[str, str],
+      device: str = "cuda",
+      n_exchanges: int = 3,
+      parallel_intents: bool = False,
+      kb: Optional[KnowledgeBase] = None,
+      scheduler: Optional[BatchScheduler] = None,
+      lazy: bool = False,
+      on_progress: Optional[Callable[[str, int, int], None]] = None
+    ) -> None:
     """Initialize dialogue agent.
     Args:
       model (Dict[str, str]): model names to load for each component.
       device (str): device where to run the model on.
       n_exchanges (int): number of exchanges to keep in conversation history.
+      parallel_intents (bool): overlap the nlg of an intent with the processing of the next one.
+      kb (Optional[KnowledgeBase]): knowledge base shared with other agents, a new one if None.
+      scheduler (Optional[BatchScheduler]): batches the llm calls with those of other agents.
+      lazy (bool): return immediately loading models and knowledge base in background, the
+        first request needing something not loaded yet waits for it.
+      on_progress (Optional[Callable[[str, int, int], None]]): called with the name of what was
+        loaded, the number of loaded items and the total when loading in background.
     """
     self.model_name = model
     self.device = device
     self.n_exchanges = n_exchanges
-    
-    # Load knowledge base
-    self.kb = KnowledgeBase()
-    # Load model
-    # Model loader cache
+    self.parallel_intents = parallel_intents
+    self.scheduler = scheduler
+    self.on_progress = on_progress
+
+    # Loaders taken from the process-wide pool, shared with other agents
     self.loaders = {}
     # Load prompts
     self.system_prompt = self._load_prompt()
 
-    # Instantiate components
-    self.preproc = Preproc(self._get_loader("preproc"), self.system_prompt["preproc"])
-    
-    self.nlu = NLU(self._get_loader("nlu"), self.system_prompt["nlu"])
-    
-    # dm can be either llm or rule-based
-    if self.model_name.get("dm") == "rule_based": dm_loader = RuleBasedDM()
-    else: dm_loader = self._get_loader("dm")
-    self.dm = DM(dm_loader, self.system_prompt["dm"])
-
-    self.nlg = NLG(self._get_loader("nlg"), self.system_prompt["nlg"])
-    self.sa = SA(self._get_loader("sa"), self.system_prompt["sa"])
+    # Components are built on first use, a lock per component avoids building it twice
+    # without making unrelated builds wait on each other
+    self._components: Dict[str, Any] = {}
+    self._component_locks = {name: threading.RLock() for name in COMPONENTS}
+    # Components sharing a model take it from the pool once
+    self._loader_lock = threading.Lock()
+    if kb is not None:
+      self._components["kb"] = kb
+
+    # Models and knowledge base being loaded in background
+    self._warmup: Optional[ThreadPoolExecutor] = None
+    self._warmup_futures: Dict[str, Future] = {}
+    self._warmup_done = 0
+    self._warmup_lock = threading.Lock()
+    if lazy:
+      self._start_warmup()
+    else:
+      # Instantiate components
+      for name in COMPONENTS:
+        self._component(name)
 
     # Create Dialogue State Tracker
     self.dst = DST()
@@ -55,20 +92,172 @@ class DialogueAgent:
     max_len = self.n_exchanges * 2
     self.history: Deque[Dict[str, str]] = deque(maxlen=max_len)
 
-  def _get_loader(self, component: str) -> ModelLoader:
-    """Given model choices from different components, give the right model for the right component.
-    Args:
-
-    """
+  def _model_for(self, component: str) -> str:
+    """Get the name of the model used by a component."""
     default_model = self.model_name.get("default")
     model_name = self.model_name.get(component, default_model)
     if not model_name:
       raise ValueError(f"model_name dict must contain a 'default' key or a key for '{component}'")
+    return model_name
+
+  def _start_warmup(self) -> None:
+    """Load the knowledge base and every distinct model in parallel threads."""
+    model_names = []
+    for component in COMPONENTS[1:]:
+      if component == "dm" and self.model_name.get("dm") == "rule_based":
+        continue
+      model_name = self._model_for(component)
+      if model_name not in model_names:
+        model_names.append(model_name)
+
+    jobs = {f"model {name}": (MODEL_POOL.acquire, name, self.device) for name in model_names}
+    if "kb" not in self._components:
+      jobs["knowledge base"] = (KnowledgeBase,)
+
+    self._warmup = ThreadPoolExecutor(max_workers=len(jobs), thread_name_prefix="warmup")
+    for item, (fn, *args) in jobs.items():
+      self._warmup_futures[item] = self._warmup.submit(fn, *args)
+    # Callbacks after submitting everything so the total is known
+    for item, future in self._warmup_futures.items():
+      future.add_done_callback(lambda f, item=item: self._on_warmup_done(item, f))
+
+  def _on_warmup_done(self, item: str, future: Future) -> None:
+    """Count a finished background load and report it."""
+    with self._warmup_lock:
+      self._warmup_done += 1
+      done = self._warmup_done
+    if future.exception() is not None:
+      print(f"Failed loading {item}: {future.exception()}")
+    if self.on_progress is not None:
+      self.on_progress(item, done, len(self._warmup_futures))
+
+  def warmup_progress(self) -> Dict[str, Any]:
+    """Get the state of the background loading.
+    Returns:
+      Dict[str, Any]: loaded items, total items and names of the ones still loading.
+    """
+    pending = [item for item, f in self._warmup_futures.items() if not f.done()]
+    total = len(self._warmup_futures)
+    return {"done": total - len(pending), "total": total, "pending": pending}
+
+  def is_ready(self) -> bool:
+    """Tell if nothing is loading in background anymore."""
+    return all(f.done() for f in self._warmup_futures.values())
 
-    # Load model only it is not already loaded
-    if model_name not in self.loaders:
-      self.loaders[model_name] = ModelLoader(model_name, self.device)
-    return self.loaders[model_name]
+  def wait_ready(self) -> None:
+    """Block until everything loaded in background is ready."""
+    for name in COMPONENTS:
+      self._component(name)
+
+  def _component(self, name: str) -> Any:
+    """Get a component, building it on first use.
+    Args:
+      name (str): name of the component, one of COMPONENTS.
+    Returns:
+      Any: the component.
+    """
+    component = self._components.get(name)
+    if component is not None:
+      return component
+
+    if name not in self._component_locks:
+      raise ValueError(f"Unknown component '{name}'")
+    for dependency in COMPONENT_DEPENDENCIES.get(name, []):
+      self._component(dependency)
+    with self._component_locks[name]:
+      if name not in self._components:
+        component = self._build_component(name)
+        # Coalesce the llm calls with the other sessions
+        if self.scheduler is not None and isinstance(getattr(component, "llm", None), LLMTask):
+          component.llm.scheduler = self.scheduler
+        self._components[name] = component
+    return self._components[name]
+
+  def _build_component(self, name: str) -> Any:
+    """Instantiate a component, waiting for what it needs if loading in background."""
+    match name:
+      case "kb":
+        # Load knowledge base
+        future = self._warmup_futures.get("knowledge base")
+        return future.result() if future is not None else KnowledgeBase()
+      case "preproc":
+        return Preproc(self._get_loader("preproc"), self.system_prompt["preproc"])
+      case "nlu":
+        # Rules answer the simple requests before the llm
+        return NLU(self._get_loader("nlu"), self.system_prompt["nlu"], rule_nlu=RuleNLU.from_kb(self._components["kb"]))
+      case "dm":
+        # dm can be either llm or rule-based
+        if self.model_name.get("dm") == "rule_based": dm_loader = RuleBasedDM()
+        else: dm_loader = self._get_loader("dm")
+        return DM(dm_loader, self.system_prompt["dm"])
+      case "nlg":
+        return NLG(self._get_loader("nlg"), self.system_prompt["nlg"])
+      case "sa":
+        return SA(self._get_loader("sa"), self.system_prompt["sa"])
+      case _:
+        raise ValueError(f"Unknown component '{name}'")
+
+  @property
+  def kb(self) -> KnowledgeBase:
+    return self._component("kb")
+
+  @property
+  def preproc(self) -> Preproc:
+    return self._component("preproc")
+
+  @property
+  def nlu(self) -> NLU:
+    return self._component("nlu")
+
+  @property
+  def dm(self) -> DM:
+    return self._component("dm")
+
+  @property
+  def nlg(self) -> NLG:
+    return self._component("nlg")
+
+  @property
+  def sa(self) -> SA:
+    return self._component("sa")
+
+  def _get_loader(self, component: str) -> ModelLoader:
+    """Given model choices from different components, give the right model for the right component.
+    Args:
+      component (str): name of the component.
+    Returns:
+      ModelLoader: loader shared through the model pool.
+    """
+    model_name = self._model_for(component)
+
+    # Take the model from the pool only once per agent, the pool loads it if no agent did
+    future = self._warmup_futures.get(f"model {model_name}")
+    if future is not None:
+      # Wait outside the lock so a slow model does not hold back the others
+      loader = future.result()
+      with self._loader_lock:
+        return self.loaders.setdefault(model_name, loader)
+    with self._loader_lock:
+      if model_name not in self.loaders:
+        self.loaders[model_name] = MODEL_POOL.acquire(model_name, self.device)
+      return self.loaders[model_name]
+
+  def llm_tasks(self) -> List[LLMTask]:
+    """Get the llm tasks of the components, the rule based dm has none."""
+    components = [self.preproc, self.nlu, self.dm, self.nlg, self.sa]
+    return [c.llm for c in components if isinstance(c.llm, LLMTask)]
+
+  def close(self) -> None:
+    """Give the loaded models back to the pool, which can evict them once unused."""
+    if self._warmup is not None:
+      self._warmup.shutdown(wait=True)
+      # Models loaded in background but never used are released too
+      for item, future in self._warmup_futures.items():
+        if item.startswith("model ") and future.exception() is None:
+          self.loaders.setdefault(item[len("model "):], future.result())
+    for loader in self.loaders.values():
+      MODEL_POOL.release(loader)
+    self.loaders.clear()
 
   def _load_prompt(self) -> dict:
     """Load a yaml files and get system prompts.
@@ -95,14 +284,20 @@ class DialogueAgent:
     self.history.clear()
     self.dst.reset()
 
-  def get_review_sa(self, reviews: list) -> dict:
+  def get_review_sa(self, reviews: list, title: Optional[str] = None) -> dict:
     """Given list of reviews return a report of positive and negative.
     Args:
       reviews (list): list of reviews strings for a given game.
+      title (Optional[str]): title of the game, its app id keys the cached report.
     Returns:
       dict: report of user sentiment on the game.
     """
-    report = self.sa.analyze(reviews)
+    appid = None
+    if title is not None:
+      game = self.kb.game_by_title(title)
+      if game:
+        appid = game.get("appid")
+    report = self.sa.analyze(reviews, key=appid)
     return report
 
 
@@ -136,7 +331,7 @@ class DialogueAgent:
         data = self.kb.get_game_info(title, info)
         # If data has reviews, the sa component will be called
         if "review" in data:
-          sa = self.get_review_sa(data["review"])
+          sa = self.get_review_sa(data["review"], title)
           data["review"] = sa
       case "discover_game":
         data = self.kb.discover_game(**slots)
@@ -145,7 +340,7 @@ class DialogueAgent:
         if "review" in data:
           # Execute sa if reviews are requested
           for title, review_list in data["review"].items():
-            sa = self.get_review_sa(review_list)
+            sa = self.get_review_sa(review_list, title)
             data["review"][title] = sa
       case "get_term_explained":
         data = self.kb.get_term_explained(**slots)
@@ -163,22 +358,20 @@ class DialogueAgent:
     return data
 
 
-  def handle_intent(self, nlu_input: str, mi: bool, nlg_tuning: Optional[str] = None) -> str:
-    """Handle a single intent given user input.
+  def _plan_intent(self, nlu_input: str) -> Tuple[str, dict, Optional[dict]]:
+    """Run the pipeline up to the nlg for a single intent.
     Args:
-      user_request (str): request on a single intent.
-      mi (bool): flag to tell the system if the user requested multiple intents at once.
-      nlg_tuning (Optional[str]): additional prompt for the nlg.
+      nlu_input (str): request on a single intent.
     Returns:
-      str: nlg output.
+      Tuple[str, dict, Optional[dict]]: nba, dialogue state and external knowledge.
     """
     # Go through NLU to extract intents
     nlu_out = self.nlu.generate(nlu_input, list(self.history))
     print(f"Extracted DS -> {nlu_out}")
 
-    # Merge DS and get the updated one
+    # Merge DS and get the updated one, a copy so later updates don't change it
     self.dst.update_ds(nlu_out)
-    ds = self.dst.get_ds()
+    ds = deepcopy(self.dst.get_ds())
     print(f"DST -> {ds}")
 
     # Go through DM to get nba
@@ -193,11 +386,46 @@ class DialogueAgent:
       nba = "fallback()"
       ek = None
 
+    return nba, ds, ek
+
+  def handle_intent(self, nlu_input: str, mi: bool, nlg_tuning: Optional[str] = None) -> str:
+    """Handle a single intent given user input.
+    Args:
+      user_request (str): request on a single intent.
+      mi (bool): flag to tell the system if the user requested multiple intents at once.
+      nlg_tuning (Optional[str]): additional prompt for the nlg.
+    Returns:
+      str: nlg output.
+    """
+    nba, ds, ek = self._plan_intent(nlu_input)
+
     nlg_out = self.nlg.generate(nba, ds, ek, mi, nlg_tuning)
 
     return nlg_out
 
+  def handle_intent_stream(self, nlu_input: str, mi: bool, nlg_tuning: Optional[str] = None) -> Iterator[str]:
+    """Handle a single intent given user input streaming the nlg output.
+    Args:
+      nlu_input (str): request on a single intent.
+      mi (bool): flag to tell the system if the user requested multiple intents at once.
+      nlg_tuning (Optional[str]): additional prompt for the nlg.
+    Returns:
+      Iterator[str]: chunks of the nlg output.
+    """
+    nba, ds, ek = self._plan_intent(nlu_input)
+
+    yield from self.nlg.generate_stream(nba, ds, ek, mi, nlg_tuning)
+
   def handle_two_intents(self, split_input: list) -> str:
+    """Handle two intents responding to both.
+    Args:
+      split_input (list): user input split by intent.
+    Returns:
+      str: combined nlg outputs.
+    """
+    if self.parallel_intents:
+      return self._handle_intents_pipelined(split_input)
+
     responses = []
     
     add_tunings = ["multiresponse1", "multiresponse2"]
@@ -215,6 +443,89 @@ class DialogueAgent:
     # Combine outputs      
     return " ".join(responses)
 
+  def _is_independent(self, nlu_input: str) -> bool:
+    """Tell if a request can be understood without the previous assistant response.
+    Requests the rules answer need no history, the others must not point to earlier turns.
+    Args:
+      nlu_input (str): request on a single intent.
+    Returns:
+      bool: true if its nlu can run before the previous response is generated.
+    """
+    rule_nlu = getattr(self.nlu, "rule_nlu", None)
+    if rule_nlu is not None and rule_nlu.parse(nlu_input) is not None:
+      return True
+    return not refers_to_earlier_turn(nlu_input)
+
+  def _handle_intents_pipelined(self, split_input: list) -> str:
+    """Handle intents running the nlg of one intent while the next one is processed.
+    Processing (NLU, DST, DM, knowledge and SA) stays in user order, so dialogue state updates
+    and wishlist edits happen as in the sequential mode. The next intent overlaps the nlg only if
+    it is independent, since its NLU would not see the response being generated; otherwise it
+    waits for the response like the sequential mode.
+    Args:
+      split_input (list): user input split by intent.
+    Returns:
+      str: combined nlg outputs.
+    """
+    responses = []
+    add_tunings = ["multiresponse1", "multiresponse2"]
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="nlg") as nlg_pool:
+      nba, ds, ek = self._plan_intent(split_input[0])
+
+      for i, sub_input in enumerate(split_input):
+        nlg_future = nlg_pool.submit(self.nlg.generate, nba, ds, ek, False, add_tunings[i])
+        self.history.append({"role": "user", "content": sub_input})
+
+        # Overlap the next intent with the current nlg
+        next_input = split_input[i + 1] if i + 1 < len(split_input) else None
+        if next_input is not None and self._is_independent(next_input):
+          nba, ds, ek = self._plan_intent(next_input)
+          next_input = None
+
+        nlg_out = nlg_future.result()
+        responses.append(nlg_out)
+        self.history.append({"role": "assistant", "content": nlg_out})
+
+        if next_input is not None:
+          nba, ds, ek = self._plan_intent(next_input)
+
+    # Combine outputs
+    return " ".join(responses)
+
+  def _stream_intents_pipelined(self, split_input: list) -> Iterator[str]:
+    """Stream the responses of many intents, processing the next independent intent while one is streamed.
+    Args:
+      split_input (list): user input split by intent.
+    Returns:
+      Iterator[str]: chunks of the combined nlg outputs.
+    """
+    add_tunings = ["multiresponse1", "multiresponse2"]
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="plan") as plan_pool:
+      nba, ds, ek = self._plan_intent(split_input[0])
+
+      for i, sub_input in enumerate(split_input):
+        # Separate the responses like handle_two_intents does
+        if i > 0:
+          yield " "
+        self.history.append({"role": "user", "content": sub_input})
+
+        next_input = split_input[i + 1] if i + 1 < len(split_input) else None
+        plan_future = None
+        if next_input is not None and self._is_independent(next_input):
+          plan_future = plan_pool.submit(self._plan_intent, next_input)
+
+        chunks = []
+        for chunk in self.nlg.generate_stream(nba, ds, ek, False, add_tunings[i]):
+          chunks.append(chunk)
+          yield chunk
+
+        if plan_future is not None:
+          nba, ds, ek = plan_future.result()
+        self.history.append({"role": "assistant", "content": "".join(chunks)})
+        if next_input is not None and plan_future is None:
+          nba, ds, ek = self._plan_intent(next_input)
 
   def chat(self, user_input: str) -> str:
     """Chat with the model giving a user input.
@@ -252,25 +563,91 @@ class DialogueAgent:
     return response
   
 
-def load_agent() -> DialogueAgent:
-  """Load the agent with the recommended configuration."""
+  def chat_stream(self, user_input: str) -> Iterator[str]:
+    """Chat with the model giving a user input, yielding the response while it is generated.
+    Args:
+      user_input (str): user input.
+    Returns:
+      Iterator[str]: chunks of the assistant response.
+    """
+    # Keep track if there are multiple intents
+    multiple_intents = False
+
+    # Go through the preprocess to split input based on intents
+    split_input = self.preproc.generate(user_input)
+    print(f"SPLIT -> {split_input}")
+
+    # Based on intent number the agent has different behaviour
+    intent_number = len(split_input)
+    if intent_number == 2 and self.parallel_intents:
+      yield from self._stream_intents_pipelined(split_input)
+      return
+    if intent_number == 2:
+      add_tunings = ["multiresponse1", "multiresponse2"]
+      for i, sub_input in enumerate(split_input):
+        # Separate the two responses like handle_two_intents does
+        if i > 0:
+          yield " "
+        chunks = []
+        for chunk in self.handle_intent_stream(sub_input, mi=False, nlg_tuning=add_tunings[i]):
+          chunks.append(chunk)
+          yield chunk
+
+        # Give context to next request
+        self.history.append({"role": "user", "content": sub_input})
+        self.history.append({"role": "assistant", "content": "".join(chunks)})
+      return
+
+    if intent_number > 2:
+      multiple_intents = True
+      for input in split_input[:-1]:
+        self.history.append({"role": "user", "content": input})
+
+    # Agent will always attend to last user intent
+    nlu_input = split_input[-1]
+
+    chunks = []
+    for chunk in self.handle_intent_stream(nlu_input, mi=multiple_intents):
+      chunks.append(chunk)
+      yield chunk
+
+    # Update history
+    self.history.append({"role": "user", "content": nlu_input})
+    self.history.append({"role": "assistant", "content": "".join(chunks)})
+
+
+# Recommended configuration, models used for every component
+DEFAULT_MODELS = {
+  "default": "qwen3",
+  "preproc": "qwen3",
+  "nlu": "qwen3",
+  "dm": "rule_based",
+  "nlg": "llama3",
+  "sa": "qwen3"
+}
+DEFAULT_DEVICE = "auto"
+DEFAULT_N_EXCHANGES = 2
+
+
+def load_agent(lazy: bool = False, on_progress: Optional[Callable[[str, int, int], None]] = None) -> DialogueAgent:
+  """Load the agent with the recommended configuration.
+  Args:
+    lazy (bool): return immediately loading models and knowledge base in background.
+    on_progress (Optional[Callable[[str, int, int], None]]): called every time something is loaded in background.
+  Returns:
+    DialogueAgent: the agent.
+  """
   # Load hf 
   load_dotenv()
   login_to_hub()
 
-  device = "auto"
-  n_exchanges = 2
-
-  # Models used for every component
-  model = {
-    "default": "qwen3",
-    "preproc": "qwen3",
-    "nlu": "qwen3",
-    "dm": "rule_based",
-    "nlg": "llama3",
-    "sa": "qwen3"
-  }
-
-  dialogue_agent = DialogueAgent(model, device, n_exchanges)
+  dialogue_agent = DialogueAgent(
+    DEFAULT_MODELS,
+    DEFAULT_DEVICE,
+    DEFAULT_N_EXCHANGES,
+    parallel_intents=True,
+    lazy=lazy,
+    on_progress=on_progress
+  )
   return dialogue_agent
 
@@ -1,7 +1,8 @@
-from models.model import ModelLoader, LLMTask
+from models.model import ModelLoader, LLMTask, make_usage
 import re
 import json
-from typing import Any, Optional, Union
+import time
+from typing import Any, Dict, List, Optional, Union
 
 def get_action(intent: str, slots: dict) -> str:
   """Given a ds return the action annotation.
@@ -118,8 +119,10 @@ class DM:
     """
     self.prompt = prompt
 
-    if isinstance(loader, ModelLoader): self.llm = LLMTask(loader, prompt["prompt"]["main"])
+    if isinstance(loader, ModelLoader): self.llm = LLMTask(loader, prompt["prompt"]["main"], generation=prompt.get("generation"))
     else: self.llm = loader
+    # Usage of every ds of the last batch
+    self.last_usage: List[Dict[str, Any]] = []
 
   def set_prompt(self, intent_name: str) -> None:
     """Sets the prompt given the current intent.
@@ -147,3 +150,38 @@ class DM:
     if validate: return validate_dm(raw_out)
     return raw_out
 
+  def generate_batch(self, dss: List[dict], validate: bool = True) -> List[str]:
+    """Get the nba of many ds, batching together the ones with the same intent.
+    Args:
+      dss (List[dict]): dialogue states.
+      validate (bool): flag to set to validate output or not.
+    Returns:
+      List[str]: outputs in the same order of the ds.
+    """
+    by_intent: Dict[str, List[int]] = {}
+    for idx, ds in enumerate(dss):
+      by_intent.setdefault(ds.get("intent", "out_of_domain"), []).append(idx)
+
+    raw_outs: List[str] = [""] * len(dss)
+    usage: List[Dict[str, Any]] = [{} for _ in dss]
+    for intent_name, positions in by_intent.items():
+      # Every intent has its own prompt
+      self.set_prompt(intent_name)
+      ds_strings = [json.dumps(dss[idx]) for idx in positions]
+      if isinstance(self.llm, RuleBasedDM):
+        outs, outs_usage = [], []
+        for ds_string in ds_strings:
+          start = time.perf_counter()
+          outs.append(self.llm.generate(ds_string))
+          outs_usage.append(make_usage(latency=time.perf_counter() - start))
+      else:
+        outs = self.llm.generate_batch(ds_strings)
+        outs_usage = self.llm.last_usage
+      for idx, out, out_usage in zip(positions, outs, outs_usage):
+        raw_outs[idx] = out
+        usage[idx] = out_usage
+    self.last_usage = usage
+
+    if validate: return [validate_dm(raw_out) for raw_out in raw_outs]
+    return raw_outs
+
@@ -1,7 +1,7 @@
 from models.model import ModelLoader, LLMTask
 import re
 import json
-from typing import Any, Optional, Union
+from typing import Any, Dict, Iterator, List, Optional, Union
 
 class NLG:
   """Natural Language Generator component."""
@@ -12,7 +12,9 @@ class NLG:
       prompt (dict): prompt for llm
     """
     self.prompt = prompt
-    self.llm = LLMTask(loader, prompt["prompt"]["main"])
+    self.llm = LLMTask(loader, prompt["prompt"]["main"], generation=prompt.get("generation"))
+    # Usage of every input of the last batch
+    self.last_usage: List[Dict[str, Any]] = []
   
   def set_prompt(self, intent_name: str, additional_tuning: Optional[str] = None) -> None:
     """Sets the prompt given the current intent.
@@ -35,11 +37,25 @@ class NLG:
     Returns:
       str: lexicalized response.
     """
+    self.set_prompt(intent_name)
     out = self.llm.generate(formatted_input)
     return out
 
-  def generate(self, nba:str, ds: dict, ek: Optional[dict], mi: bool, additional_tuning: Optional[str] = None) -> str:
-    """Get lexicalized output for the user.
+  def eval_generate_batch(self, intent_name: str, formatted_inputs: List[str]) -> List[str]:
+    """Batched generation for eval data of the same intent that already has formatted input.
+    Args:
+      intent_name (str): intent_name to set the prompt.
+      formatted_inputs (List[str]): already formatted inputs.
+    Returns:
+      List[str]: lexicalized responses in the same order of the inputs.
+    """
+    self.set_prompt(intent_name)
+    outs = self.llm.generate_batch(formatted_inputs)
+    self.last_usage = self.llm.last_usage
+    return outs
+
+  def _build_input(self, nba: str, ds: dict, ek: Optional[dict], mi: bool, additional_tuning: Optional[str] = None) -> str:
+    """Set the prompt for the intent and format the nlg input.
     Args:
       nba (str): next best action.
       ds (dict): dialogue state.
@@ -47,7 +63,7 @@ class NLG:
       mi (bool): flag for multiple intents.
       additional_tuning (Optional[str]): additional prompt to further tune the response.
     Returns:
-      str: generated response.
+      str: formatted nlg input.
     """
     intent_name = ds.get("intent", "out_of_domain")
     self.set_prompt(intent_name, additional_tuning)
@@ -56,7 +72,33 @@ class NLG:
     else: ek_string = ek
     nlg_input = f"NBA: {nba}\nDS: {ds_string}\nEK: {ek_string}\n MI: {mi}"
     print(nlg_input)
+    return nlg_input
 
+  def generate(self, nba:str, ds: dict, ek: Optional[dict], mi: bool, additional_tuning: Optional[str] = None) -> str:
+    """Get lexicalized output for the user.
+    Args:
+      nba (str): next best action.
+      ds (dict): dialogue state.
+      ek: (Optional[dict]): external knowledge.
+      mi (bool): flag for multiple intents.
+      additional_tuning (Optional[str]): additional prompt to further tune the response.
+    Returns:
+      str: generated response.
+    """
+    nlg_input = self._build_input(nba, ds, ek, mi, additional_tuning)
     out = self.llm.generate(nlg_input)
     return out
 
+  def generate_stream(self, nba:str, ds: dict, ek: Optional[dict], mi: bool, additional_tuning: Optional[str] = None) -> Iterator[str]:
+    """Get lexicalized output for the user as a stream of text chunks.
+    Args:
+      nba (str): next best action.
+      ds (dict): dialogue state.
+      ek: (Optional[dict]): external knowledge.
+      mi (bool): flag for multiple intents.
+      additional_tuning (Optional[str]): additional prompt to further tune the response.
+    Returns:
+      Iterator[str]: chunks of the generated response.
+    """
+    nlg_input = self._build_input(nba, ds, ek, mi, additional_tuning)
+    yield from self.llm.generate_stream(nlg_input)
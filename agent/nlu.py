@@ -1,7 +1,45 @@
-from models.model import ModelLoader, LLMTask
+from models.model import ModelLoader, LLMTask, make_usage
+from agent.rule_nlu import RuleNLU
+from agent.dst import (
+  intent_schemas, VALID_GENRES, VALID_PLATFORMS, VALID_INFO_TYPES, VALID_CRITERIA, VALID_MODES
+)
 import json
 import re
-from typing import Any, Optional
+import time
+from typing import Any, Dict, List, Optional
+
+
+def nullable(schema: dict) -> dict:
+  """Allow null as value of a schema."""
+  return {"anyOf": [schema, {"type": "null"}]}
+
+# Value of the slots with a known type, the others are free strings
+SLOT_VALUE_SCHEMAS = {
+  "info": {"type": "string", "enum": VALID_INFO_TYPES},
+  "genre": {"type": "string", "enum": VALID_GENRES},
+  "platform": {"type": "string", "enum": VALID_PLATFORMS},
+  "criteria": {"type": "string", "enum": VALID_CRITERIA},
+  "mode": {"type": "string", "enum": VALID_MODES},
+  "price": {"type": "number"},
+  "release_year": {"type": "integer"},
+  "required_age": {"type": "integer"}
+}
+
+# Schema of the nlu output used to constrain decoding
+NLU_SCHEMA = {
+  "type": "object",
+  "required": ["intent", "slots"],
+  "properties": {
+    "intent": {"type": "string", "enum": list(intent_schemas.keys())},
+    "slots": {
+      "type": "object",
+      "properties": {
+        slot: nullable(SLOT_VALUE_SCHEMAS.get(slot, {"type": "string"}))
+        for slots in intent_schemas.values() for slot in slots
+      }
+    }
+  }
+}
 
 
 def validate_nlu(nlu_out: str) -> dict:
@@ -37,15 +75,24 @@ def validate_nlu(nlu_out: str) -> dict:
 
 class NLU:
   """Natural Language Understanding component to extract intent and slots."""
-  def __init__(self, loader: ModelLoader, prompt: dict) -> None:
+  def __init__(self, loader: ModelLoader, prompt: dict, constrained: bool = True, rule_nlu: Optional[RuleNLU] = None) -> None:
     """Initialize component.
     Args:
       loader (ModelLoader): model loader for component.
       prompt (dict): prompts for component.
+      constrained (bool): constrain decoding to json following NLU_SCHEMA.
+      rule_nlu (Optional[RuleNLU]): rules tried before the llm, which runs only if they are unsure.
     """
     self.loader = loader
     self.prompt = prompt
-    self.llm = LLMTask(loader, prompt["prompt"])
+    self.llm = LLMTask(loader, prompt["prompt"], json_schema=NLU_SCHEMA if constrained else None, generation=prompt.get("generation"))
+    self.rule_nlu = rule_nlu
+    # Requests answered by each path, and the path of the last one
+    self.path_stats = {"rule": 0, "llm": 0}
+    self.last_path: Optional[str] = None
+    self.last_paths: List[str] = []
+    # Usage of every input of the last batch
+    self.last_usage: List[Dict[str, Any]] = []
   
   def generate(self, nlu_input: str, history: Optional[list] = None, validate: bool = True) -> Any:
     """Given an input output the intent and slots.
@@ -58,7 +105,52 @@ class NLU:
     """
     if history is None: history = []
 
+    if self.rule_nlu is not None:
+      rule_out = self.rule_nlu.parse(nlu_input)
+      if rule_out is not None:
+        self.last_path = "rule"
+        self.path_stats["rule"] += 1
+        if validate: return rule_out
+        return json.dumps(rule_out)
+
+    self.last_path = "llm"
+    self.path_stats["llm"] += 1
     raw_out = self.llm.generate(nlu_input, history)
     if validate: return validate_nlu(raw_out)
     return raw_out
 
+  def generate_batch(self, nlu_inputs: List[str], validate: bool = True) -> List[Any]:
+    """Extract intent and slots of many inputs, the ones the rules can't answer go through the llm in batches.
+    Args:
+      nlu_inputs (List[str]): strings where intent and slots must be extracted.
+      validate (bool): flag to set to validate output.
+    Returns:
+      List[Any]: outputs in the same order of the inputs, as in generate.
+    """
+    outputs: List[Any] = [None] * len(nlu_inputs)
+    paths = ["llm"] * len(nlu_inputs)
+    usage = [make_usage() for _ in nlu_inputs]
+    if self.rule_nlu is not None:
+      for idx, nlu_input in enumerate(nlu_inputs):
+        start = time.perf_counter()
+        rule_out = self.rule_nlu.parse(nlu_input)
+        usage[idx] = make_usage(latency=time.perf_counter() - start)
+        if rule_out is not None:
+          paths[idx] = "rule"
+          outputs[idx] = rule_out if validate else json.dumps(rule_out)
+
+    llm_idx = [idx for idx, path in enumerate(paths) if path == "llm"]
+    if llm_idx:
+      raw_outs = self.llm.generate_batch([nlu_inputs[idx] for idx in llm_idx])
+      for idx, raw_out, llm_usage in zip(llm_idx, raw_outs, self.llm.last_usage):
+        outputs[idx] = validate_nlu(raw_out) if validate else raw_out
+        # Time spent on the rules comes before the llm
+        usage[idx] = dict(llm_usage, latency=llm_usage["latency"] + usage[idx]["latency"])
+
+    # Path and usage of every input of the batch
+    self.last_paths = paths
+    self.last_usage = usage
+    self.path_stats["rule"] += len(nlu_inputs) - len(llm_idx)
+    self.path_stats["llm"] += len(llm_idx)
+    return outputs
+
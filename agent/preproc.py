@@ -1,7 +1,53 @@
-from models.model import ModelLoader, LLMTask
+from models.model import ModelLoader, LLMTask, make_usage
 import json
 import re
-from typing import Any
+import time
+from typing import Any, Dict, List
+
+# Schema of the preproc output used to constrain decoding
+PREPROC_SCHEMA = {
+  "type": "array",
+  "items": {"type": "string"},
+  "minItems": 1
+}
+
+# Words that start a new request after "and", "or" or a comma
+REQUEST_STARTERS = {
+  "add", "remove", "delete", "take", "save", "show", "list", "open", "find", "search", "look",
+  "compare", "explain", "define", "tell", "give", "get", "recommend", "suggest", "check",
+  "what", "what's", "whats", "how", "who", "which", "where", "when", "why", "is", "are",
+  "does", "do", "can", "could", "would", "will", "please", "i", "i'm", "let", "put", "order"
+}
+# Words and phrases that always mark a second request
+SPLIT_CUES = re.compile(r"\b(also|then|but|first|actually|after that|afterwards|as well|plus|no wait|instead)\b|;")
+# Longer inputs are left to the llm
+FAST_PATH_MAX_WORDS = 25
+
+
+def is_single_intent(user_input: str) -> bool:
+  """Tell if an input surely holds a single request, so it doesn't need to be split.
+  Refining a search ("a strategy game under 20 dollars and with good reviews") stays single,
+  while "and", "or" or a comma followed by a request verb or question word may start a new one.
+  Args:
+    user_input (str): user input string.
+  Returns:
+    bool: true if the input can skip the splitting llm.
+  """
+  text = user_input.strip().lower()
+  if not text or len(text.split()) > FAST_PATH_MAX_WORDS:
+    return False
+  if SPLIT_CUES.search(text):
+    return False
+  # More than one sentence
+  if re.search(r"[.?!]+\s+\S", text):
+    return False
+
+  words = re.findall(r"[\w']+|,", text)
+  for prev, word in zip(words, words[1:]):
+    if prev in ("and", "or", ",") and word in REQUEST_STARTERS:
+      return False
+  return True
+
 
 def validate_preproc(preproc_out: str, user_input: str) -> list:
   """Validate the output of the preprocessor.
@@ -38,15 +84,22 @@ def validate_preproc(preproc_out: str, user_input: str) -> list:
 
 class Preproc:
   """Class for the preprocessor component that splits text based on intent."""
-  def __init__(self, loader: ModelLoader, prompt: dict) -> None:
+  def __init__(self, loader: ModelLoader, prompt: dict, constrained: bool = True, fast_path: bool = True) -> None:
     """Initialize component.
     Args:
       loader (ModelLoader): model loader for the component.
       prompt (dict): dictionary containing prompt for the component.
+      constrained (bool): constrain decoding to a json list of strings.
+      fast_path (bool): skip the llm for inputs that surely hold a single request.
     """
     self.loader = loader
     self.prompt = prompt
-    self.llm = LLMTask(loader, prompt["prompt"])
+    self.llm = LLMTask(loader, prompt["prompt"], json_schema=PREPROC_SCHEMA if constrained else None, generation=prompt.get("generation"))
+    self.fast_path = fast_path
+    # Inputs that skipped the llm
+    self.bypass_stats = {"calls": 0, "bypassed": 0}
+    # Usage of every input of the last batch
+    self.last_usage: List[Dict[str, Any]] = []
   
   def generate(self, user_input: str, validate: bool = True) -> Any:
     """Pass through the model to get splitted input.
@@ -56,8 +109,52 @@ class Preproc:
     Returns:
       Any: the expected output should be a list of strings. Disabling validation could lead to some format errors from LLM.
     """
+    self.bypass_stats["calls"] += 1
+    if self.fast_path and is_single_intent(user_input):
+      self.bypass_stats["bypassed"] += 1
+      # Same output the llm gives for a single request
+      if validate: return [user_input]
+      return json.dumps([user_input])
+
     raw_out = self.llm.generate(user_input)
     if validate: return validate_preproc(raw_out, user_input)
     return raw_out
+
+  def generate_batch(self, user_inputs: List[str], validate: bool = True) -> List[Any]:
+    """Split many inputs, the ones the fast path can't answer go through the llm in batches.
+    Args:
+      user_inputs (List[str]): user input strings.
+      validate (bool): flag to decide if output is validated or not.
+    Returns:
+      List[Any]: outputs in the same order of the inputs, as in generate.
+    """
+    outputs: List[Any] = [None] * len(user_inputs)
+    usage = [make_usage() for _ in user_inputs]
+    llm_idx = []
+    for idx, user_input in enumerate(user_inputs):
+      start = time.perf_counter()
+      if self.fast_path and is_single_intent(user_input):
+        outputs[idx] = [user_input] if validate else json.dumps([user_input])
+        usage[idx] = make_usage(latency=time.perf_counter() - start)
+      else:
+        llm_idx.append(idx)
+    self.bypass_stats["calls"] += len(user_inputs)
+    self.bypass_stats["bypassed"] += len(user_inputs) - len(llm_idx)
+
+    if llm_idx:
+      raw_outs = self.llm.generate_batch([user_inputs[idx] for idx in llm_idx])
+      for idx, raw_out, llm_usage in zip(llm_idx, raw_outs, self.llm.last_usage):
+        outputs[idx] = validate_preproc(raw_out, user_inputs[idx]) if validate else raw_out
+        usage[idx] = llm_usage
+    self.last_usage = usage
+    return outputs
+
+  def bypass_rate(self) -> float:
+    """Get the fraction of inputs that skipped the llm.
+    Returns:
+      float: bypass rate.
+    """
+    calls = self.bypass_stats["calls"]
+    return self.bypass_stats["bypassed"] / calls if calls > 0 else 0.0
     
 
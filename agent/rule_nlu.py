@@ -0,0 +1,420 @@
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from weakref import WeakKeyDictionary
+from agent.dst import DST, intent_schemas, VALID_GENRES, VALID_PLATFORMS, VALID_INFO_TYPES, VALID_CRITERIA, VALID_MODES
+from data.kb import KnowledgeBase
+
+
+def _alternatives(values: Iterable[str]) -> str:
+  """Regex alternation of some values, longest first so "free to play" wins over shorter ones."""
+  return "|".join(re.escape(v) for v in sorted(values, key=len, reverse=True))
+
+
+GENRES = _alternatives(VALID_GENRES)
+PLATFORMS = _alternatives(VALID_PLATFORMS)
+MODES = _alternatives(VALID_MODES)
+# Spoken forms of the info types
+INFO_ALIASES = {info: info for info in VALID_INFO_TYPES}
+INFO_ALIASES.update({info.replace("_", " "): info for info in VALID_INFO_TYPES})
+INFO_ALIASES.update({
+  "reviews": "review", "rating": "review", "ratings": "review", "age rating": "required_age", "minimum age": "required_age",
+  "cost": "price", "modes": "mode", "game modes": "mode", "platforms": "platform", "genres": "genre",
+  "description": "summary", "plot": "summary", "maker": "developer", "studio": "developer",
+})
+INFOS = _alternatives(INFO_ALIASES)
+CRITERIA_ALIASES = {c: c for c in VALID_CRITERIA}
+CRITERIA_ALIASES.update({"reviews": "review", "ratings": "review", "prices": "price", "genres": "genre", "cost": "price"})
+CRITERIA = _alternatives(CRITERIA_ALIASES)
+
+# Pieces the patterns are built from, so they cover wordings instead of single sentences
+POLITE = r"(?:(?:please|can you|could you|would you|i want to|i'd like to|i would like to)\s+)*"
+LISTS = r"(?:(?:my|the) (?:wishlist|wish list|list|saved games|saved list|saved titles))"
+SHOW = r"(?:show|open|list|display|check|see|view|give|bring up|pull up)(?: me)?"
+GAMING = r"(?: (?:in|for) (?:the context of )?(?:gaming|games|video games))?"
+
+# References to earlier turns need the history, so the llm handles them
+REFERENCES = {"it", "this", "that", "them", "one", "this game", "that game", "the game", "both", "these", "those"}
+# Captured text starting with these words is a question rather than a name
+QUESTION_STARTS = ("how", "what", "why", "who", "where", "when", "you", "your", "yourself", "me", "my")
+# Words pointing to earlier turns anywhere in a request
+ANAPHORA = {
+  "it", "its", "this", "that", "these", "those", "them", "they", "their", "one", "ones", "both", "same",
+  "previous", "above", "first", "second", "last", "former", "latter", "else", "other", "too", "also",
+}
+
+WISHLIST_PATTERNS = [
+  rf"{POLITE}{SHOW} {LISTS}(?: items| contents| again)?",
+  rf"what(?:'s| is| games are)(?: currently)? (?:in|on) {LISTS}",
+  r"(?:what|which) games (?:have i|did i) (?:saved?|wishlisted|bookmarked)",
+]
+# Titles, names and terms are captured loosely and kept only if the knowledge base knows them
+ADD_PATTERNS = [
+  rf"{POLITE}(?:add|save|put|stick|bookmark|keep) (?P<title>.+?) (?:to|in|into|on|onto) {LISTS}",
+  rf"{POLITE}wishlist (?P<title>.+)",
+]
+REMOVE_PATTERNS = [
+  rf"{POLITE}(?:remove|delete|drop|erase|take|get rid of) (?P<title>.+?) (?:from|off|out of) {LISTS}",
+]
+FRIEND_PATTERNS = [
+  r"what(?: games?)?(?: is| does| has)? (?P<name>[\w.-]+) (?:playing|play|own|owns|have|got|recommend)",
+  r"what(?:'s| is) (?P<name>[\w.-]+) playing",
+  rf"{POLITE}{SHOW}(?: the| all)? games (?:that )?(?P<name>[\w.-]+) (?:owns|has|plays|is playing)",
+  rf"{POLITE}{SHOW}(?: the| all)? games (?:owned|played) by (?P<name>[\w.-]+)",
+  rf"{POLITE}{SHOW} (?P<name>[\w.-]+)'s (?:games|library|collection)",
+  r"(?:does|has) (?P<name>[\w.-]+) (?:have|got) any (?:recommendations|suggestions|games)",
+]
+TERM_PATTERNS = [
+  rf"what does (?:the (?:term|word) )?(?P<term>.+?) (?:mean|stand for){GAMING}",
+  rf"{POLITE}(?:explain|define|describe)(?: the (?:term|word|meaning of)| what)? (?P<term>.+?)(?: means?)?{GAMING}",
+  rf"what(?:'s| is) (?:the (?:meaning|definition) of|meant by) (?P<term>.+?){GAMING}",
+]
+INFO_PATTERNS = [
+  rf"{POLITE}(?:what(?:'s| is| are)|tell me|give me|show me|i want to know|i'd like to know) the (?P<info>{INFOS}) (?:of|for) (?P<title>.+)",
+  rf"(?:what(?:'s| is| are)|tell me|show me) (?P<title>.+?)'s? (?P<info>{INFOS})",
+  r"how much (?:does|is) (?P<title>.+?)(?: cost)?",
+]
+COMPARE_PATTERNS = [
+  rf"{POLITE}compare (?:the )?(?P<criteria>{CRITERIA}) (?:of|for|between) (?P<pair>.+)",
+  rf"{POLITE}compare (?P<pair>.+?) (?:by|on|in terms of) (?:their )?(?P<criteria>{CRITERIA})",
+  rf"{POLITE}compare (?P<pair>.+)",
+  rf"(?:tell me about|show me|what are) the (?P<criteria>{CRITERIA}) differences? between (?P<pair>.+)",
+  r"(?:what(?:'s| is| are) the )?differences? between (?P<pair>.+)",
+  r"how (?:does|do) (?P<pair>.+?) compare",
+  r"(?:which|what) is better,? (?P<pair>.+)",
+]
+# Either a title or a term, decided by the knowledge base
+LOOKUP_PATTERNS = [
+  rf"what(?:'s| is) (?P<value>.+?){GAMING}",
+  r"(?:tell me|i want to know|i'd like to know|i want to learn)(?: more| something| everything)? about (?P<value>.+)",
+]
+# Only titles, the same wording asks for discovery otherwise
+SEARCH_PATTERNS = [
+  r"(?:search for|look up|find info(?:rmation)? (?:on|about)|details (?:on|about)) (?P<title>.+)",
+]
+
+# Discovery requests are a lead followed only by clauses the rules understand
+DISCOVER_LEAD = (
+  r"(?:(?:can you |could you |please )?(?:find|show|give|recommend|suggest|list|search for|look for|get)(?: me)?"
+  r"|i (?:want|need|would like|'d like)(?: to play)?|i am looking for|i'm looking for|are there|do you know|do you have|got)\b"
+)
+# Words starting another clause, where a free text slot may end
+_BOUNDARY = r"\s+(?:that|which|for|on|and|released|from|with|under|below|made|developed|published|by|like|similar)\b"
+DISCOVER_CLAUSES: List[Tuple[str, Optional[str]]] = [
+  (rf"(?:that are |that is |which are )?(?P<genre>{GENRES})\b", "genre"),
+  (rf"(?:that are |that is |which are )?(?P<mode>{MODES})\b", "mode"),
+  (rf"(?:playable |available |that run )?(?:on|for) (?P<platform>{PLATFORMS})\b", "platform"),
+  (r"(?:released |published |made |come out |that came out )?(?:in|from) (?P<release_year>(?:19|20)\d\d)\b", "release_year"),
+  (r"(?:that |which )?(?:costs? |for |priced )?(?:less than|under|below|cheaper than) \$?(?P<price>\d+(?:\.\d+)?)(?: ?dollars| ?euros|\$)?", "price"),
+  (r"(?:that are |that is )?(?:for |suitable for |rated for )?ages? (?P<required_age>\d+)\+?", "required_age"),
+]
+# Clauses with a free text value, which must be known to the knowledge base
+FREE_CLAUSES: List[Tuple[str, str]] = [
+  (r"(?:made|developed|created) by\s+", "developer"),
+  (r"(?:published )?by\s+", "publisher"),
+  (r"(?:similar to|like|such as)\s+", "similar_title"),
+]
+FILLERS = [r"(?:some|any|a|an|other|new|good)\b", r"games?\b", r"(?:and|that are|that is|with|to play)\b"]
+
+
+def normalize(text: str) -> str:
+  """Normalize a name like the dialogue state tracker does."""
+  return DST._normalize_names(text)
+
+
+def refers_to_earlier_turn(text: str) -> bool:
+  """Tell if a request may point to something said before, such as "it" or "the first one"."""
+  return any(word in ANAPHORA for word in normalize(text).split())
+
+
+class TitleTrie:
+  """Word level trie of the game titles, to find the longest title starting at a word."""
+
+  def __init__(self, titles: Iterable[str] = ()) -> None:
+    """Build the trie.
+    Args:
+      titles (Iterable[str]): normalized titles.
+    """
+    self.root: Dict[str, Any] = {}
+    for title in titles:
+      self.add(title)
+
+  def add(self, title: str) -> None:
+    """Add a normalized title."""
+    words = title.split()
+    if not words:
+      return
+    node = self.root
+    for word in words:
+      node = node.setdefault(word, {})
+    # Marks the end of a title
+    node[None] = True
+
+  def longest_match(self, words: List[str], start: int = 0) -> int:
+    """Get the end of the longest title starting at a word.
+    Args:
+      words (List[str]): normalized words.
+      start (int): index of the first word.
+    Returns:
+      int: index after the last word of the title, start if no title matches.
+    """
+    node = self.root
+    end = start
+    for i in range(start, len(words)):
+      node = node.get(words[i])
+      if node is None:
+        break
+      if None in node:
+        end = i + 1
+    return end
+
+  def __contains__(self, text: str) -> bool:
+    words = normalize(text).split()
+    return bool(words) and self.longest_match(words) == len(words)
+
+
+class RuleNLU:
+  """Pattern and gazetteer based nlu answering the unambiguous requests without the llm.
+  Every pattern must match the whole request and every captured title, name, term or company
+  must be known to the knowledge base, anything else is left to the llm.
+  """
+
+  def __init__(
+      self,
+      titles: Iterable[str] = (),
+      terms: Iterable[str] = (),
+      names: Iterable[str] = (),
+      publishers: Iterable[str] = (),
+      developers: Iterable[str] = ()
+    ) -> None:
+    """Initialize the rules.
+    Args:
+      titles (Iterable[str]): normalized game titles.
+      terms (Iterable[str]): terms of the glossary.
+      names (Iterable[str]): usernames of the friends.
+      publishers (Iterable[str]): normalized publishers.
+      developers (Iterable[str]): normalized developers.
+    """
+    self.titles = TitleTrie(titles)
+    self.terms = {t.lower() for t in terms}
+    self.names = {n.lower() for n in names}
+    self.publishers = [p.lower() for p in publishers if p]
+    self.developers = [d.lower() for d in developers if d]
+
+  @classmethod
+  def from_kb(cls, kb: KnowledgeBase) -> "RuleNLU":
+    """Get the rules for the titles, terms, friends and companies of a knowledge base, built once per knowledge base.
+    Args:
+      kb (KnowledgeBase): knowledge base.
+    Returns:
+      RuleNLU: rules.
+    """
+    rules = _RULES_BY_KB.get(kb)
+    if rules is None:
+      friends = [friend["username"] for friend in kb.user_profile.get("friends", [])]
+      rules = cls(kb.title_index.keys(), kb.glossary.keys(), friends, kb.query_engine.publishers, kb.query_engine.developers)
+      _RULES_BY_KB[kb] = rules
+    return rules
+
+  @staticmethod
+  def _state(intent: str, **slots: Any) -> dict:
+    """Build an nlu output with every slot of the intent."""
+    return {"intent": intent, "slots": {slot: slots.get(slot) for slot in intent_schemas[intent]}}
+
+  @staticmethod
+  def _match(patterns: List[str], text: str) -> Optional[re.Match]:
+    """Match the whole text against the first fitting pattern."""
+    for pattern in patterns:
+      match = re.fullmatch(pattern, text, re.IGNORECASE)
+      if match:
+        return match
+    return None
+
+  @staticmethod
+  def _is_reference(value: str) -> bool:
+    """Tell if a slot value refers to something said before."""
+    value = normalize(value)
+    if not value or value in REFERENCES or value.split()[0] in QUESTION_STARTS:
+      return True
+    return value.startswith(("the first", "the second", "the better", "the last"))
+
+  def _is_title(self, value: str) -> bool:
+    """Tell if a value is exactly a title of the knowledge base."""
+    return not self._is_reference(value) and value in self.titles
+
+  def _is_term(self, value: str) -> bool:
+    """Tell if a value is a term of the glossary."""
+    return value.lower() in self.terms
+
+  def _is_friend(self, value: str) -> bool:
+    """Tell if a value is the username of a friend."""
+    return value.lower() in self.names
+
+  @staticmethod
+  def _is_company(value: str, companies: List[str]) -> bool:
+    """Tell if a value names a publisher or developer, as whole words of one of them."""
+    value = normalize(value)
+    if not value:
+      return False
+    pattern = re.compile(rf"\b{re.escape(value)}\b")
+    return any(pattern.search(company) for company in companies)
+
+  def _is_known(self, slot: str, value: str) -> bool:
+    """Tell if the knowledge base knows the value of a free text discovery slot."""
+    if slot == "similar_title":
+      return self._is_title(value)
+    if self._is_reference(value):
+      return False
+    return self._is_company(value, self.publishers if slot == "publisher" else self.developers)
+
+  def _split_pair(self, pair: str) -> Optional[Tuple[str, str]]:
+    """Split "<title> and <title>" in two known titles, None if no separator gives two of them."""
+    for sep in re.finditer(r"\s+(?:and|vs\.?|versus|or|with|to)\s+", pair, re.IGNORECASE):
+      first, second = pair[:sep.start()].strip(), pair[sep.end():].strip()
+      if self._is_title(first) and self._is_title(second):
+        return first, second
+    return None
+
+  def _lookup(self, value: str) -> Optional[dict]:
+    """Parse a value asked about, which is sure only when it is either a term or a title."""
+    value = value.strip().strip("'\"")
+    candidates = [value]
+    # "an rpg" is the term "rpg", while a title may start with an article
+    article = re.match(r"(?:a|an)\s+", value, re.IGNORECASE)
+    if article:
+      candidates.append(value[article.end():])
+    for candidate in candidates:
+      is_term = self._is_term(candidate)
+      is_title = self._is_title(candidate)
+      if is_term and not is_title:
+        return self._state("get_term_explained", term=candidate)
+      if is_title and not is_term:
+        return self._state("get_game_info", title=candidate)
+    return None
+
+  def _match_free(self, text: str) -> Optional[Tuple[str, str, int]]:
+    """Match a free text discovery clause at the start of the text.
+    Returns:
+      Optional[Tuple[str, str, int]]: slot, known value and end of the clause, None if no value is known.
+    """
+    for prefix, slot in FREE_CLAUSES:
+      lead = re.match(prefix, text, re.IGNORECASE)
+      if not lead:
+        continue
+      start = lead.end()
+      ends = [sep.start() + start for sep in re.finditer(_BOUNDARY, text[start:], re.IGNORECASE)] + [len(text)]
+      # Longest value first, so titles and companies containing "and" or "for" stay whole
+      for end in reversed(ends):
+        value = text[start:end].strip()
+        if value and self._is_known(slot, value):
+          return slot, value, end
+      return None
+    return None
+
+  def _parse_discover(self, text: str) -> Optional[dict]:
+    """Parse a discovery request made only of known clauses."""
+    lead = re.match(DISCOVER_LEAD, text, re.IGNORECASE)
+    if not lead or not re.search(r"\bgames?\b", text, re.IGNORECASE):
+      return None
+
+    slots: Dict[str, Any] = {}
+    pos = lead.end()
+    while pos < len(text):
+      # Skip spaces and commas between clauses
+      gap = re.match(r"[\s,]+", text[pos:])
+      if gap:
+        pos += gap.end()
+        continue
+      slot, value, end = None, None, None
+      for pattern, clause_slot in DISCOVER_CLAUSES:
+        match = re.match(pattern, text[pos:], re.IGNORECASE)
+        if match and match.end() > 0:
+          slot, value, end = clause_slot, match.group(clause_slot), match.end()
+          break
+      else:
+        free = self._match_free(text[pos:])
+        if free is not None:
+          slot, value, end = free
+        else:
+          match = next((m for m in (re.match(p, text[pos:], re.IGNORECASE) for p in FILLERS) if m and m.end() > 0), None)
+          if match is None:
+            # Something the rules don't understand
+            return None
+          end = match.end()
+      if slot is not None:
+        # A slot given twice is not a simple request
+        if slot in slots:
+          return None
+        slots[slot] = value
+      pos += end
+
+    if not slots:
+      return None
+    for slot in ("genre", "platform", "mode"):
+      if slot in slots:
+        slots[slot] = slots[slot].lower()
+    for slot in ("release_year", "required_age"):
+      if slot in slots:
+        slots[slot] = int(slots[slot])
+    if "price" in slots:
+      slots["price"] = float(slots["price"])
+    return self._state("discover_game", **slots)
+
+  def parse(self, text: str) -> Optional[dict]:
+    """Extract intent and slots from a request if the rules are sure about them.
+    Args:
+      text (str): request on a single intent.
+    Returns:
+      Optional[dict]: nlu output with all slots of the intent, None if unsure.
+    """
+    text = re.sub(r"\s+", " ", text).strip().rstrip("?.!").strip()
+    if not text:
+      return None
+
+    if self._match(WISHLIST_PATTERNS, text):
+      return self._state("get_wishlist")
+
+    for intent, patterns in (("add_to_wishlist", ADD_PATTERNS), ("remove_from_wishlist", REMOVE_PATTERNS)):
+      match = self._match(patterns, text)
+      if match:
+        title = match.group("title").strip()
+        return self._state(intent, title=title) if self._is_title(title) else None
+
+    match = self._match(FRIEND_PATTERNS, text)
+    if match and self._is_friend(match.group("name")):
+      return self._state("get_friend_games", name=match.group("name"))
+
+    match = self._match(TERM_PATTERNS, text)
+    if match:
+      term = match.group("term").strip().strip("'\"")
+      return self._state("get_term_explained", term=term) if self._is_term(term) else None
+
+    match = self._match(COMPARE_PATTERNS, text)
+    if match:
+      pair = self._split_pair(match.group("pair"))
+      if pair is None:
+        return None
+      criteria = match.groupdict().get("criteria")
+      criteria = CRITERIA_ALIASES[criteria.lower()] if criteria else None
+      return self._state("compare_games", title1=pair[0], title2=pair[1], criteria=criteria)
+
+    match = self._match(INFO_PATTERNS, text)
+    if match:
+      title = match.group("title").strip()
+      if not self._is_title(title):
+        return None
+      info = match.group("info") if "info" in match.groupdict() else None
+      info = INFO_ALIASES[info.lower()] if info else "price"
+      return self._state("get_game_info", title=title, info=info)
+
+    match = self._match(LOOKUP_PATTERNS, text)
+    if match:
+      return self._lookup(match.group("value"))
+    match = self._match(SEARCH_PATTERNS, text)
+    if match and self._is_title(match.group("title").strip()):
+      return self._state("get_game_info", title=match.group("title").strip())
+
+    return self._parse_discover(text)
+
+
+# Rules built for every knowledge base, the title trie is expensive to build
+_RULES_BY_KB: "WeakKeyDictionary[KnowledgeBase, RuleNLU]" = WeakKeyDictionary()
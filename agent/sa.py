@@ -1,8 +1,24 @@
 from models.model import ModelLoader, LLMTask
 import re
 import json
-from typing import Any, Optional, Union
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Union
 
+SA_LABELS = ["positive", "negative", "neutral"]
+LABEL_CACHE_SIZE = 20000
+REPORT_CACHE_SIZE = 512
+
+
+def hash_text(text: str) -> str:
+  """Content hash used as cache key.
+  Args:
+    text (str): text to hash.
+  Returns:
+    str: hex digest.
+  """
+  return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
 def validate_sa(sa_out: str) -> str:
   """Validate sentiment analysis output.
@@ -21,9 +37,23 @@ def validate_sa(sa_out: str) -> str:
   return fallback_sentiment
 
 class SA:
-  def __init__(self, loader: ModelLoader, prompt: dict) -> None:
+  def __init__(self, loader: ModelLoader, prompt: dict, scoring: bool = True) -> None:
+    """Initialize component.
+    Args:
+      loader (ModelLoader): model loader for component.
+      prompt (dict): prompt for component.
+      scoring (bool): if set, labels are scored from the logits instead of generated.
+    """
     self.prompt = prompt
-    self.llm = LLMTask(loader, prompt["prompt"])
+    self.scoring = scoring
+    self.llm = LLMTask(loader, prompt["prompt"], generation=prompt.get("generation"))
+    # Usage of every review of the last batch
+    self.last_usage: List[Dict[str, Any]] = []
+
+    # Review hash -> label and report key -> (review set hash, report)
+    self.label_cache: "OrderedDict[str, str]" = OrderedDict()
+    self.report_cache: "OrderedDict[Any, tuple]" = OrderedDict()
+    self._cache_lock = threading.Lock()
   
   def generate(self, review: str, validate: bool = True) -> str:
     """Get label based on a single review.
@@ -37,11 +67,86 @@ class SA:
     if validate: return validate_sa(raw_out)
     else: return raw_out
 
-  def analyze(self, reviews: list) -> dict:
-    """Analyze multiple reviews and return a report."""
-    report = {"positive": 0, "negative": 0, "neutral": 0}
-    for review in reviews:
-      label = self.generate(review)
+  def generate_batch(self, reviews: list, validate: bool = True) -> list:
+    """Get labels for many reviews with batched generation.
+    Args:
+      reviews (list): list of reviews.
+      validate (bool): flag to set for validation.
+    Returns:
+      list: sentiment labels in the same order of the reviews.
+    """
+    raw_outs = self.llm.generate_batch(reviews)
+    self.last_usage = self.llm.last_usage
+    if validate: return [validate_sa(raw_out) for raw_out in raw_outs]
+    else: return raw_outs
+
+  def classify(self, reviews: list) -> list:
+    """Classify reviews scoring the labels on the logits instead of generating.
+    Args:
+      reviews (list): list of reviews.
+    Returns:
+      list: dicts with the most probable label and the probability of each label.
+    """
+    scores = self.llm.score_labels(reviews, SA_LABELS)
+    self.last_usage = self.llm.last_usage
+    return [{"label": max(probs, key=probs.get), "probs": probs} for probs in scores]
+
+  def _label_reviews(self, reviews: list) -> list:
+    """Label reviews running the model only on the ones never seen before.
+    Args:
+      reviews (list): list of reviews.
+    Returns:
+      list: sentiment labels in the same order of the reviews.
+    """
+    hashes = [hash_text(review) for review in reviews]
+    with self._cache_lock:
+      labels = {h: self.label_cache[h] for h in hashes if h in self.label_cache}
+
+    # Deduplicate the reviews that must go through the model
+    missing = {}
+    for h, review in zip(hashes, reviews):
+      if h not in labels:
+        missing.setdefault(h, review)
+
+    if missing:
+      if self.scoring:
+        new_labels = [result["label"] for result in self.classify(list(missing.values()))]
+      else:
+        new_labels = self.generate_batch(list(missing.values()))
+      with self._cache_lock:
+        for h, label in zip(missing.keys(), new_labels):
+          labels[h] = label
+          self.label_cache[h] = label
+          self.label_cache.move_to_end(h)
+        while len(self.label_cache) > LABEL_CACHE_SIZE:
+          self.label_cache.popitem(last=False)
+
+    return [labels[h] for h in hashes]
+
+  def analyze(self, reviews: list, key: Any = None) -> dict:
+    """Analyze multiple reviews and return a report.
+    Args:
+      reviews (list): list of reviews.
+      key (Any): optional key of the review set (e.g. the app id) to reuse its report.
+    Returns:
+      dict: count of every label.
+    """
+    set_hash = hash_text("\x1f".join(reviews))
+    if key is not None:
+      with self._cache_lock:
+        cached = self.report_cache.get(key)
+      # Reuse the report only if the reviews did not change
+      if cached is not None and cached[0] == set_hash:
+        return dict(cached[1])
+
+    report = {label: 0 for label in SA_LABELS}
+    for label in self._label_reviews(reviews):
       report[label] += 1
-    return report
 
+    if key is not None:
+      with self._cache_lock:
+        self.report_cache[key] = (set_hash, dict(report))
+        self.report_cache.move_to_end(key)
+        while len(self.report_cache) > REPORT_CACHE_SIZE:
+          self.report_cache.popitem(last=False)
+    return report
@@ -2,6 +2,6 @@ from gui.chat import ChatGUI
 from agent.agent import load_agent
 
 if __name__ == "__main__":
-  agent = load_agent()
+  agent = load_agent(lazy=True)
   gui = ChatGUI(agent)
   gui.mainloop()
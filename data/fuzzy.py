@@ -0,0 +1,76 @@
+import re
+from collections import defaultdict
+from typing import Dict, List, Tuple
+import numpy as np
+
+# Roman numerals written in titles, compared as digits
+ROMAN_NUMERALS = {
+  "i": "1", "ii": "2", "iii": "3", "iv": "4", "v": "5",
+  "vi": "6", "vii": "7", "viii": "8", "ix": "9", "x": "10"
+}
+
+
+def canonical_title(title: str) -> str:
+  """Write a normalized title in the form the index compares.
+  Args:
+    title (str): normalized title.
+  Returns:
+    str: title with roman numerals as digits and without spaces repeated.
+  """
+  words = [ROMAN_NUMERALS.get(w, w) for w in title.split()]
+  return " ".join(words)
+
+
+def trigrams(text: str) -> List[str]:
+  """Get the distinct character trigrams of a text, padded so short words have some.
+  Args:
+    text (str): canonical title.
+  Returns:
+    List[str]: trigrams.
+  """
+  padded = f"  {text} "
+  return list({padded[i:i + 3] for i in range(len(padded) - 2)})
+
+
+class TrigramIndex:
+  """Inverted index from character trigrams to titles, ranking titles by Dice similarity."""
+
+  def __init__(self, titles: List[str]) -> None:
+    """Build the index.
+    Args:
+      titles (List[str]): normalized titles, returned as they are by search.
+    """
+    self.titles = np.array(titles, dtype=object)
+    postings: Dict[str, List[int]] = defaultdict(list)
+    sizes = np.zeros(len(titles), dtype=np.int32)
+    for idx, title in enumerate(titles):
+      grams = trigrams(canonical_title(title))
+      sizes[idx] = len(grams)
+      for gram in grams:
+        postings[gram].append(idx)
+
+    self.sizes = sizes
+    self.postings = {gram: np.array(ids, dtype=np.int32) for gram, ids in postings.items()}
+
+  def search(self, query: str, k: int = 5) -> List[Tuple[str, float]]:
+    """Rank the titles sharing trigrams with the query.
+    Args:
+      query (str): normalized title to look for.
+      k (int): number of candidates to return.
+    Returns:
+      List[Tuple[str, float]]: best titles with Dice similarity in [0, 1], best first.
+    """
+    grams = trigrams(canonical_title(re.sub(r"\s+", " ", query).strip()))
+    lists = [self.postings[g] for g in grams if g in self.postings]
+    if not lists:
+      return []
+
+    # Trigrams shared with every title
+    shared = np.bincount(np.concatenate(lists), minlength=len(self.titles))
+    candidates = np.flatnonzero(shared)
+    scores = 2 * shared[candidates] / (len(grams) + self.sizes[candidates])
+
+    k = min(k, len(candidates))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind="stable")]
+    return [(self.titles[candidates[i]], float(scores[i])) for i in top]
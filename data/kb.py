@@ -1,28 +1,107 @@
 import pandas as pd
 import json
 import os
-from typing import Any, Optional
+from typing import Any, List, Optional, Tuple
 import numpy as np
 import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from data.fuzzy import TrigramIndex
+from data.query import GameQueryEngine
+from data.similarity import GameVectorIndex
+from data.review_cache import ReviewCache
 
 
 DATA_DIR = os.path.dirname(os.path.abspath(__file__))
 GAMES_PATH = os.path.join(DATA_DIR,"steam_dataset.feather")
 USER_PROFILE_PATH = os.path.join(DATA_DIR,"mock_user.json")
 GLOSSARY_PATH = os.path.join(DATA_DIR,"video_game_glossary.json")
+REVIEW_CACHE_PATH = os.path.join(DATA_DIR,"review_cache.sqlite")
+GAME_VECTORS_PATH = os.path.join(DATA_DIR,"game_vectors.npz")
+
+REVIEWS_URL = "https://store.steampowered.com/appreviews"
+# Reviews younger than the ttl are fresh, stale ones are served while refreshed
+REVIEW_TTL = 6 * 60 * 60
+REVIEW_MAX_STALE = 7 * 24 * 60 * 60
+# Connect and read timeout of a single review request
+REVIEW_TIMEOUT = (3.05, 10)
+REVIEW_WORKERS = 4
+# A misspelled title resolves to its best match only if similar enough and clearly ahead of the next one
+FUZZY_MIN_SCORE = 0.6
+FUZZY_MARGIN = 0.05
+# Games similar to a title must share at least this share of its genres
+SIMILAR_MIN_GENRE_OVERLAP = 0.5
 
 
 class KnowledgeBase:
   """KnowledgeBase class used to get data to return to the user."""
 
-  def __init__(self):
-    """Initialize external knowledge module."""
+  def __init__(
+      self,
+      review_ttl: float = REVIEW_TTL,
+      review_max_stale: float = REVIEW_MAX_STALE,
+      offline: Optional[bool] = None,
+      reviews_url: Optional[str] = None
+    ):
+    """Initialize external knowledge module.
+    Args:
+      review_ttl (float): seconds after which cached reviews are refreshed.
+      review_max_stale (float): seconds after the ttl in which stale reviews are still served.
+      offline (Optional[bool]): only serve reviews from cache, defaults to STEAM_REVIEWS_OFFLINE.
+      reviews_url (Optional[str]): base url of the reviews endpoint, defaults to STEAM_REVIEWS_URL.
+    """
     # Load games dataset
     self.game_database = pd.read_feather(GAMES_PATH)
+    # Index titles to avoid scanning the dataset on every lookup
+    self.title_index = self._build_title_index()
+    # Trigram index to resolve titles that are slightly off
+    self.title_search = TrigramIndex(list(self.title_index.keys()))
+    # Precompute the columns used by discover_game
+    self.query_engine = GameQueryEngine(self.game_database)
+    # Vectors of the games to find similar ones, saved to disk to skip building them
+    self.vector_index = GameVectorIndex.load_or_build(GAME_VECTORS_PATH, self._dataset_fingerprint(), self.game_database, self.query_engine)
     # Load user profile
     self.user_profile = self._load_json(USER_PROFILE_PATH)
+    # Sessions of the server share the profile
+    self._profile_lock = threading.Lock()
     self.glossary = self._load_json(GLOSSARY_PATH)
+
+    # Review fetching settings, env variables allow pointing to a local server
+    self.review_cache = ReviewCache(REVIEW_CACHE_PATH)
+    self.review_ttl = review_ttl
+    self.review_max_stale = review_max_stale
+    if offline is None:
+      offline = os.getenv("STEAM_REVIEWS_OFFLINE", "0").lower() in ("1", "true", "yes")
+    self.offline = offline
+    self.reviews_url = reviews_url or os.getenv("STEAM_REVIEWS_URL", REVIEWS_URL)
+    # Pooled keep-alive session shared by the fetching threads
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=REVIEW_WORKERS, pool_maxsize=REVIEW_WORKERS)
+    self.session.mount("https://", adapter)
+    self.session.mount("http://", adapter)
+    self.review_executor = ThreadPoolExecutor(max_workers=REVIEW_WORKERS, thread_name_prefix="reviews")
+    # App ids being refreshed in background
+    self._revalidating = set()
+    self._revalidating_lock = threading.Lock()
   
+  def _build_title_index(self) -> dict:
+    """Map every normalized title to the position of its first row.
+    Returns:
+      dict: normalized title to row position.
+    """
+    index = {}
+    for pos, title in enumerate(self.game_database['name_normalized'].tolist()):
+      # Keep the first match like the previous lookup did
+      index.setdefault(title, pos)
+    return index
+
+  def _dataset_fingerprint(self) -> str:
+    """Identify the dataset file, so indices saved from another version are rebuilt."""
+    stat = os.stat(GAMES_PATH)
+    return f"{stat.st_size}:{stat.st_mtime_ns}:{len(self.game_database)}"
+
   def _load_json(self, path: str) -> Any:
     """Utility to load json files.
     Args:
@@ -42,20 +121,51 @@ class KnowledgeBase:
     with open(path, "w", encoding="utf-8") as file:
       json.dump(data, file, indent=2)
 
-  def game_by_title(self, title: str) -> Optional[dict]:
+  def title_candidates(self, title: str, k: int = 5) -> List[Tuple[str, float]]:
+    """Get the titles closest to a possibly misspelled one.
+    Args:
+      title (str): normalized title.
+      k (int): number of candidates.
+    Returns:
+      List[Tuple[str, float]]: normalized titles with similarity in [0, 1], best first.
+    """
+    return self.title_search.search(title, k)
+
+  def resolve_title(self, title: str) -> Optional[str]:
+    """Get the title of the dataset a user title refers to.
+    Args:
+      title (str): normalized title, possibly slightly off.
+    Returns:
+      Optional[str]: normalized title in the dataset, None if no title is close enough.
+    """
+    if title in self.title_index:
+      return title
+    candidates = self.title_candidates(title, k=2)
+    if not candidates or candidates[0][1] < FUZZY_MIN_SCORE:
+      return None
+    if len(candidates) > 1 and candidates[0][1] - candidates[1][1] < FUZZY_MARGIN:
+      # Too close to tell which one the user meant
+      return None
+    return candidates[0][0]
+
+  def game_by_title(self, title: str, fuzzy: bool = True) -> Optional[dict]:
     """Get a game given the title.
     Args:
       title (str): title of the game already normalized.
+      fuzzy (bool): accept a title slightly off from the one in the dataset.
     Returns:
       Optional[dict]: returns the data of that game.
     """
-    match = self.game_database[self.game_database['name_normalized'] == title]
-      
-    if match.empty:
+    if title is None:
       return None
-    
-    result = match.iloc[0]
-    return result.to_dict()
+    if fuzzy:
+      title = self.resolve_title(title)
+    pos = self.title_index.get(title)
+
+    if pos is None:
+      return None
+
+    return self.game_database.iloc[pos].to_dict()
   
 
   def get_game_info(self, title: str, info: str) -> dict:
@@ -115,64 +225,41 @@ class KnowledgeBase:
     Returns:
       dict: result containing matches.
     """
-    # Copy the game database
-    filtered_games = self.game_database.copy()
-
-    # Filtering genre
-    if genre:
-      filtered_games = filtered_games[filtered_games['genres'].astype(str).str.contains(genre, case=False, na=False)]
-    # Filtering the price as an upper bound
-    if price:
-      filtered_games = filtered_games[filtered_games['price'] <= price]
-    # Filter release year
-    if release_year:
-      # From date take the year
-      filtered_games = filtered_games[filtered_games['release_date'].apply(lambda x: x.year) == release_year]
-    # Filter platform
-    if platform:
-      filtered_games = filtered_games[filtered_games[platform] == True]
-    # Filter game mode
-    if mode:
-      if mode == "singleplayer":
-        mode = "single-player"
-      elif mode == "multiplayer":
-        mode = "multi-player"
-      filtered_games = filtered_games[filtered_games['categories'].astype(str).str.contains(mode, case=False, na=False)]
-    # Filter required age
-    if required_age:
-      filtered_games = filtered_games[filtered_games['required_age'] == required_age]
-    # Filter publisher and developer using the normalized fields
-    if publisher:
-      filtered_games = filtered_games[filtered_games['publishers_normalized'].str.contains(publisher, case=False, na=False)]
-    if developer:
-      filtered_games = filtered_games[filtered_games['developers_normalized'].str.contains(developer, case=False, na=False)]
-    # Filter from genres of a similar game
+    # Position of the similar game
+    sim_pos = None
     if similar_title:
-      sim_game = self.game_by_title(similar_title)
-      if not sim_game:
+      sim_pos = self.title_index.get(self.resolve_title(similar_title))
+      if sim_pos is None:
         return {"error": f"No similar game found of name {similar_title}"}
-      sim_genres = sim_game.get('genres', [])
-      # Take main 3 genres for query
-      top_3_genres = sim_genres[:10]
-      for g in top_3_genres:
-        filtered_games = filtered_games[filtered_games['genres'].astype(str).str.contains(g, case=False, na=False)]
-      # Exclude similar title from results
-      filtered_games = filtered_games[filtered_games['name_normalized'] != sim_game['name_normalized']]
 
+    # Evaluate all filters as vectorized masks
+    positions = self.query_engine.filter(
+      genre=genre,
+      price=price,
+      release_year=release_year,
+      platform=platform,
+      mode=mode,
+      required_age=required_age,
+      publisher=publisher,
+      developer=developer,
+      exclude_title=self.query_engine.names_normalized[sim_pos] if sim_pos is not None else None
+    )
+
+    # Games closest to the similar one come first, among those sharing its main genres
+    if sim_pos is not None:
+      overlap = self.query_engine.genre_overlap(sim_pos)
+      positions = positions[overlap[positions] >= SIMILAR_MIN_GENRE_OVERLAP]
+      positions = self.vector_index.similar(sim_pos, k=10, candidates=positions)
 
     # Take 5 matches
-    candidates = filtered_games.head(10)
+    candidates = positions[:10]
     sampling_size = min(len(candidates), 5)
 
-    if sampling_size > 0:
-      results = candidates.sample(n=sampling_size)
-    else:
-      results = candidates
-
-    if results.empty:
+    if sampling_size == 0:
       return {"error": "No matches found with characteristics."}
 
-    return {"games": results['name'].tolist()}
+    results = np.random.choice(candidates, size=sampling_size, replace=False)
+    return {"games": self.query_engine.names[results].tolist()}
 
 
   def compare_games(self, title1: str, title2: str, criteria: str) -> dict:
@@ -200,9 +287,8 @@ class KnowledgeBase:
       case "review":
         id1 = game1.get("appid", 0)
         id2 = game2.get("appid", 0)
-        reviews1 = self.get_reviews(id1)
-        reviews2 = self.get_reviews(id2)
-        data = {title1: reviews1, title2: reviews2}
+        reviews = self.get_reviews_many([id1, id2])
+        data = {title1: reviews[id1], title2: reviews[id2]}
       case _:
         return {"error": "Invalid criteria"}
 
@@ -256,13 +342,14 @@ class KnowledgeBase:
     if not game:
       return {"error": f"No game found with title '{title}'"}
         
-    # Check if already in wishlist
-    current_wishlist = self.user_profile.get('wishlist', [])
-    if game['name_normalized'] in current_wishlist:
-      return {"error": f"'{game['name']}' is already in wishlist"}
-
-    self.user_profile['wishlist'].append(game['name_normalized'])
-    self._save_json(self.user_profile, USER_PROFILE_PATH)
+    with self._profile_lock:
+      # Check if already in wishlist
+      current_wishlist = self.user_profile.get('wishlist', [])
+      if game['name_normalized'] in current_wishlist:
+        return {"error": f"'{game['name']}' is already in wishlist"}
+
+      self.user_profile['wishlist'].append(game['name_normalized'])
+      self._save_json(self.user_profile, USER_PROFILE_PATH)
     return {"confirmation": f"Added '{game['name']}' to your wishlist"}
 
 
@@ -273,16 +360,17 @@ class KnowledgeBase:
     Returns:
       dict: confirm or error message
     """
-
-    current_wishlist = self.user_profile.get('wishlist', [])
-    # Find a match in current wishlist of the title
-    match = next((g for g in current_wishlist if g == title), None)
-        
-    if not match:
-      return {"error": f"'{title}' was not found in your wishlist"}
-    
-    self.user_profile['wishlist'].remove(match)
-    self._save_json(self.user_profile, USER_PROFILE_PATH)
+    with self._profile_lock:
+      current_wishlist = self.user_profile.get('wishlist', [])
+      # Find a match in current wishlist of the title, or of the dataset title it refers to
+      resolved = title if title in current_wishlist else self.resolve_title(title)
+      match = next((g for g in current_wishlist if g == resolved), None)
+          
+      if not match:
+        return {"error": f"'{title}' was not found in your wishlist"}
+      
+      self.user_profile['wishlist'].remove(match)
+      self._save_json(self.user_profile, USER_PROFILE_PATH)
     return {"confirmation": f"Removed '{match}' from your wishlist"}
     
   
@@ -296,14 +384,14 @@ class KnowledgeBase:
     return {"wishlist": wl}
 
 
-  def get_reviews(self, id: int) -> list:
+  def _fetch_reviews(self, id: int) -> Optional[list]:
     """Using API get up to date reviews on a game.
     Args:
       id (int): app id of game.
     Returns:
-      list: list of recent reviews for that given game.
+      Optional[list]: list of recent reviews, None if the request failed.
     """
-    url = f'https://store.steampowered.com/appreviews/{id}'
+    url = f'{self.reviews_url}/{id}'
     params = {
       'json': 1,
       'filter': 'recent',
@@ -311,7 +399,7 @@ class KnowledgeBase:
       'num_per_page': 50
     }
     try:
-      response = requests.get(url, params=params)
+      response = self.session.get(url, params=params, timeout=REVIEW_TIMEOUT)
       response.raise_for_status() # Raise error for bad responses (4xx, 5xx)
       data = response.json()
       # Check if 'reviews' key exists in case of empty response
@@ -322,8 +410,77 @@ class KnowledgeBase:
         return [] 
     except requests.RequestException as e:
       print(f"Error fetching reviews: {e}")
+      return None
+
+  def _refresh_reviews(self, id: int) -> Optional[list]:
+    """Fetch reviews and store them in the cache.
+    Args:
+      id (int): app id of game.
+    Returns:
+      Optional[list]: fetched reviews, None if the request failed.
+    """
+    reviews = self._fetch_reviews(id)
+    if reviews is not None:
+      self.review_cache.put(id, reviews)
+    return reviews
+
+  def _revalidate(self, id: int) -> None:
+    """Refresh the cached reviews of a game in background.
+    Args:
+      id (int): app id of game.
+    """
+    with self._revalidating_lock:
+      if id in self._revalidating:
+        return
+      self._revalidating.add(id)
+
+    def run() -> None:
+      """Refresh and mark the app id as done."""
+      try:
+        self._refresh_reviews(id)
+      finally:
+        with self._revalidating_lock:
+          self._revalidating.discard(id)
+
+    self.review_executor.submit(run)
+
+  def get_reviews(self, id: int) -> list:
+    """Get recent reviews on a game, served from the local cache when fresh enough.
+    Args:
+      id (int): app id of game.
+    Returns:
+      list: list of recent reviews for that given game.
+    """
+    cached = self.review_cache.get(id)
+    if cached is not None:
+      reviews, fetched_at = cached
+      age = time.time() - fetched_at
+      if self.offline or age < self.review_ttl:
+        return reviews
+      if age < self.review_ttl + self.review_max_stale:
+        # Serve stale reviews while they are refreshed
+        self._revalidate(id)
+        return reviews
+    elif self.offline:
       return []
 
+    reviews = self._refresh_reviews(id)
+    if reviews is None:
+      # On network errors old reviews are better than nothing
+      return cached[0] if cached is not None else []
+    return reviews
+
+  def get_reviews_many(self, ids: list) -> dict:
+    """Get reviews of several games fetching them concurrently.
+    Args:
+      ids (list): app ids of the games.
+    Returns:
+      dict: app id to list of recent reviews.
+    """
+    unique_ids = list(dict.fromkeys(ids))
+    results = self.review_executor.map(self.get_reviews, unique_ids)
+    return dict(zip(unique_ids, results))
+
 
 if __name__ == "__main__":
   kb = KnowledgeBase()
@@ -0,0 +1,164 @@
+import numpy as np
+import pandas as pd
+from typing import List, Optional, Tuple
+
+PLATFORMS = ["windows", "mac", "linux"]
+
+
+class GameQueryEngine:
+  """Filter engine over columns of the games dataset precomputed at load time."""
+
+  def __init__(self, game_database: pd.DataFrame) -> None:
+    """Precompute the columns used by the discover filters.
+    Args:
+      game_database (pd.DataFrame): games dataset.
+    """
+    self.n_games = len(game_database)
+    self.names = game_database['name'].to_numpy()
+    self.names_normalized = game_database['name_normalized'].to_numpy()
+
+    # Multi-hot matrices of genres and categories
+    self.genre_vocab, self.genre_matrix = self._multi_hot(game_database['genres'])
+    self.category_vocab, self.category_matrix = self._multi_hot(game_database['categories'])
+
+    # Numeric columns, missing values never satisfy a filter
+    self.year = pd.to_datetime(game_database['release_date'], errors="coerce").dt.year.fillna(-1).astype(np.int32).to_numpy()
+    self.price = pd.to_numeric(game_database['price'], errors="coerce").to_numpy(dtype=np.float64)
+    self.required_age = pd.to_numeric(game_database['required_age'], errors="coerce").to_numpy(dtype=np.float64)
+
+    self.platforms = {p: (game_database[p] == True).to_numpy() for p in PLATFORMS}
+
+    # Factorized names so substring search runs on unique values only
+    self.publisher_codes, self.publishers = self._factorize(game_database['publishers_normalized'])
+    self.developer_codes, self.developers = self._factorize(game_database['developers_normalized'])
+
+  @staticmethod
+  def _multi_hot(column: pd.Series) -> Tuple[List[str], np.ndarray]:
+    """Turn a column of string lists into a vocabulary and a boolean matrix.
+    Args:
+      column (pd.Series): column where every cell is a list of strings.
+    Returns:
+      Tuple[List[str], np.ndarray]: lowercase vocabulary and matrix of shape (n_games, vocab_size).
+    """
+    vocab = {}
+    rows = []
+    cols = []
+    for row, values in enumerate(column.tolist()):
+      if values is None or isinstance(values, float):
+        continue
+      for value in values:
+        col = vocab.setdefault(str(value).lower(), len(vocab))
+        rows.append(row)
+        cols.append(col)
+
+    matrix = np.zeros((len(column), len(vocab)), dtype=bool)
+    matrix[rows, cols] = True
+    return list(vocab.keys()), matrix
+
+  @staticmethod
+  def _factorize(column: pd.Series) -> Tuple[np.ndarray, List[str]]:
+    """Encode a string column as integer codes.
+    Args:
+      column (pd.Series): string column.
+    Returns:
+      Tuple[np.ndarray, List[str]]: code of every row and lowercase unique values.
+    """
+    codes, uniques = pd.factorize(column)
+    return codes, [str(u).lower() for u in uniques]
+
+  @staticmethod
+  def _vocab_match(vocab: List[str], matrix: np.ndarray, term: str) -> np.ndarray:
+    """Rows having at least one value containing the term.
+    Args:
+      vocab (List[str]): vocabulary of the matrix.
+      matrix (np.ndarray): multi-hot matrix.
+      term (str): substring to search, case insensitive.
+    Returns:
+      np.ndarray: boolean mask of matching rows.
+    """
+    term = term.lower()
+    cols = [i for i, value in enumerate(vocab) if term in value]
+    if not cols:
+      return np.zeros(matrix.shape[0], dtype=bool)
+    return matrix[:, cols].any(axis=1)
+
+  @staticmethod
+  def _code_match(codes: np.ndarray, uniques: List[str], term: str) -> np.ndarray:
+    """Rows whose value contains the term.
+    Args:
+      codes (np.ndarray): code of every row.
+      uniques (List[str]): values of the codes.
+      term (str): substring to search, case insensitive.
+    Returns:
+      np.ndarray: boolean mask of matching rows.
+    """
+    term = term.lower()
+    matched = [code for code, value in enumerate(uniques) if term in value]
+    return np.isin(codes, matched)
+
+  def filter(
+      self,
+      genre: Optional[str] = None,
+      price: Optional[float] = None,
+      release_year: Optional[int] = None,
+      platform: Optional[str] = None,
+      mode: Optional[str] = None,
+      required_age: Optional[int] = None,
+      publisher: Optional[str] = None,
+      developer: Optional[str] = None,
+      exclude_title: Optional[str] = None
+    ) -> np.ndarray:
+    """Get the games satisfying every given filter.
+    Args:
+      genre (Optional[str]): genre of the games.
+      price (Optional[float]): higher bound of the price.
+      release_year (Optional[int]): year of release.
+      platform (Optional[str]): platform where the game must run.
+      mode (Optional[str]): either singleplayer or multiplayer.
+      required_age (Optional[int]): required age to play the game.
+      publisher (Optional[str]): normalized publisher name.
+      developer (Optional[str]): normalized developer name.
+      exclude_title (Optional[str]): normalized title to leave out.
+    Returns:
+      np.ndarray: positions of the matching games in dataset order.
+    """
+    mask = np.ones(self.n_games, dtype=bool)
+
+    if genre:
+      mask &= self._vocab_match(self.genre_vocab, self.genre_matrix, genre)
+    if price:
+      mask &= self.price <= price
+    if release_year:
+      mask &= self.year == release_year
+    if platform:
+      if platform not in self.platforms:
+        return np.array([], dtype=np.int64)
+      mask &= self.platforms[platform]
+    if mode:
+      if mode == "singleplayer":
+        mode = "single-player"
+      elif mode == "multiplayer":
+        mode = "multi-player"
+      mask &= self._vocab_match(self.category_vocab, self.category_matrix, mode)
+    if required_age:
+      mask &= self.required_age == required_age
+    if publisher:
+      mask &= self._code_match(self.publisher_codes, self.publishers, publisher)
+    if developer:
+      mask &= self._code_match(self.developer_codes, self.developers, developer)
+    if exclude_title:
+      mask &= self.names_normalized != exclude_title
+
+    return np.flatnonzero(mask)
+
+  def genre_overlap(self, position: int) -> np.ndarray:
+    """Get the share of the genres of a game that every game has too.
+    Args:
+      position (int): position of the reference game.
+    Returns:
+      np.ndarray: fraction in [0, 1] for every game, ones if the reference game has no genres.
+    """
+    genres = np.flatnonzero(self.genre_matrix[position])
+    if len(genres) == 0:
+      return np.ones(self.n_games, dtype=np.float32)
+    return self.genre_matrix[:, genres].sum(axis=1, dtype=np.float32) / len(genres)
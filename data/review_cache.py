@@ -0,0 +1,57 @@
+import json
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from typing import List, Optional, Tuple
+
+
+class ReviewCache:
+  """On-disk cache of Steam reviews keyed by app id."""
+
+  def __init__(self, path: str) -> None:
+    """Open the cache creating the table if needed.
+    Args:
+      path (str): path of the sqlite database.
+    """
+    self.path = path
+    self._lock = threading.Lock()
+    with self._lock, closing(self._connect()) as conn, conn:
+      conn.execute(
+        "CREATE TABLE IF NOT EXISTS reviews ("
+        "appid INTEGER PRIMARY KEY, reviews TEXT NOT NULL, fetched_at REAL NOT NULL)"
+      )
+
+  def _connect(self) -> sqlite3.Connection:
+    """Open a connection, a new one is used for every operation so threads don't share it."""
+    return sqlite3.connect(self.path, timeout=10)
+
+  def get(self, appid: int) -> Optional[Tuple[List[str], float]]:
+    """Get the cached reviews of a game.
+    Args:
+      appid (int): app id of the game.
+    Returns:
+      Optional[Tuple[List[str], float]]: reviews and unix time of the fetch, None if missing.
+    """
+    with self._lock, closing(self._connect()) as conn:
+      row = conn.execute(
+        "SELECT reviews, fetched_at FROM reviews WHERE appid = ?", (int(appid),)
+      ).fetchone()
+    if row is None:
+      return None
+    return json.loads(row[0]), row[1]
+
+  def put(self, appid: int, reviews: List[str], fetched_at: Optional[float] = None) -> None:
+    """Store the reviews of a game.
+    Args:
+      appid (int): app id of the game.
+      reviews (List[str]): fetched reviews.
+      fetched_at (Optional[float]): unix time of the fetch, now if not given.
+    """
+    if fetched_at is None:
+      fetched_at = time.time()
+    with self._lock, closing(self._connect()) as conn, conn:
+      conn.execute(
+        "INSERT OR REPLACE INTO reviews (appid, reviews, fetched_at) VALUES (?, ?, ?)",
+        (int(appid), json.dumps(reviews), fetched_at)
+      )
@@ -0,0 +1,139 @@
+import os
+from typing import Any, List, Optional
+import numpy as np
+import pandas as pd
+from data.query import GameQueryEngine
+
+# Bump when the way vectors are built changes, so saved indices are rebuilt
+VECTOR_VERSION = 1
+# Weight of every block of features in the similarity
+GENRE_WEIGHT = 1.0
+CATEGORY_WEIGHT = 0.5
+TAG_WEIGHT = 1.0
+# Most voted tags kept for every game, and size of the tag vocabulary
+TAGS_PER_GAME = 10
+MAX_TAGS = 256
+
+
+def _top_tags(value: Any) -> List[str]:
+  """Get the most voted tags of a game, tags are either a dict of votes or a list."""
+  if isinstance(value, dict):
+    votes = {k: v for k, v in value.items() if v is not None}
+    return sorted(votes, key=votes.get, reverse=True)[:TAGS_PER_GAME]
+  if value is None or isinstance(value, float):
+    return []
+  return list(value)[:TAGS_PER_GAME]
+
+
+def _tag_matrix(game_database: pd.DataFrame) -> np.ndarray:
+  """Multi-hot matrix of the most common tags, empty if the dataset has no tags."""
+  if "tags" not in game_database.columns:
+    return np.zeros((len(game_database), 0), dtype=bool)
+  tags = game_database["tags"].map(_top_tags)
+  counts = pd.Series([t for game_tags in tags for t in game_tags], dtype=object).value_counts()
+  keep = set(counts.index[:MAX_TAGS])
+  _, matrix = GameQueryEngine._multi_hot(tags.map(lambda game_tags: [t for t in game_tags if t in keep]))
+  return matrix
+
+
+class GameVectorIndex:
+  """L2 normalized feature vectors of the games, to rank games by cosine similarity."""
+
+  def __init__(self, vectors: np.ndarray) -> None:
+    """Initialize the index.
+    Args:
+      vectors (np.ndarray): float32 matrix of shape (n_games, n_features) with unit rows, or zero rows for games without features.
+    """
+    self.vectors = vectors
+
+  @classmethod
+  def from_database(cls, game_database: pd.DataFrame, query_engine: GameQueryEngine) -> "GameVectorIndex":
+    """Build the vectors from genres, categories and tags.
+    Args:
+      game_database (pd.DataFrame): games dataset.
+      query_engine (GameQueryEngine): engine with the genre and category matrices already built.
+    Returns:
+      GameVectorIndex: the index.
+    """
+    blocks = [
+      query_engine.genre_matrix.astype(np.float32) * GENRE_WEIGHT,
+      query_engine.category_matrix.astype(np.float32) * CATEGORY_WEIGHT,
+      _tag_matrix(game_database).astype(np.float32) * TAG_WEIGHT
+    ]
+    vectors = np.concatenate(blocks, axis=1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors /= np.where(norms > 0, norms, 1.0)
+    return cls(vectors)
+
+  def save(self, path: str, fingerprint: str) -> None:
+    """Save the vectors with the fingerprint of the dataset they come from.
+    Args:
+      path (str): npz file.
+      fingerprint (str): fingerprint of the dataset.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez_compressed(path, vectors=self.vectors, fingerprint=np.array(fingerprint))
+
+  @classmethod
+  def load(cls, path: str, fingerprint: str) -> Optional["GameVectorIndex"]:
+    """Load saved vectors if they come from the same dataset.
+    Args:
+      path (str): npz file.
+      fingerprint (str): fingerprint of the current dataset.
+    Returns:
+      Optional[GameVectorIndex]: the index, None if missing or outdated.
+    """
+    if not os.path.exists(path):
+      return None
+    try:
+      with np.load(path) as data:
+        if str(data["fingerprint"]) != fingerprint:
+          return None
+        return cls(data["vectors"])
+    except Exception as e:
+      print(f"Could not load game vectors ({e}), rebuilding them.")
+      return None
+
+  @classmethod
+  def load_or_build(cls, path: str, fingerprint: str, game_database: pd.DataFrame, query_engine: GameQueryEngine) -> "GameVectorIndex":
+    """Load the saved vectors, building and saving them when missing or outdated.
+    Args:
+      path (str): npz file.
+      fingerprint (str): fingerprint of the current dataset.
+      game_database (pd.DataFrame): games dataset.
+      query_engine (GameQueryEngine): engine with the genre and category matrices.
+    Returns:
+      GameVectorIndex: the index.
+    """
+    index = cls.load(path, f"{VECTOR_VERSION}:{fingerprint}")
+    if index is None:
+      print("Building game vectors.")
+      index = cls.from_database(game_database, query_engine)
+      index.save(path, f"{VECTOR_VERSION}:{fingerprint}")
+    return index
+
+  def similar(self, position: int, k: int = 10, candidates: Optional[np.ndarray] = None) -> np.ndarray:
+    """Get the games most similar to one.
+    Args:
+      position (int): position of the reference game.
+      k (int): number of games to return.
+      candidates (Optional[np.ndarray]): positions to rank, every game if None.
+    Returns:
+      np.ndarray: positions of the most similar games with some feature in common, best first.
+    """
+    if candidates is None:
+      candidates = np.arange(self.vectors.shape[0])
+    candidates = candidates[candidates != position]
+    if len(candidates) == 0:
+      return candidates
+
+    # Scoring every game avoids copying the candidate rows
+    scores = (self.vectors @ self.vectors[position])[candidates]
+    # Games sharing nothing are not similar
+    keep = scores > 0
+    candidates, scores = candidates[keep], scores[keep]
+    k = min(k, len(candidates))
+    if k == 0:
+      return candidates[:0]
+    top = np.argpartition(-scores, k - 1)[:k]
+    return candidates[top[np.argsort(-scores[top], kind="stable")]]
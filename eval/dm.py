@@ -1,28 +1,59 @@
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
 import json
 from collections import defaultdict
-from eval.evaluator import Evaluator
-from agent.dm import DM
-from tqdm import tqdm
+from eval.evaluator import Evaluator, EVAL_BATCH_SIZE, CHECKPOINT_FSYNC_EVERY
+from agent.dm import DM, RuleBasedDM
+from models.model import make_usage
 import os
+import time
 
 EVAL_DIR = os.path.dirname(os.path.abspath(__file__))
 RESULTS_PATH = os.path.join(EVAL_DIR, "results", "dm_results.json")
-STATE_PATH = os.path.join(EVAL_DIR, "temp", "dm_state.json")
+STATE_PATH = os.path.join(EVAL_DIR, "temp", "dm_state.jsonl")
+EXPORT_PATH = os.path.join(EVAL_DIR, "temp", "dm_state.json")
+# The rule based dm takes microseconds per sample, a process only pays off its startup over many samples
+MIN_SAMPLES_PER_WORKER = 50000
+
+
+def predict_rule_based(samples: List[dict]) -> List[Tuple[str, dict]]:
+  """Get the rule based nba of the samples, at module level so it can run in a process pool.
+  Args:
+    samples (List[dict]): test samples.
+  Returns:
+    List[Tuple[str, dict]]: nba and usage of every sample.
+  """
+  rule_dm = RuleBasedDM()
+  results = []
+  for sample in samples:
+    start = time.perf_counter()
+    pred = rule_dm.generate(json.dumps(sample["ds"]))
+    results.append((pred, make_usage(latency=time.perf_counter() - start)))
+  return results
+
 
 class DM_Evaluator(Evaluator):
   def __init__(
     self, 
     dm: DM,
     filepath: str,
-    prompt: Dict):
+    prompt: Dict,
+    batch_size: int = EVAL_BATCH_SIZE,
+    fsync_every: int = CHECKPOINT_FSYNC_EVERY,
+    run_name: Optional[str] = None,
+    workers: Optional[int] = None):
     """Initialize evaluator.
     Args:
       dm (DM): component to evaluate.
       filepath (str): test set filepath.
       prompt (dict): prompt for the task.
+      batch_size (int): number of samples passed to the component at once.
+      fsync_every (int): checkpoint records written between two fsync.
+      run_name (Optional[str]): suffix of the state and results files.
+      workers (Optional[int]): processes running the rule based dm, used only with enough samples for each of them.
+        The rule based dm runs inline if None.
     """
-    super().__init__(dm, filepath, prompt)
+    super().__init__(dm, filepath, prompt, batch_size, fsync_every, run_name)
+    self.workers = workers
 
     # Get predictions
     pred_states, gt_states = self.get_pred_gt()
@@ -35,29 +66,33 @@ class DM_Evaluator(Evaluator):
     Returns:
       tuple: predicitons and ground truths.
     """
-    # Resume state from file
-    start_idx, pred_states, gt_states = self.resume_eval_state(STATE_PATH)
-    # Check if eval is already done
-    if start_idx >= len(self.test_set):
-      return pred_states, gt_states
-
-    remaining_samples = self.test_set[start_idx:]
-
-    for sample in tqdm(remaining_samples, desc="Evaluating DM", initial=start_idx, total=len(self.test_set)):
-      # Adapt prompt based on intent
-      pred = self.component.generate(sample["ds"], validate = False)
-      
-      pred_states.append(pred)
-      gt_states.append(sample["annotation"])
-
-      # Save state every k samples
-      if len(pred_states) % 10 == 0:
-        self.save_eval_state(pred_states, gt_states, STATE_PATH)
-    
-    # Save last batch of samples
-    self.save_eval_state(pred_states, gt_states, STATE_PATH)
-
-    return pred_states, gt_states
+    rule_based = isinstance(self.component.llm, RuleBasedDM)
+    workers = None
+    if rule_based and self.workers and self.workers > 1:
+      workers = min(self.workers, len(self.test_set) // MIN_SAMPLES_PER_WORKER) or None
+    return self.predict_test_set(
+      self.run_path(STATE_PATH),
+      self.run_path(EXPORT_PATH),
+      predict_rule_based if rule_based else self.predict_batch,
+      "Evaluating DM",
+      # Samples with the same intent share the prompt
+      group_key=lambda sample: sample["ds"].get("intent", "out_of_domain"),
+      workers=workers
+    )
+
+  def predict_batch(self, samples: List[dict]) -> List[Tuple[str, dict]]:
+    """Get the nba of a batch of samples.
+    Args:
+      samples (List[dict]): test samples.
+    Returns:
+      List[Tuple[str, dict]]: raw dm output and usage of every sample.
+    """
+    preds = self.component.generate_batch([sample["ds"] for sample in samples], validate=False)
+    return list(zip(preds, self.component.last_usage))
+
+  def cost_class(self, sample: dict) -> str:
+    """Samples are grouped by the intent of their ds."""
+    return sample["ds"].get("intent", "out_of_domain")
   
   @staticmethod
   def _action_is_equal(pred: str, gt: str) -> bool:
@@ -101,8 +136,11 @@ class DM_Evaluator(Evaluator):
       "total_accuracy": total_accuracy,
       "class_accuracy": class_accuracy,
     }
+    metrics["cost"] = self.evaluate_cost()
+    if self.samples_per_sec is not None:
+      metrics["samples_per_sec"] = self.samples_per_sec
 
-    self.save_results(metrics, RESULTS_PATH)
+    self.save_results(metrics, self.run_path(RESULTS_PATH))
 
     return metrics
   
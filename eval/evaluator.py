@@ -1,26 +1,383 @@
-from typing import List, Tuple, Any
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional, Tuple
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+import numpy as np
+import hashlib
 import json
 import os
+import time
+
+# Samples passed to the component at once, and samples between two checkpoints
+EVAL_BATCH_SIZE = 16
+EVAL_CHUNK_SIZE = 64
+# Checkpoint records written between two fsync
+CHECKPOINT_FSYNC_EVERY = 256
+
+
+class BatchRunner:
+  """Run a component over test samples in batches, keeping the order of the samples."""
+
+  def __init__(
+    self,
+    predict_batch: Callable[[List[dict]], List[Any]],
+    batch_size: int = EVAL_BATCH_SIZE,
+    chunk_size: int = EVAL_CHUNK_SIZE,
+    group_key: Optional[Callable[[dict], Hashable]] = None,
+    workers: Optional[int] = None,
+    desc: str = "Evaluating"
+    ):
+    """Initialize runner.
+    Args:
+      predict_batch (Callable[[List[dict]], List[Any]]): predictions for a list of samples, in the same order.
+      batch_size (int): maximum number of samples in a batch.
+      chunk_size (int): samples grouped together, and returned at once to be checkpointed.
+      group_key (Optional[Callable[[dict], Hashable]]): samples of a batch share this key, such as the intent.
+      workers (Optional[int]): run batches in a pool of processes, predict_batch must be picklable.
+      desc (str): description of the progress bar.
+    """
+    self.predict_batch = predict_batch
+    self.batch_size = batch_size
+    self.chunk_size = max(chunk_size, batch_size)
+    self.group_key = group_key
+    self.workers = workers
+    self.desc = desc
+    self.samples_per_sec: Optional[float] = None
+
+  def _batches(self, chunk: List[dict]) -> List[List[int]]:
+    """Split a chunk into batches of samples with the same key.
+    Args:
+      chunk (List[dict]): samples of the chunk.
+    Returns:
+      List[List[int]]: positions of the samples of every batch.
+    """
+    groups: Dict[Hashable, List[int]] = {}
+    for idx, sample in enumerate(chunk):
+      key = self.group_key(sample) if self.group_key is not None else None
+      groups.setdefault(key, []).append(idx)
+    return [
+      positions[i:i + self.batch_size]
+      for positions in groups.values()
+      for i in range(0, len(positions), self.batch_size)
+    ]
+
+  def run(
+    self,
+    samples: List[dict],
+    on_chunk: Optional[Callable[[List[dict], List[Any]], None]] = None,
+    initial: int = 0
+    ) -> List[Any]:
+    """Get the predictions of all samples.
+    Args:
+      samples (List[dict]): samples to predict.
+      on_chunk (Optional[Callable[[List[dict], List[Any]], None]]): called with every chunk and its predictions, in order.
+      initial (int): samples already done in a previous run, for the progress bar.
+    Returns:
+      List[Any]: predictions in the same order of the samples.
+    """
+    predictions: List[Any] = []
+    if not samples:
+      return predictions
+
+    pool = ProcessPoolExecutor(self.workers) if self.workers else None
+    run_batches = pool.map if pool is not None else map
+    start = time.perf_counter()
+    try:
+      with tqdm(desc=self.desc, initial=initial, total=initial + len(samples)) as bar:
+        for offset in range(0, len(samples), self.chunk_size):
+          chunk = samples[offset:offset + self.chunk_size]
+          batches = self._batches(chunk)
+          outputs = run_batches(self.predict_batch, [[chunk[i] for i in batch] for batch in batches])
+
+          # Put the predictions back in the order of the samples
+          chunk_preds: List[Any] = [None] * len(chunk)
+          for batch, batch_preds in zip(batches, outputs):
+            for idx, pred in zip(batch, batch_preds):
+              chunk_preds[idx] = pred
+
+          predictions.extend(chunk_preds)
+          if on_chunk is not None:
+            on_chunk(chunk, chunk_preds)
+          bar.update(len(chunk))
+    finally:
+      if pool is not None:
+        pool.shutdown()
+
+    elapsed = time.perf_counter() - start
+    self.samples_per_sec = len(samples) / max(elapsed, 1e-9)
+    print(f"{self.desc}: {len(samples)} samples in {elapsed:.1f}s ({self.samples_per_sec:.2f} samples/sec)")
+    return predictions
+
+
+class EvalCheckpoint:
+  """Append-only jsonl file with one record per evaluated sample, after a header with the run fingerprint."""
+
+  def __init__(self, filepath: str, fsync_every: int = CHECKPOINT_FSYNC_EVERY, fingerprint: str = "") -> None:
+    """Initialize checkpoint.
+    Args:
+      filepath (str): jsonl file.
+      fsync_every (int): records written between two fsync, lines are flushed anyway after every append.
+      fingerprint (str): hash of what determines the predictions, such as model, prompt and test set.
+    """
+    self.filepath = filepath
+    self.fsync_every = fsync_every
+    self.fingerprint = fingerprint
+    self._file = None
+    self._unsynced = 0
+
+  def is_stale(self) -> bool:
+    """Check if the saved records come from a run with another fingerprint.
+    Returns:
+      bool: true if the header is missing or different.
+    """
+    with open(self.filepath, "rb") as f:
+      header = f.readline()
+    try:
+      return json.loads(header)["fingerprint"] != self.fingerprint
+    except Exception:
+      return True
+
+  def records(self) -> Iterator[dict]:
+    """Stream the saved records, dropping a last line left half written by a crash.
+    Returns:
+      Iterator[dict]: records in the order they were saved, without the header.
+    """
+    valid_end = 0
+    with open(self.filepath, "rb") as f:
+      for line_idx, line in enumerate(f):
+        if not line.endswith(b"\n"):
+          break
+        try:
+          record = json.loads(line)
+        except json.JSONDecodeError:
+          break
+        valid_end += len(line)
+        if line_idx > 0:
+          yield record
+      truncated = f.tell() != valid_end or f.read(1) != b""
+
+    # New records must start on a clean line
+    if truncated:
+      print(f"Dropping a damaged record at the end of {self.filepath}.")
+      with open(self.filepath, "r+b") as f:
+        f.truncate(valid_end)
+
+  def reset(self) -> None:
+    """Start the checkpoint from scratch."""
+    self.close()
+    if os.path.exists(self.filepath):
+      os.remove(self.filepath)
+
+  def append(self, records: List[dict]) -> None:
+    """Write records at the end of the file.
+    Args:
+      records (List[dict]): records to save.
+    """
+    if self._file is None:
+      os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+      self._file = open(self.filepath, "a", encoding="utf-8")
+      if self._file.tell() == 0:
+        self._file.write(json.dumps({"fingerprint": self.fingerprint}) + "\n")
+    for record in records:
+      self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+    self._file.flush()
+
+    self._unsynced += len(records)
+    if self._unsynced >= self.fsync_every:
+      self.sync()
+
+  def sync(self) -> None:
+    """Make sure the written records reach the disk."""
+    if self._file is not None and self._unsynced > 0:
+      os.fsync(self._file.fileno())
+      self._unsynced = 0
+
+  def close(self) -> None:
+    """Sync and close the file."""
+    if self._file is not None:
+      self.sync()
+      self._file.close()
+      self._file = None
+
 
 class Evaluator:
   def __init__(
     self,
     component: Any,
     filepath: str,
-    prompt: dict
+    prompt: dict,
+    batch_size: int = EVAL_BATCH_SIZE,
+    fsync_every: int = CHECKPOINT_FSYNC_EVERY,
+    run_name: Optional[str] = None
     ):
     """Initialize evaluator.
     Args:
       nlu (Any): component to evaluate.
       filepath (str): test set filepath.
+      batch_size (int): number of samples passed to the component at once.
+      fsync_every (int): checkpoint records written between two fsync.
+      run_name (Optional[str]): suffix of the state and results files, so runs of different models don't overwrite each other.
     """
     # Init compoenent to eval
     self.component = component
     self.prompt = prompt
+    self.batch_size = batch_size
+    self.fsync_every = fsync_every
+    self.run_name = run_name
+    # Opened by resume_eval_state
+    self.checkpoint: Optional[EvalCheckpoint] = None
+    # Throughput of the last run, None when everything was resumed
+    self.samples_per_sec: Optional[float] = None
+    # Usage of every sample, such as latency and token counts
+    self.sample_info: List[Optional[dict]] = []
 
     # Load test set
     self.test_set = self.load_test_set(filepath)
 
+  def run_path(self, filepath: str) -> str:
+    """Add the run name to a state or results file.
+    Args:
+      filepath (str): default path of the file.
+    Returns:
+      str: path of the file for this run.
+    """
+    if not self.run_name:
+      return filepath
+    root, ext = os.path.splitext(filepath)
+    return f"{root}_{self.run_name}{ext}"
+
+  def run_samples(
+    self,
+    samples: List[dict],
+    predict_batch: Callable[[List[dict]], List[Any]],
+    on_chunk: Callable[[List[dict], List[Any]], None],
+    desc: str,
+    initial: int = 0,
+    group_key: Optional[Callable[[dict], Hashable]] = None,
+    workers: Optional[int] = None
+    ) -> List[Any]:
+    """Predict the samples in batches with a BatchRunner, recording its throughput.
+    Args:
+      samples (List[dict]): samples to predict.
+      predict_batch (Callable[[List[dict]], List[Any]]): predictions for a list of samples.
+      on_chunk (Callable[[List[dict], List[Any]], None]): called with every chunk of predictions, to save them.
+      desc (str): description of the progress bar.
+      initial (int): samples already done in a previous run.
+      group_key (Optional[Callable[[dict], Hashable]]): samples of a batch share this key.
+      workers (Optional[int]): number of processes, for components that don't use the llm.
+    Returns:
+      List[Any]: predictions in the same order of the samples.
+    """
+    runner = BatchRunner(predict_batch, self.batch_size, group_key=group_key, workers=workers, desc=desc)
+    predictions = runner.run(samples, on_chunk, initial)
+    self.samples_per_sec = runner.samples_per_sec
+
+    response_cache = getattr(getattr(self.component, "llm", None), "response_cache", None)
+    if response_cache is not None:
+      stats = response_cache.stats
+      print(f"Response cache: {stats['hits']} hits, {stats['misses']} misses ({response_cache.hit_rate():.1%} hit rate)")
+    return predictions
+
+  def predict_test_set(
+    self,
+    state_path: str,
+    export_path: str,
+    predict_batch: Callable[[List[dict]], List[Tuple[Any, dict]]],
+    desc: str,
+    group_key: Optional[Callable[[dict], Hashable]] = None,
+    workers: Optional[int] = None
+    ) -> Tuple[list, list]:
+    """Predict the samples missing from the checkpoint, saving every chunk with the usage of its samples.
+    Args:
+      state_path (str): jsonl checkpoint.
+      export_path (str): json export of the whole state.
+      predict_batch (Callable[[List[dict]], List[Tuple[Any, dict]]]): prediction and usage of every sample of a batch.
+      desc (str): description of the progress bar.
+      group_key (Optional[Callable[[dict], Hashable]]): samples of a batch share this key.
+      workers (Optional[int]): number of processes, for components that don't use the llm.
+    Returns:
+      Tuple[list, list]: predictions and ground truths of the whole test set.
+    """
+    start_idx, pred_states, gt_states, self.sample_info = self.resume_eval_state(state_path, with_extras=True)
+    # Check if eval is already done
+    if start_idx >= len(self.test_set):
+      return pred_states, gt_states
+
+    def save_chunk(samples: List[dict], results: List[Tuple[Any, dict]]) -> None:
+      preds = [pred for pred, _ in results]
+      infos = [info for _, info in results]
+      gts = [sample["annotation"] for sample in samples]
+      pred_states.extend(preds)
+      gt_states.extend(gts)
+      self.sample_info.extend(infos)
+      self.save_eval_state(preds, gts, infos)
+
+    self.run_samples(self.test_set[start_idx:], predict_batch, save_chunk, desc, start_idx, group_key, workers)
+    self.export_eval_state(pred_states, gt_states, export_path, self.sample_info)
+
+    return pred_states, gt_states
+
+  def cost_class(self, sample: dict) -> str:
+    """Get the class of a sample in the cost report, such as its intent.
+    Args:
+      sample (dict): test sample.
+    Returns:
+      str: class name.
+    """
+    return "all"
+
+  @staticmethod
+  def _cost_stats(infos: List[dict]) -> Dict[str, Any]:
+    """Summarize the usage of some samples.
+    Args:
+      infos (List[dict]): usage of the samples.
+    Returns:
+      Dict[str, Any]: token counts, decoding speed and latency percentiles.
+    """
+    latencies = np.array([info["latency"] for info in infos]) * 1000
+    prompt_tokens = sum(info["prompt_tokens"] for info in infos)
+    generated_tokens = sum(info["generated_tokens"] for info in infos)
+    total_latency = latencies.sum() / 1000
+    return {
+      "count": len(infos),
+      "prompt_tokens": prompt_tokens,
+      "generated_tokens": generated_tokens,
+      "mean_prompt_tokens": prompt_tokens / len(infos),
+      "mean_generated_tokens": generated_tokens / len(infos),
+      # Generated tokens over the time samples waited for them
+      "tokens_per_sec": generated_tokens / total_latency if total_latency > 0 else 0.0,
+      "latency_ms": {
+        "mean": float(latencies.mean()),
+        "p50": float(np.percentile(latencies, 50)),
+        "p95": float(np.percentile(latencies, 95)),
+        "p99": float(np.percentile(latencies, 99))
+      }
+    }
+
+  def evaluate_cost(self) -> Dict[str, Any]:
+    """Report latency and token usage of the samples, overall and by class.
+    Returns:
+      Dict[str, Any]: cost report, samples answered by the response cache are only counted.
+    """
+    measured = defaultdict(list)
+    cached = 0
+    for sample, info in zip(self.test_set, self.sample_info):
+      # Samples of older runs have no usage
+      if not info or "prompt_tokens" not in info:
+        continue
+      if info.get("cached"):
+        cached += 1
+        continue
+      measured[self.cost_class(sample)].append(info)
+
+    infos = [info for class_infos in measured.values() for info in class_infos]
+    if not infos:
+      return {"count": 0, "cached": cached}
+    report = self._cost_stats(infos)
+    report["cached"] = cached
+    report["by_class"] = {name: self._cost_stats(class_infos) for name, class_infos in sorted(measured.items())}
+    return report
+
   def load_test_set(self, filepath: str) -> dict:
     """Load a new test set.
     Args:
@@ -39,21 +396,66 @@ class Evaluator:
       filepath (str): str containing file where to dump results
     """
     try:
+      os.makedirs(os.path.dirname(filepath), exist_ok=True)
       with open(filepath, 'w', encoding='utf-8') as f:
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
         json.dump(metrics, f, indent=2, ensure_ascii=False)
       print(f"Results saved cleanly to {filepath}")
     except Exception as e:
       print(f"Error saving results: {e}")
   
-  def save_eval_state(self, preds: list, gts: list, filepath: str) -> None:
-    """Save the current evaluation state to save time.
+  def fingerprint_fields(self) -> Dict[str, Any]:
+    """Get what determines the predictions of the run.
+    Returns:
+      Dict[str, Any]: json serializable fields.
+    """
+    llm = getattr(self.component, "llm", None)
+    return {
+      "component": type(self.component).__name__,
+      "model": getattr(llm, "model_id", type(llm).__name__),
+      "model_variant": getattr(llm, "model_variant", None),
+      "prompt": self.prompt,
+      "test_set": self.test_set
+    }
+
+  def state_fingerprint(self) -> str:
+    """Hash the fields of the run, so checkpoints of other runs are not resumed.
+    Returns:
+      str: sha256 hex digest.
+    """
+    payload = json.dumps(self.fingerprint_fields(), sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+  def save_eval_state(self, preds: list, gts: list, extras: Optional[list] = None) -> None:
+    """Append newly evaluated samples to the checkpoint opened by resume_eval_state.
     Args:
       preds (list): new model predictions.
       gts (list): associated gts.
+      extras (Optional[list]): additional info of every sample, such as latency.
+    """
+    if extras is None:
+      extras = [None] * len(preds)
+    try:
+      self.checkpoint.append([
+        {"pred": p, "gt": g, "extra": e} if e is not None else {"pred": p, "gt": g}
+        for p, g, e in zip(preds, gts, extras)
+      ])
+    except Exception as e:
+      print(f"Warning: Failed to save eval state: {e}")
+
+  def export_eval_state(self, preds: list, gts: list, filepath: str, extras: Optional[list] = None) -> None:
+    """Flush the checkpoint and write the whole state as a single json file, to inspect it.
+    Args:
+      preds (list): all model predictions.
+      gts (list): associated gts.
       filepath (str): filepath where to dump data.
+      extras (Optional[list]): additional info of every sample, such as latency.
     """
+    if self.checkpoint is not None:
+      self.checkpoint.close()
     data = [{"id": idx, "pred": p, "gt": g} for idx, (p,g) in enumerate(zip(preds, gts))]
+    if extras is not None:
+      for item, extra in zip(data, extras):
+        item["extra"] = extra
     try:
       os.makedirs(os.path.dirname(filepath), exist_ok=True)
       with open(filepath, 'w', encoding='utf-8') as f:
@@ -61,33 +463,37 @@ class Evaluator:
     except Exception as e:
       print(f"Warning: Failed to save visualization file: {e}")
   
-  def resume_eval_state(self, filepath: str) -> tuple:
-    """Resume previous evaluation state.
+  def resume_eval_state(self, filepath: str, with_extras: bool = False) -> tuple:
+    """Resume previous evaluation state, and open the checkpoint new samples are appended to.
     Args:
-      filepath (str): filepath of old eval_state if present.
+      filepath (str): filepath of the jsonl checkpoint, created if missing.
+      with_extras (bool): also return the additional info of every sample.
     Returns:
-      tuple: contains starting sample idx, existing pred and existing gts
+      tuple: contains starting sample idx, existing pred and existing gts, and extras if requested
     """
-    start_idx = 0
     preds = []
     gts = []
+    extras = []
+    self.checkpoint = EvalCheckpoint(filepath, self.fsync_every, self.state_fingerprint())
+    # Predictions of another model, prompt or test set can't be reused
+    if os.path.exists(filepath) and self.checkpoint.is_stale():
+      print(f"Existing file at {filepath} comes from a different model, prompt or test set. Starting from scratch.")
+      self.checkpoint.reset()
     if os.path.exists(filepath):
+      print(f"Found existing file at {filepath}. Attempting to resume...")
       try:
-        print(f"Found existing file at {filepath}. Attempting to resume...")
-        with open(filepath, 'r', encoding='utf-8') as f:
-          data = json.load(f)   
-          if isinstance(data, list) and len(data) > 0:
-            for item in data:
-              preds.append(item.get("pred"))
-              gts.append(item.get("gt"))
-            start_idx = len(preds)
-            print(f"Successfully resumed. Skipping first {start_idx} samples.")
+        for item in self.checkpoint.records():
+          preds.append(item.get("pred"))
+          gts.append(item.get("gt"))
+          extras.append(item.get("extra"))
+        if preds:
+          print(f"Successfully resumed. Skipping first {len(preds)} samples.")
       except Exception as e:
         print(f"Warning: Could not load existing progress ({e}). Starting from scratch.")
-        
-    return start_idx, preds, gts
-
-
-  
-  
+        self.checkpoint.reset()
+        preds, gts, extras = [], [], []
+    start_idx = len(preds)
 
+    if with_extras:
+      return start_idx, preds, gts, extras
+    return start_idx, preds, gts
@@ -1,7 +1,7 @@
-from eval.evaluator import Evaluator
-from tqdm import tqdm
+from eval.evaluator import Evaluator, EVAL_BATCH_SIZE, CHECKPOINT_FSYNC_EVERY
 import json
 from collections import Counter
+from typing import List, Optional, Tuple
 import numpy as np
 import sacrebleu
 
@@ -10,17 +10,21 @@ import os
 
 EVAL_DIR = os.path.dirname(os.path.abspath(__file__))
 RESULTS_PATH = os.path.join(EVAL_DIR, "results", "nlg_results.json")
-STATE_PATH = os.path.join(EVAL_DIR, "temp", "nlg_state.json")
+STATE_PATH = os.path.join(EVAL_DIR, "temp", "nlg_state.jsonl")
+EXPORT_PATH = os.path.join(EVAL_DIR, "temp", "nlg_state.json")
 
 class NLG_Evaluator(Evaluator):
-  def __init__(self, nlg: NLG, filepath: str, prompt: dict) -> None:
+  def __init__(self, nlg: NLG, filepath: str, prompt: dict, batch_size: int = EVAL_BATCH_SIZE, fsync_every: int = CHECKPOINT_FSYNC_EVERY, run_name: Optional[str] = None) -> None:
     """Initialize NLG Evaluator.
     Args:
       nlg (LLMTast): model for the nlg task.
       filepath (str): path of the dataset.
       prompt (dict): dict containing prompts for intent.  
+      batch_size (int): number of samples passed to the component at once.
+      fsync_every (int): checkpoint records written between two fsync.
+      run_name (Optional[str]): suffix of the state and results files.
     """
-    super().__init__(nlg, filepath, prompt)
+    super().__init__(nlg, filepath, prompt, batch_size, fsync_every, run_name)
     self.pred_states, self.gt_states = self.get_pred_gt()
 
   def get_pred_gt(self) -> tuple:
@@ -28,28 +32,28 @@ class NLG_Evaluator(Evaluator):
     Returns:
       tuple: predicitons and ground truths.
     """
-    # Resume state from file
-    start_idx, pred_states, gt_states = self.resume_eval_state(STATE_PATH)
-    # Check if eval is already done
-    if start_idx >= len(self.test_set):
-      return pred_states, gt_states
-
-    remaining_samples = self.test_set[start_idx:]
-
-    for sample in tqdm(remaining_samples, desc="Evaluating NLG", initial=start_idx, total=len(self.test_set)):
-      intent = sample["intent"]
-      pred = self.component.eval_generate(intent, json.dumps(sample["input"]))
-      pred_states.append(pred)
-      gt_states.append(sample["annotation"])
-
-      # Save state every k samples
-      if len(pred_states) % 10 == 0:
-        self.save_eval_state(pred_states, gt_states, STATE_PATH)
-    
-    # Save last batch of samples
-    self.save_eval_state(pred_states, gt_states, STATE_PATH)
+    return self.predict_test_set(
+      self.run_path(STATE_PATH),
+      self.run_path(EXPORT_PATH),
+      self.predict_batch,
+      "Evaluating NLG",
+      group_key=lambda sample: sample["intent"]
+    )
+
+  def predict_batch(self, samples: List[dict]) -> List[Tuple[str, dict]]:
+    """Get the responses of a batch of samples with the same intent.
+    Args:
+      samples (List[dict]): test samples.
+    Returns:
+      List[Tuple[str, dict]]: generated response and usage of every sample.
+    """
+    intent = samples[0]["intent"]
+    preds = self.component.eval_generate_batch(intent, [json.dumps(sample["input"]) for sample in samples])
+    return list(zip(preds, self.component.last_usage))
 
-    return pred_states, gt_states
+  def cost_class(self, sample: dict) -> str:
+    """Samples are grouped by intent."""
+    return sample["intent"]
 
 
   def _compute_f1(self, pred: str, refs: list) -> float:
@@ -119,8 +123,11 @@ class NLG_Evaluator(Evaluator):
       "bleu": bleu_score,
       "f1": float(avg_f1),
     }
+    metrics["cost"] = self.evaluate_cost()
+    if self.samples_per_sec is not None:
+      metrics["samples_per_sec"] = self.samples_per_sec
 
-    self.save_results(metrics, RESULTS_PATH)
+    self.save_results(metrics, self.run_path(RESULTS_PATH))
 
 
     return metrics
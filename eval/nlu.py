@@ -1,30 +1,36 @@
-from typing import Any, Dict, Tuple, List
+from typing import Any, Dict, Optional, Tuple, List
 import json
 from collections import defaultdict
-from eval.evaluator import Evaluator
+from eval.evaluator import Evaluator, EVAL_BATCH_SIZE, CHECKPOINT_FSYNC_EVERY
 from agent.nlu import NLU
-from tqdm import tqdm
 import os
 import re
 
 EVAL_DIR = os.path.dirname(os.path.abspath(__file__))
 RESULTS_PATH = os.path.join(EVAL_DIR, "results", "nlu_results.json")
-STATE_PATH = os.path.join(EVAL_DIR, "temp", "nlu_state.json")
+STATE_PATH = os.path.join(EVAL_DIR, "temp", "nlu_state.jsonl")
+EXPORT_PATH = os.path.join(EVAL_DIR, "temp", "nlu_state.json")
 
 class NLU_Evaluator(Evaluator):
   def __init__(
     self,
     nlu: NLU,
     filepath: str,
-    prompt: dict
+    prompt: dict,
+    batch_size: int = EVAL_BATCH_SIZE,
+    fsync_every: int = CHECKPOINT_FSYNC_EVERY,
+    run_name: Optional[str] = None
     ):
     """Initialize evaluator.
     Args:
       nlu (LLMTask): component to evaluate.
       filepath (str): test set filepath.
       prompt (dict): prompt for the task.
+      batch_size (int): number of samples passed to the component at once.
+      fsync_every (int): checkpoint records written between two fsync.
+      run_name (Optional[str]): suffix of the state and results files.
     """
-    super().__init__(nlu, filepath, prompt)
+    super().__init__(nlu, filepath, prompt, batch_size, fsync_every, run_name)
 
     # Get predictions
     pred_states, gt_states = self.get_pred_gt()
@@ -37,16 +43,25 @@ class NLU_Evaluator(Evaluator):
     Returns:
       tuple: predicitons and ground truths.
     """
-    # Resume state from file
-    start_idx, pred_states, gt_states = self.resume_eval_state(STATE_PATH)
-    # Check if eval is already done
-    if start_idx >= len(self.test_set):
-      return pred_states, gt_states
-    
-    remaining_samples = self.test_set[start_idx:]
+    return self.predict_test_set(self.run_path(STATE_PATH), self.run_path(EXPORT_PATH), self.predict_batch, "Evaluating NLU")
+
+  def fingerprint_fields(self) -> Dict[str, Any]:
+    """Get what determines the predictions of the run, the rules included."""
+    fields = super().fingerprint_fields()
+    fields["rule_nlu"] = self.component.rule_nlu is not None
+    return fields
 
-    for sample in tqdm(remaining_samples, desc="Evaluating NLU", initial=start_idx, total=len(self.test_set)):
-      pred = self.component.generate(sample["utterance"], validate = False)
+  def predict_batch(self, samples: List[dict]) -> List[Tuple[dict, dict]]:
+    """Parse a batch of samples.
+    Args:
+      samples (List[dict]): test samples.
+    Returns:
+      List[Tuple[dict, dict]]: prediction of every sample, with its path and usage.
+    """
+    raw_preds = self.component.generate_batch([sample["utterance"] for sample in samples], validate=False)
+
+    results = []
+    for pred, path, usage in zip(raw_preds, self.component.last_paths, self.component.last_usage):
       try:
         pred = json.loads(pred)
       except Exception:
@@ -56,18 +71,13 @@ class NLU_Evaluator(Evaluator):
         if match:
           pred = json.loads(match.group(1))
         else: pred = {"intent": "invalid_format", "slots": {}}
-        
-      pred_states.append(pred)
-      gt_states.append(sample["annotation"])
-
-      # Save state every k samples
-      if len(pred_states) % 1 == 0:
-        self.save_eval_state(pred_states, gt_states, STATE_PATH)
-    
-    # Save last batch of samples
-    self.save_eval_state(pred_states, gt_states, STATE_PATH)
+      # Path answering the sample, rule or llm, and its usage
+      results.append((pred, dict(usage, path=path)))
+    return results
 
-    return pred_states, gt_states
+  def cost_class(self, sample: dict) -> str:
+    """Samples are grouped by their intent."""
+    return sample["annotation"].get("intent", "UNKNOWN")
 
 
   @staticmethod
@@ -115,6 +125,32 @@ class NLU_Evaluator(Evaluator):
     }
 
     
+  def evaluate_paths(self) -> Dict[str, Any]:
+    """Compare the samples answered by the rules with those answered by the llm.
+    Returns:
+      Dict[str, Any]: share of samples, intent accuracy and latency of every path.
+    """
+    by_path = defaultdict(lambda: {"count": 0, "correct": 0, "latency": 0.0})
+    for pred, gt, info in zip(self.pred_states, self.gt_states, self.sample_info):
+      # Samples of older runs don't know their path
+      if not info:
+        continue
+      stats = by_path[info["path"]]
+      stats["count"] += 1
+      stats["correct"] += int(pred.get("intent") == gt.get("intent"))
+      stats["latency"] += info["latency"]
+
+    total = sum(stats["count"] for stats in by_path.values())
+    return {
+      path: {
+        "share": stats["count"] / total,
+        "count": stats["count"],
+        "intent_accuracy": stats["correct"] / stats["count"],
+        "mean_latency_ms": 1000 * stats["latency"] / stats["count"]
+      }
+      for path, stats in by_path.items()
+    }
+
   def evaluate(self) -> Dict[str, Any]:
     """
     Evaluate NLU predictions against ground-truth dialogue states.
@@ -201,10 +237,14 @@ class NLU_Evaluator(Evaluator):
       "intent_accuracy": intent_correct / len(self.gt_states),
       "intents_by_type": intents_by_type,
       "slots_overall": slots_overall,
-      "slots_by_type": slots_by_type
+      "slots_by_type": slots_by_type,
+      "paths": self.evaluate_paths()
     }
+    metrics["cost"] = self.evaluate_cost()
+    if self.samples_per_sec is not None:
+      metrics["samples_per_sec"] = self.samples_per_sec
 
     # Save to file
-    self.save_results(metrics, RESULTS_PATH)
+    self.save_results(metrics, self.run_path(RESULTS_PATH))
 
     return metrics
\ No newline at end of file
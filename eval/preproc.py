@@ -1,29 +1,32 @@
-from eval.evaluator import Evaluator
-from tqdm import tqdm
+from eval.evaluator import Evaluator, EVAL_BATCH_SIZE, CHECKPOINT_FSYNC_EVERY
 import json
 from collections import Counter
 import numpy as np
 import sacrebleu
-from typing import Any
+from typing import Any, List, Optional, Tuple
 import re
 
-from agent.preproc import Preproc
+from agent.preproc import Preproc, is_single_intent
 import os
 
 EVAL_DIR = os.path.dirname(os.path.abspath(__file__))
 RESULTS_PATH = os.path.join(EVAL_DIR, "results", "preproc_results.json")
-STATE_PATH = os.path.join(EVAL_DIR, "temp", "preproc_state.json")
+STATE_PATH = os.path.join(EVAL_DIR, "temp", "preproc_state.jsonl")
+EXPORT_PATH = os.path.join(EVAL_DIR, "temp", "preproc_state.json")
 
 
 class PreprocEvaluator(Evaluator):
-  def __init__(self, preproc: Preproc, filepath: str, prompt: dict) -> None:
+  def __init__(self, preproc: Preproc, filepath: str, prompt: dict, batch_size: int = EVAL_BATCH_SIZE, fsync_every: int = CHECKPOINT_FSYNC_EVERY, run_name: Optional[str] = None) -> None:
     """Initialize the Preproc evaluator.
     Args:
       preproc (Preproc): model for preproc task.
       filepath (str): path of the dataset.
       prompt (dict): dict containing prompts for intent.
+      batch_size (int): number of samples passed to the component at once.
+      fsync_every (int): checkpoint records written between two fsync.
+      run_name (Optional[str]): suffix of the state and results files.
     """
-    super().__init__(preproc, filepath, prompt)
+    super().__init__(preproc, filepath, prompt, batch_size, fsync_every, run_name)
     self.pred_states, self.gt_states = self.get_pred_gt()
 
 
@@ -32,16 +35,24 @@ class PreprocEvaluator(Evaluator):
     Returns:
       tuple: predicitons and ground truths.
     """
-    # Resume state from file
-    start_idx, pred_states, gt_states = self.resume_eval_state(STATE_PATH)
-    # Check if eval is already done
-    if start_idx >= len(self.test_set):
-      return pred_states, gt_states
+    return self.predict_test_set(self.run_path(STATE_PATH), self.run_path(EXPORT_PATH), self.predict_batch, "Evaluating Preproc")
 
-    remaining_samples = self.test_set[start_idx:]
+  def fingerprint_fields(self) -> dict:
+    """Get what determines the predictions of the run, the fast path included."""
+    fields = super().fingerprint_fields()
+    fields["fast_path"] = self.component.fast_path
+    return fields
 
-    for sample in tqdm(remaining_samples, desc="Evaluating Preproc", initial=start_idx, total=len(self.test_set)):
-      pred = self.component.generate(sample["utterance"], validate=False)
+  def predict_batch(self, samples: List[dict]) -> List[Tuple[Any, dict]]:
+    """Split a batch of samples.
+    Args:
+      samples (List[dict]): test samples.
+    Returns:
+      List[Tuple[Any, dict]]: parsed preproc output and usage of every sample.
+    """
+    raw_preds = self.component.generate_batch([sample["utterance"] for sample in samples], validate=False)
+    preds = []
+    for pred in raw_preds:
       try:
         pred = json.loads(pred)
       except Exception:
@@ -51,19 +62,12 @@ class PreprocEvaluator(Evaluator):
         if match:
           pred = json.loads(match.group(1))
         else: pred = []
+      preds.append(pred)
+    return list(zip(preds, self.component.last_usage))
 
-
-      pred_states.append(pred)
-      gt_states.append(sample["annotation"])
-
-      # Save state every k samples
-      if len(pred_states) % 1 == 0:
-        self.save_eval_state(pred_states, gt_states, STATE_PATH)
-    
-    # Save last batch of samples
-    self.save_eval_state(pred_states, gt_states, STATE_PATH)
-
-    return pred_states, gt_states
+  def cost_class(self, sample: dict) -> str:
+    """Samples are grouped by the number of requests they hold."""
+    return f"{len(sample['annotation'])} requests"
   
 
   def normalize_to_string(self, x):
@@ -150,10 +154,19 @@ class PreprocEvaluator(Evaluator):
     avg_f1 = np.mean([s["f1"] for s in sample_scores])
     avg_bleu = np.mean([s["bleu"] for s in sample_scores])
 
+    # How often the heuristic skips the llm, and how often it is right to
+    bypassed = [is_single_intent(sample["utterance"]) for sample in self.test_set[:len(self.gt_states)]]
+    correct = [len(gt) == 1 for gt, b in zip(self.gt_states, bypassed) if b]
+
     metrics = {
       "f1": float(avg_f1),
-      "bleu": float(avg_bleu)
+      "bleu": float(avg_bleu),
+      "bypass_rate": float(np.mean(bypassed)),
+      "bypass_precision": float(np.mean(correct)) if correct else 0.0
     }
+    metrics["cost"] = self.evaluate_cost()
+    if self.samples_per_sec is not None:
+      metrics["samples_per_sec"] = self.samples_per_sec
 
-    self.save_results(metrics, RESULTS_PATH)
+    self.save_results(metrics, self.run_path(RESULTS_PATH))
     return metrics
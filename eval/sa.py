@@ -1,26 +1,29 @@
-from eval.evaluator import Evaluator
-from tqdm import tqdm
+from eval.evaluator import Evaluator, EVAL_BATCH_SIZE, CHECKPOINT_FSYNC_EVERY
 import json
 from collections import Counter, defaultdict
 import numpy as np
-from typing import Any
+from typing import Any, Dict, List, Optional, Tuple
 
 from agent.sa import SA
 import os
 
 EVAL_DIR = os.path.dirname(os.path.abspath(__file__))
 RESULTS_PATH = os.path.join(EVAL_DIR, "results", "sa_results.json")
-STATE_PATH = os.path.join(EVAL_DIR, "temp", "sa_state.json")
+STATE_PATH = os.path.join(EVAL_DIR, "temp", "sa_state.jsonl")
+EXPORT_PATH = os.path.join(EVAL_DIR, "temp", "sa_state.json")
 
 class SA_Evaluator(Evaluator):
-  def __init__(self, sa: SA, filepath: str, prompt: dict):
+  def __init__(self, sa: SA, filepath: str, prompt: dict, batch_size: int = EVAL_BATCH_SIZE, fsync_every: int = CHECKPOINT_FSYNC_EVERY, run_name: Optional[str] = None):
     """Initialize the SA evaluator.
     Args:
       sa (SA): model for sentiment analysis task.
       filepath (str): path of the dataset.
       prompt (dict): dict containing prompts for intent.
+      batch_size (int): number of samples passed to the component at once.
+      fsync_every (int): checkpoint records written between two fsync.
+      run_name (Optional[str]): suffix of the state and results files.
     """
-    super().__init__(sa, filepath, prompt)
+    super().__init__(sa, filepath, prompt, batch_size, fsync_every, run_name)
     self.pred_states, self.gt_states = self.get_pred_gt()
 
   def get_pred_gt(self) -> tuple:
@@ -28,27 +31,32 @@ class SA_Evaluator(Evaluator):
     Returns:
       tuple: predicitons and ground truths.
     """
-    # Resume state from file
-    start_idx, pred_states, gt_states = self.resume_eval_state(STATE_PATH)
-    # Check if eval is already done
-    if start_idx >= len(self.test_set):
-      return pred_states, gt_states
+    return self.predict_test_set(self.run_path(STATE_PATH), self.run_path(EXPORT_PATH), self.predict_batch, "Evaluating SA")
 
-    remaining_samples = self.test_set[start_idx:]
-
-    for sample in tqdm(remaining_samples, desc="Evaluating SA", initial=start_idx, total=len(self.test_set)):
-      pred = self.component.generate(sample["review"], validate=False)
-      pred_states.append(pred)
-      gt_states.append(sample["annotation"])
-
-      # Save state every k samples
-      if len(pred_states) % 1 == 0:
-        self.save_eval_state(pred_states, gt_states, STATE_PATH)
-    
-    # Save last batch of samples
-    self.save_eval_state(pred_states, gt_states, STATE_PATH)
-
-    return pred_states, gt_states
+  def predict_batch(self, samples: List[dict]) -> List[Tuple[str, dict]]:
+    """Get the sentiment of a batch of samples.
+    Args:
+      samples (List[dict]): test samples.
+    Returns:
+      List[Tuple[str, dict]]: label or raw sa output and usage of every sample.
+    """
+    reviews = [sample["review"] for sample in samples]
+    # Evaluate the mode the component runs with
+    if self.component.scoring:
+      preds = [result["label"] for result in self.component.classify(reviews)]
+    else:
+      preds = self.component.generate_batch(reviews, validate=False)
+    return list(zip(preds, self.component.last_usage))
+
+  def fingerprint_fields(self) -> Dict[str, Any]:
+    """Get what determines the predictions of the run, scored and generated labels are kept apart."""
+    fields = super().fingerprint_fields()
+    fields["scoring"] = self.component.scoring
+    return fields
+
+  def cost_class(self, sample: dict) -> str:
+    """Samples are grouped by their sentiment."""
+    return str(sample["annotation"])
   
   @staticmethod
   def _sentiment_is_equal(pred: str, gt: str) -> bool:
@@ -93,6 +101,9 @@ class SA_Evaluator(Evaluator):
       "total_accuracy": total_accuracy,
       "class_accuracy": class_accuracy,
     }
+    metrics["cost"] = self.evaluate_cost()
+    if self.samples_per_sec is not None:
+      metrics["samples_per_sec"] = self.samples_per_sec
 
-    self.save_results(metrics, RESULTS_PATH)
+    self.save_results(metrics, self.run_path(RESULTS_PATH))
     return metrics
@@ -1,5 +1,7 @@
 import os
 from models.model import LLMTask, ModelLoader
+from models.cache import ResponseCache, PREFIX_CACHE
+from models.pool import MODEL_POOL
 from models.registry import MODELS
 from argparse import ArgumentParser, Namespace
 import torch
@@ -9,11 +11,17 @@ from eval.dm import DM_Evaluator
 from eval.nlg import NLG_Evaluator
 from eval.preproc import PreprocEvaluator
 from eval.sa import SA_Evaluator
-from typing import Any
+from eval.evaluator import EVAL_BATCH_SIZE, CHECKPOINT_FSYNC_EVERY
+from typing import Any, Dict, List, Optional
+from functools import lru_cache
+import json
+import time
 from dotenv import load_dotenv
 from models.utils import login_to_hub
 from agent.preproc import Preproc
 from agent.nlu import NLU
+from agent.rule_nlu import RuleNLU
+from data.kb import KnowledgeBase
 from agent.dm import DM, RuleBasedDM
 from agent.nlg import NLG
 from agent.sa import SA
@@ -23,6 +31,19 @@ PROJ_DIR = os.path.dirname(os.path.abspath(__file__))
 TEST_DIR = os.path.join(PROJ_DIR, "eval", "test_set")
 
 PROMPT_DIR = os.path.join(PROJ_DIR, "prompt")
+RESPONSE_CACHE_PATH = os.path.join(PROJ_DIR, "eval", "temp", "response_cache.sqlite")
+SWEEP_RESULTS_PATH = os.path.join(PROJ_DIR, "eval", "results", "sweep_results.json")
+
+DEVICE = "auto"
+COMPONENTS = ["preproc", "nlu", "dm", "nlg", "sa"]
+# Quality metrics shown in the sweep table, nested keys are joined by dots
+HEADLINE_METRICS = {
+  "preproc": ["f1", "bleu"],
+  "nlu": ["intent_accuracy", "slots_overall.f1_score"],
+  "dm": ["total_accuracy"],
+  "nlg": ["bleu", "f1"],
+  "sa": ["total_accuracy"]
+}
 
 
 
@@ -46,6 +67,49 @@ def parse_args() -> Namespace:
     default="nlu",
     help="Component to evaluate.",
   )
+  parser.add_argument(
+    "--models",
+    type=str,
+    nargs="+",
+    choices=list(MODELS.keys()) + ["rule_based"],
+    help="Sweep mode, models to evaluate one after the other, each loaded once for all components.",
+  )
+  parser.add_argument(
+    "--components",
+    type=str,
+    nargs="+",
+    choices=COMPONENTS,
+    default=COMPONENTS,
+    help="Components evaluated by every model of the sweep.",
+  )
+  parser.add_argument(
+    "--rule-nlu",
+    action="store_true",
+    help="Try the rule based nlu before the llm, needs the knowledge base.",
+  )
+  parser.add_argument(
+    "-b", "--batch-size",
+    type=int,
+    default=EVAL_BATCH_SIZE,
+    help="Number of test samples passed to the component at once.",
+  )
+  parser.add_argument(
+    "--fsync-every",
+    type=int,
+    default=CHECKPOINT_FSYNC_EVERY,
+    help="Checkpoint records written between two fsync.",
+  )
+  parser.add_argument(
+    "--no-cache",
+    action="store_true",
+    help="Generate every response again instead of reusing the cached ones.",
+  )
+  parser.add_argument(
+    "--workers",
+    type=int,
+    default=None,
+    help="Processes running the rule based dm, only used with at least 50000 samples per process; inline by default.",
+  )
   return parser.parse_args()
 
 def get_evaluator(component: str) -> Any:
@@ -59,7 +123,12 @@ def get_evaluator(component: str) -> Any:
 
   return name_to_class[component]
 
-def get_component(model_name: str, component_name: str, prompt: dict) -> Any:
+@lru_cache(maxsize=None)
+def get_knowledge_base() -> KnowledgeBase:
+  """Load the knowledge base once, the runs of a sweep share it."""
+  return KnowledgeBase()
+
+def get_component(model_name: str, component_name: str, prompt: dict, rule_nlu: bool = False, model_loader: Optional[ModelLoader] = None) -> Any:
   # Get rule_based
   if model_name == "rule_based":
     if component_name != "dm":
@@ -67,15 +136,16 @@ def get_component(model_name: str, component_name: str, prompt: dict) -> Any:
     rule_dm = RuleBasedDM()
     return DM(rule_dm, prompt)
   else: # Initialize LLM
-    load_dotenv()
-    login_to_hub()
-    device = "auto"
-    
-    # Init component
-    model_loader = ModelLoader(model_name, device)
+    if model_loader is None:
+      load_dotenv()
+      login_to_hub()
+      model_loader = ModelLoader(model_name, DEVICE)
 
+    # Init component
     if component_name == "nlu":
-      return NLU(model_loader, prompt)
+      # Titles and terms of the rules come from the knowledge base
+      rules = RuleNLU.from_kb(get_knowledge_base()) if rule_nlu else None
+      return NLU(model_loader, prompt, rule_nlu=rules)
     elif component_name == "dm":
       return DM(model_loader, prompt)
     elif component_name == "nlg":
@@ -86,13 +156,25 @@ def get_component(model_name: str, component_name: str, prompt: dict) -> Any:
       return SA(model_loader, prompt)
   
   raise ValueError("Invalid configuration model={model_name}, component={component_name}")
-    
 
-def eval() -> None:
-  """Execute the agent."""
-  args = parse_args()
-  model_name = args.model
-  component_name = args.component
+
+def evaluate_component(
+    args: Namespace,
+    model_name: str,
+    component_name: str,
+    model_loader: Optional[ModelLoader] = None,
+    run_name: Optional[str] = None
+  ) -> Dict[str, Any]:
+  """Evaluate a component with a model.
+  Args:
+    args (Namespace): command line args.
+    model_name (str): name of the model.
+    component_name (str): name of the component.
+    model_loader (Optional[ModelLoader]): already loaded model, loaded here if None.
+    run_name (Optional[str]): suffix of the state and results files.
+  Returns:
+    Dict[str, Any]: metrics, with number of samples, wall time and throughput of the run.
+  """
   # Get test set path
   test_set_path = os.path.join(TEST_DIR, component_name + ".json")
   # Get prompt path
@@ -101,16 +183,139 @@ def eval() -> None:
   with open(prompt_path, "r", encoding="utf-8") as file:
     prompt = yaml.safe_load(file)
 
-  component = get_component(model_name, component_name, prompt)
+  start = time.perf_counter()
+  component = get_component(model_name, component_name, prompt, args.rule_nlu, model_loader)
+  # Responses of prompts unchanged since the last run are reused
+  if not args.no_cache and isinstance(getattr(component, "llm", None), LLMTask):
+    component.llm.response_cache = ResponseCache(RESPONSE_CACHE_PATH)
 
   # Get evaluator class based on which component to evaluate
   eval_class = get_evaluator(component_name)
-  evaluator = eval_class(component, test_set_path, prompt)
+  eval_kwargs = {"batch_size": args.batch_size, "fsync_every": args.fsync_every, "run_name": run_name}
+  if component_name == "dm":
+    eval_kwargs["workers"] = args.workers
+  evaluator = eval_class(component, test_set_path, prompt, **eval_kwargs)
 
   # Initialize and run evaluator
   results = evaluator.evaluate()
-  
-  print(results)
+  return {
+    "metrics": results,
+    "samples": len(evaluator.gt_states),
+    "eval_time_s": time.perf_counter() - start,
+    "samples_per_sec": evaluator.samples_per_sec
+  }
+
+
+def get_metric(metrics: dict, name: str) -> Any:
+  """Get a possibly nested metric.
+  Args:
+    metrics (dict): metrics of a run.
+    name (str): metric name, nested keys joined by dots.
+  Returns:
+    Any: metric value, None if missing.
+  """
+  value: Any = metrics
+  for key in name.split("."):
+    if not isinstance(value, dict):
+      return None
+    value = value.get(key)
+  return value
+
+
+def print_sweep_table(rows: List[Dict[str, Any]]) -> None:
+  """Print the sweep results, one row per model and component.
+  Args:
+    rows (List[Dict[str, Any]]): sweep rows.
+  """
+  def fmt(value: Any) -> str:
+    if value is None: return "-"
+    if isinstance(value, float): return f"{value:.3f}"
+    return str(value)
+
+  columns = [
+    "model", "component", "load_time_s", "eval_time_s", "samples", "samples_per_sec",
+    "mean_latency_ms", "p50_latency_ms", "p95_latency_ms", "tokens_per_sec", "metrics"
+  ]
+  lines = [columns]
+  for row in rows:
+    quality = ", ".join(f"{name}={fmt(value)}" for name, value in row["metrics"].items())
+    lines.append([fmt(row[col]) for col in columns[:-1]] + [quality])
+  widths = [max(len(line[i]) for line in lines) for i in range(len(columns))]
+  for line in lines:
+    print("  ".join(cell.ljust(width) for cell, width in zip(line, widths)).rstrip())
+
+
+def sweep(args: Namespace) -> List[Dict[str, Any]]:
+  """Evaluate every component with every model, loading each model once.
+  Args:
+    args (Namespace): command line args.
+  Returns:
+    List[Dict[str, Any]]: one row per model and component, also saved to SWEEP_RESULTS_PATH.
+  """
+  load_dotenv()
+  if any(model_name != "rule_based" for model_name in args.models):
+    login_to_hub()
+
+  rows = []
+  for model_name in args.models:
+    components = args.components
+    if model_name == "rule_based":
+      # Only the dm has a rule based version
+      components = [c for c in components if c == "dm"]
+    if not components:
+      print(f"Skipping {model_name}, no component to evaluate.")
+      continue
+
+    model_loader = None
+    load_time = 0.0
+    if model_name != "rule_based":
+      start = time.perf_counter()
+      model_loader = MODEL_POOL.acquire(model_name, DEVICE)
+      load_time = time.perf_counter() - start
+      print(f"Loaded {model_name} in {load_time:.1f}s")
+
+    try:
+      for component_name in components:
+        run = evaluate_component(args, model_name, component_name, model_loader, run_name=model_name)
+        rows.append({
+          "model": model_name,
+          "component": component_name,
+          "load_time_s": load_time,
+          "eval_time_s": run["eval_time_s"],
+          "samples": run["samples"],
+          "samples_per_sec": run["samples_per_sec"],
+          "mean_latency_ms": get_metric(run["metrics"], "cost.latency_ms.mean"),
+          "p50_latency_ms": get_metric(run["metrics"], "cost.latency_ms.p50"),
+          "p95_latency_ms": get_metric(run["metrics"], "cost.latency_ms.p95"),
+          "tokens_per_sec": get_metric(run["metrics"], "cost.tokens_per_sec"),
+          "metrics": {name: get_metric(run["metrics"], name) for name in HEADLINE_METRICS[component_name]}
+        })
+        # Save after every run so an interrupted sweep keeps what is done
+        os.makedirs(os.path.dirname(SWEEP_RESULTS_PATH), exist_ok=True)
+        with open(SWEEP_RESULTS_PATH, "w", encoding="utf-8") as f:
+          json.dump(rows, f, indent=2, ensure_ascii=False)
+    finally:
+      if model_loader is not None:
+        # Unload the model before the next one, with the key/values of its prompts
+        MODEL_POOL.release(model_loader)
+        model_loader = None
+        PREFIX_CACHE.clear()
+        MODEL_POOL.evict_unused()
+
+  print_sweep_table(rows)
+  print(f"Sweep results saved to {SWEEP_RESULTS_PATH}")
+  return rows
+
+
+def eval() -> None:
+  """Execute the agent."""
+  args = parse_args()
+  if args.models:
+    sweep(args)
+    return
+
+  run = evaluate_component(args, args.model, args.component)
+  print(run["metrics"])
 
 if __name__ == "__main__":
-  eval()
\ No newline at end of file
+  eval()
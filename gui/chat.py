@@ -2,7 +2,7 @@ import customtkinter as ctk
 import threading
 from PIL import Image, ImageDraw, ImageOps, ImageTk
 import os
-from gui.loading import LoadingAnimation
+from gui.loading import LoadingAnimation, WarmupProgress
 from agent.agent import DialogueAgent
 from typing import Any
 
@@ -28,6 +28,9 @@ COLOR = {
 }
 
 PLACEHOLDER_TXT = "Write you request..."
+WARMUP_TXT = "Loading models..."
+# Milliseconds between checks of the background loading
+WARMUP_POLL_MS = 500
 START_MSG = "Hi! I'm your virtual gaming assistant. Feel free to ask me anything about video games.\n\nNot sure where to start? Just type \"help\" to see what I can do.\n\nLet's get started!"
 HELP_MSG = "Here is what I can do for you:\n1. Search for information on a game\n2. Find a fun new game to play\n3. Compare two games to help you choose\n4. Manage your wishlist\n5. Explain gaming terminology\n6. See your friends' games"
 INPUT_CORNER_RAD = 20
@@ -90,6 +93,13 @@ class ChatGUI(ctk.CTk):
       command=self.reset_chat
     )
     self.reset_btn.grid(row=0, column=2, padx=20, sticky="e")
+
+    # Progress of the models loading in background
+    self.warmup_progress = None
+    if not self.agent.is_ready():
+      self.warmup_progress = WarmupProgress(self.header)
+      self.warmup_progress.grid(row=0, column=1, padx=10, sticky="e")
+      self.after(WARMUP_POLL_MS, self.poll_warmup)
     
     # Chat history
     self.chat_history = ctk.CTkScrollableFrame(
@@ -137,11 +147,23 @@ class ChatGUI(ctk.CTk):
 
     self.loading_animation = None
     self.loading_container = None
+    # Bubble and text of the bot response being streamed
+    self.stream_bubble = None
+    self.stream_text = ""
 
     # Add starting message of the bot
     self.add_message(START_MSG, is_bot=True)
 
 
+  def poll_warmup(self) -> None:
+    """Update the loading progress until everything is loaded."""
+    progress = self.agent.warmup_progress()
+    self.warmup_progress.update_progress(progress["done"], progress["total"], progress["pending"])
+    if progress["pending"]:
+      self.after(WARMUP_POLL_MS, self.poll_warmup)
+    else:
+      self.after(2000, self.warmup_progress.destroy)
+
   def on_global_click(self, event: Any) -> None:
     """Handle global mouse clicks to handle focus.
     Args:
@@ -204,6 +226,8 @@ class ChatGUI(ctk.CTk):
     self.set_input_state("normal")
         
     self.hide_loading()
+    self.stream_bubble = None
+    self.stream_text = ""
         
     for widget in self.chat_history.winfo_children():
       widget.destroy()
@@ -264,15 +288,47 @@ class ChatGUI(ctk.CTk):
     """
     # Catch help message
     if text.lower() == "help":
-      response = HELP_MSG
-    else:
-      try:
-        response = self.agent.chat(text)
-        print(response)
-      except Exception as e:
-        response = f"Error processing request: {str(e)}"
+      self.after(0, self.display_bot_response, HELP_MSG)
+      return
+
+    # The request waits for the models still loading
+    if not self.agent.is_ready():
+      self.after(0, self.set_loading_text, WARMUP_TXT)
+
+    try:
+      # Paint the response while the agent generates it
+      for chunk in self.agent.chat_stream(text):
+        self.after(0, self.append_bot_chunk, chunk)
+    except Exception as e:
+      self.after(0, self.append_bot_chunk, f"Error processing request: {str(e)}")
     # Update UI after we are done
-    self.after(0, self.display_bot_response, response)
+    self.after(0, self.finish_bot_response)
+
+  def append_bot_chunk(self, chunk: str) -> None:
+    """Append a chunk of the streamed response to the bot bubble.
+    Args:
+      chunk (str): new text of the response.
+    """
+    if self.stream_bubble is None:
+      # First chunk replaces the loading animation with the bubble
+      self.hide_loading()
+      self.stream_text = ""
+      self.stream_bubble = self.add_message(self.stream_text, is_bot=True)
+    self.stream_text += chunk
+    self.stream_bubble.configure(text=self.stream_text)
+    self.scroll_to_bottom()
+
+  def finish_bot_response(self) -> None:
+    """Close the streamed response and enable the input again."""
+    if self.stream_bubble is None:
+      self.display_bot_response("")
+      return
+    print(self.stream_text)
+    self.stream_bubble = None
+    self.stream_text = ""
+    self.set_input_state("normal")
+    self.input_box.insert("0.0", self.placeholder_text)
+    self.input_box.configure(text_color=COLOR["PLACEHOLDER"])
 
   def display_bot_response(self, response: str) -> None:
     """Update UI with the bot's response.
@@ -324,6 +380,14 @@ class ChatGUI(ctk.CTk):
     # This will scroll down when thinking starts
     self.scroll_to_bottom()
 
+  def set_loading_text(self, text: str) -> None:
+    """Change the text of the loading animation bubble.
+    Args:
+      text (str): new text.
+    """
+    if self.loading_animation is not None:
+      self.loading_animation.set_text(text)
+
   def hide_loading(self) -> None:
     """Remove loading animation bubble."""
     if self.loading_animation is not None:
@@ -334,11 +398,13 @@ class ChatGUI(ctk.CTk):
       self.loading_container = None
 
 
-  def add_message(self, text: str, is_bot: bool) -> None:
+  def add_message(self, text: str, is_bot: bool) -> ctk.CTkLabel:
     """Add new message to chat history.
     Args:
       text (str): message text.
       is_bot (bool): flag to choose who is the sender.
+    Returns:
+      CTkLabel, bubble containing the message text.
     """
 
     msg_container = ctk.CTkFrame(self.chat_history, fg_color=COLOR["FG"])
@@ -374,4 +440,5 @@ class ChatGUI(ctk.CTk):
       )
       bubble.pack(side="right", anchor="e", ipadx=12, ipady=12)
         
-    self.scroll_to_bottom()
\ No newline at end of file
+    self.scroll_to_bottom()
+    return bubble
\ No newline at end of file
@@ -3,7 +3,7 @@ import tkinter as tk
 from PIL import Image, ImageDraw, ImageTk
 import math
 import ctypes
-from typing import Any
+from typing import Any, List
 
 # Colors
 COLOR = {
@@ -112,7 +112,50 @@ class LoadingAnimation(ctk.CTkFrame):
         
     self.after(20, self.animate)
 
+  def set_text(self, text: str) -> None:
+    """Change the text next to the dots.
+    Args:
+      text (str): new text.
+    """
+    self.label.configure(text=text)
+
   def stop(self) -> None:
     """Stop the animation and destroy the widget."""
     self.is_running = False
-    self.destroy()
\ No newline at end of file
+    self.destroy()
+
+
+class WarmupProgress(ctk.CTkFrame):
+  """Progress of the models and data loaded in background."""
+  def __init__(self, master, **kwargs: Any) -> None:
+    """Initialize the progress bar.
+    Args:
+      master (object): parent widget.
+      **kwargs (Any): Additional keyword arguments passed to CTkFrame.
+    """
+    super().__init__(master, fg_color="transparent", **kwargs)
+
+    self.label = ctk.CTkLabel(
+      self,
+      text="Loading...",
+      text_color=COLOR["TEXT"],
+      font=("Arial", 12)
+    )
+    self.label.pack(side="top", anchor="e")
+
+    self.bar = ctk.CTkProgressBar(self, width=160, progress_color=COLOR["DOT"])
+    self.bar.set(0)
+    self.bar.pack(side="top", anchor="e")
+
+  def update_progress(self, done: int, total: int, pending: List[str]) -> None:
+    """Show how much was loaded.
+    Args:
+      done (int): number of loaded items.
+      total (int): number of items to load.
+      pending (List[str]): names of the items still loading.
+    """
+    self.bar.set(done / total if total > 0 else 1.0)
+    if pending:
+      self.label.configure(text=f"Loading {', '.join(pending)} ({done}/{total})")
+    else:
+      self.label.configure(text="Ready")
\ No newline at end of file
@@ -15,10 +15,16 @@ def chat(model):
       print(f"Assistant: {response}")
 
 
+def print_progress(item: str, done: int, total: int) -> None:
+  """Report what finished loading in background."""
+  print(f"\n[Loaded {item} ({done}/{total})]")
+
+
 def main() -> None:
   """Execute the agent."""
 
-  dialogue_agent = load_agent()
+  # Models load in background, the first request waits for them
+  dialogue_agent = load_agent(lazy=True, on_progress=print_progress)
   chat(dialogue_agent)
 
 if __name__ == "__main__":
@@ -0,0 +1,200 @@
+import threading
+import time
+from concurrent.futures import Future
+from queue import Empty, Queue
+from typing import Any, Dict, Hashable, List, Optional
+
+# Seconds the scheduler waits for other requests to join a batch
+BATCH_WINDOW = 0.02
+# Prompts passed at most to a single batched call
+MAX_BATCH_PROMPTS = 16
+
+
+class _Request:
+  """Prompts waiting to be run by the scheduler."""
+
+  def __init__(self, task: Any, kind: str, prompts: List[str], histories: List[Any], extra: Dict[str, Any]) -> None:
+    self.task = task
+    self.kind = kind
+    self.prompts = prompts
+    self.histories = histories
+    self.extra = extra
+    self.future: Future = Future()
+
+  def group_key(self) -> Hashable:
+    """Requests with the same key can run in the same batched call."""
+    task = self.task
+    extra = tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in self.extra.items()))
+    stop = tuple(task.stop) if isinstance(task.stop, list) else task.stop
+    return (id(task.model), self.kind, task.system_prompt, id(task.json_schema), stop, extra)
+
+
+class BatchScheduler:
+  """Coalesce concurrent calls of different tasks on the same model into batched generations.
+  Every caller blocks until its own outputs are ready, a single worker runs the batches so
+  the model never runs two generations at once.
+  """
+
+  def __init__(self, window: float = BATCH_WINDOW, max_batch_prompts: int = MAX_BATCH_PROMPTS) -> None:
+    """Initialize the scheduler and start its worker.
+    Args:
+      window (float): seconds to wait for more requests after the first one arrives.
+      max_batch_prompts (int): maximum number of prompts collected before running.
+    """
+    self.window = window
+    self.max_batch_prompts = max_batch_prompts
+    self._queue: "Queue[_Request]" = Queue()
+    self.stats = {"requests": 0, "batches": 0, "prompts": 0}
+    self._stats_lock = threading.Lock()
+    self._worker = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+    self._worker.start()
+
+  def is_worker(self) -> bool:
+    """Tell if the caller is the scheduler worker, which must run tasks directly."""
+    return threading.current_thread() is self._worker
+
+  def _submit(self, task: Any, kind: str, prompts: List[str], histories: Optional[List[Any]], **extra: Any) -> List[Any]:
+    """Queue prompts and wait for their outputs.
+    Args:
+      task (Any): llm task the prompts belong to.
+      kind (str): "generate" or "score".
+      prompts (List[str]): prompts to run.
+      histories (Optional[List[Any]]): history of every prompt.
+      **extra (Any): arguments of the batched call, part of the grouping key.
+    Returns:
+      List[Any]: outputs in the order of the prompts.
+    """
+    if histories is None:
+      histories = [None] * len(prompts)
+    request = _Request(task, kind, list(prompts), list(histories), extra)
+    self._queue.put(request)
+    return request.future.result()
+
+  def generate(self, task: Any, prompt: str, history: Any = None, max_new_tokens: Optional[int] = None) -> str:
+    """Generate the output of a single prompt batched with concurrent ones.
+    Args:
+      task (Any): llm task generating.
+      prompt (str): user prompt after which the model generates.
+      history (Any): previous exchanges to add after the system prompt.
+      max_new_tokens (Optional[int]): maximum number of tokens to generate.
+    Returns:
+      str: generated response.
+    """
+    return self._submit(task, "generate", [prompt], [history], max_new_tokens=max_new_tokens, max_batch_size=None)[0]
+
+  def generate_batch(
+      self,
+      task: Any,
+      prompts: List[str],
+      histories: List[Any],
+      max_new_tokens: int,
+      max_batch_size: Optional[int] = None
+    ) -> List[str]:
+    """Generate the outputs of many prompts batched with concurrent ones.
+    Args:
+      task (Any): llm task generating.
+      prompts (List[str]): user prompts after which the model generates.
+      histories (List[Any]): history of every prompt.
+      max_new_tokens (int): maximum number of tokens to generate.
+      max_batch_size (Optional[int]): override of the maximum batch size.
+    Returns:
+      List[str]: generated responses in the order of the prompts.
+    """
+    return self._submit(task, "generate", prompts, histories, max_new_tokens=max_new_tokens, max_batch_size=max_batch_size)
+
+  def score_labels(self, task: Any, prompts: List[str], labels: List[str], histories: Optional[List[Any]] = None) -> List[Dict[str, float]]:
+    """Score labels for some prompts batched with concurrent ones.
+    Args:
+      task (Any): llm task scoring.
+      prompts (List[str]): user prompts to classify.
+      labels (List[str]): candidate labels.
+      histories (Optional[List[Any]]): optional history for every prompt.
+    Returns:
+      List[Dict[str, float]]: probability of every label for each prompt.
+    """
+    return self._submit(task, "score", prompts, histories, labels=list(labels))
+
+  def _collect(self) -> List[_Request]:
+    """Wait for a request, then gather the ones arriving within the window."""
+    requests = [self._queue.get()]
+    n_prompts = len(requests[0].prompts)
+    deadline = time.monotonic() + self.window
+    while n_prompts < self.max_batch_prompts:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        break
+      try:
+        request = self._queue.get(timeout=remaining)
+      except Empty:
+        break
+      requests.append(request)
+      n_prompts += len(request.prompts)
+    return requests
+
+  @staticmethod
+  def _generate_group(group: List[_Request]) -> List[str]:
+    """Generate the prompts of a group in shared batched calls.
+    Every task answers its prompts from its own response cache and records its own budget and usage.
+    Args:
+      group (List[_Request]): requests sharing model and settings.
+    Returns:
+      List[str]: outputs of all the prompts, in the order of the requests.
+    """
+    first = group[0]
+    max_new_tokens = first.extra["max_new_tokens"]
+    batches = [request.task.start_batch(request.prompts, request.histories, max_new_tokens) for request in group]
+    texts = [batch.texts[idx] for batch in batches for idx in batch.pending]
+    results = first.task.generate_texts(texts, max_new_tokens, first.extra["max_batch_size"])
+
+    outputs: List[str] = []
+    start = 0
+    for request, batch in zip(group, batches):
+      end = start + len(batch.pending)
+      outputs.extend(request.task.finish_batch(batch, results[start:end]))
+      start = end
+    return outputs
+
+  def _run_group(self, group: List[_Request]) -> None:
+    """Run requests sharing model and settings in a single batched call."""
+    prompts = [p for r in group for p in r.prompts]
+    histories = [h for r in group for h in r.histories]
+    try:
+      if group[0].kind == "generate":
+        outputs = self._generate_group(group)
+      else:
+        # Scoring keeps no cache or stats in the task
+        outputs = group[0].task.score_labels(prompts, group[0].extra["labels"], histories)
+    except Exception as e:
+      for request in group:
+        request.future.set_exception(e)
+      return
+
+    start = 0
+    for request in group:
+      end = start + len(request.prompts)
+      request.future.set_result(outputs[start:end])
+      start = end
+
+    with self._stats_lock:
+      self.stats["requests"] += len(group)
+      self.stats["batches"] += 1
+      self.stats["prompts"] += len(prompts)
+
+  def _run(self) -> None:
+    """Worker loop running the collected requests grouped by model and settings."""
+    while True:
+      groups: Dict[Hashable, List[_Request]] = {}
+      for request in self._collect():
+        groups.setdefault(request.group_key(), []).append(request)
+      for group in groups.values():
+        self._run_group(group)
+
+  def report(self) -> Dict[str, Any]:
+    """Summarize how much requests were coalesced.
+    Returns:
+      Dict[str, Any]: requests, batches and mean prompts per batch.
+    """
+    with self._stats_lock:
+      stats = dict(self.stats)
+    stats["mean_batch"] = stats["prompts"] / stats["batches"] if stats["batches"] > 0 else 0.0
+    return stats
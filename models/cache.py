@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class PrefixCache:
+  """LRU cache of the key/values computed for the static system prompt prefix of a model."""
+
+  def __init__(self, max_entries: int = 8) -> None:
+    """Initialize the cache.
+    Args:
+      max_entries (int): maximum number of prefixes to keep, the least recently used is dropped.
+    """
+    self.max_entries = max_entries
+    self._entries: "OrderedDict[Tuple[str, str, str, str], Tuple[Any, Any]]" = OrderedDict()
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def make_key(model_id: str, device: Any, system_prompt: str, variant: Optional[Dict[str, Any]] = None) -> Tuple[str, str, str, str]:
+    """Build the cache key of a system prompt.
+    Args:
+      model_id (str): id of the model that computed the prefix.
+      device (Any): device where the key/values live.
+      system_prompt (str): system prompt the prefix is made of.
+      variant (Optional[Dict[str, Any]]): how the weights were loaded, e.g. load strategy and dtype.
+    Returns:
+      Tuple[str, str, str, str]: cache key, starting with the model id.
+    """
+    prompt_hash = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()
+    variant_key = json.dumps(variant, sort_keys=True, default=str)
+    return (model_id, variant_key, str(device), prompt_hash)
+
+  def get(self, key: Tuple[str, str, str, str]) -> Optional[Tuple[Any, Any]]:
+    """Get the prefix token ids and key/values of a key.
+    Args:
+      key (Tuple[str, str, str, str]): cache key.
+    Returns:
+      Optional[Tuple[Any, Any]]: prefix ids and past key values, None if missing.
+    """
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None:
+        self._entries.move_to_end(key)
+      return entry
+
+  def put(self, key: Tuple[str, str, str, str], prefix_ids: Any, past_key_values: Any) -> None:
+    """Store the key/values of a prefix.
+    Args:
+      key (Tuple[str, str, str, str]): cache key.
+      prefix_ids (Any): token ids of the prefix.
+      past_key_values (Any): key/values computed on the prefix.
+    """
+    with self._lock:
+      self._entries[key] = (prefix_ids, past_key_values)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+
+  def drop_model(self, model_id: str, device: Any = None) -> int:
+    """Remove the prefixes of a model, so their key/values don't keep device memory after it is unloaded.
+    Args:
+      model_id (str): id of the model.
+      device (Any): device of the model, every device if None.
+    Returns:
+      int: number of prefixes removed.
+    """
+    with self._lock:
+      keys = [key for key in self._entries if key[0] == model_id and (device is None or key[2] == str(device))]
+      for key in keys:
+        del self._entries[key]
+    return len(keys)
+
+  def clear(self) -> None:
+    """Remove all cached prefixes."""
+    with self._lock:
+      self._entries.clear()
+
+
+# Shared by every LLMTask so components on the same model reuse their prefixes
+PREFIX_CACHE = PrefixCache()
+
+
+class ResponseCache:
+  """On-disk cache of llm responses, addressed by the hash of everything that determines them."""
+
+  def __init__(self, path: str) -> None:
+    """Open the cache creating the table if needed.
+    Args:
+      path (str): path of the sqlite database.
+    """
+    self.path = path
+    self.stats = {"hits": 0, "misses": 0}
+    self._lock = threading.Lock()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with self._lock, closing(self._connect()) as conn, conn:
+      conn.execute(
+        "CREATE TABLE IF NOT EXISTS responses ("
+        "key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL)"
+      )
+
+  def _connect(self) -> sqlite3.Connection:
+    """Open a connection, a new one is used for every operation so threads don't share it."""
+    return sqlite3.connect(self.path, timeout=10)
+
+  @staticmethod
+  def make_key(model_id: str, text: str, params: Dict[str, Any]) -> str:
+    """Build the key of a response.
+    Args:
+      model_id (str): id of the model generating the response.
+      text (str): full prompt rendered with the chat template.
+      params (Dict[str, Any]): generation parameters, such as budget, stop and decoding settings.
+    Returns:
+      str: sha256 hex digest.
+    """
+    payload = json.dumps([model_id, text, params], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+  def get_many(self, keys: List[str]) -> Dict[str, str]:
+    """Get the cached responses of some keys.
+    Args:
+      keys (List[str]): response keys.
+    Returns:
+      Dict[str, str]: responses of the keys found.
+    """
+    unique = list(dict.fromkeys(keys))
+    with self._lock, closing(self._connect()) as conn:
+      rows = conn.execute(
+        f"SELECT key, response FROM responses WHERE key IN ({', '.join('?' * len(unique))})", unique
+      ).fetchall() if unique else []
+      found = dict(rows)
+      hits = sum(key in found for key in keys)
+      self.stats["hits"] += hits
+      self.stats["misses"] += len(keys) - hits
+    return found
+
+  def get(self, key: str) -> Optional[str]:
+    """Get the cached response of a key.
+    Args:
+      key (str): response key.
+    Returns:
+      Optional[str]: response, None if missing.
+    """
+    return self.get_many([key]).get(key)
+
+  def put_many(self, items: Dict[str, str]) -> None:
+    """Store responses.
+    Args:
+      items (Dict[str, str]): responses by key.
+    """
+    if not items:
+      return
+    now = time.time()
+    with self._lock, closing(self._connect()) as conn, conn:
+      conn.executemany(
+        "INSERT OR REPLACE INTO responses (key, response, created_at) VALUES (?, ?, ?)",
+        [(key, response, now) for key, response in items.items()]
+      )
+
+  def put(self, key: str, response: str) -> None:
+    """Store a response.
+    Args:
+      key (str): response key.
+      response (str): generated response.
+    """
+    self.put_many({key: response})
+
+  def hit_rate(self) -> float:
+    """Get the fraction of lookups answered by the cache.
+    Returns:
+      float: hit rate.
+    """
+    lookups = self.stats["hits"] + self.stats["misses"]
+    return self.stats["hits"] / lookups if lookups > 0 else 0.0
@@ -0,0 +1,449 @@
+import json
+import threading
+import torch
+from typing import Any, Dict, List, Optional, Tuple
+from transformers import LogitsProcessor, PreTrainedTokenizer, StoppingCriteria
+
+# States of a generated text with respect to a schema
+INVALID = "invalid"
+PARTIAL = "partial"
+COMPLETE = "complete"
+
+WHITESPACE = " \t\n\r"
+# Longest whitespace run allowed, pretty printing needs indentation but no more
+MAX_WHITESPACE = 32
+
+
+class _Incomplete(Exception):
+  """The text ended before the value was complete."""
+
+
+class _Invalid(Exception):
+  """The text can't be extended into a value matching the schema."""
+
+
+class _SchemaParser:
+  """Recursive descent parser checking a JSON text against a subset of JSON schema.
+  Supported keywords are type (object, array, string, number, integer, boolean, null),
+  properties, required, items, minItems, enum and anyOf. Enums are case insensitive.
+  """
+
+  def __init__(self, text: str) -> None:
+    """Initialize the parser.
+    Args:
+      text (str): text to parse.
+    """
+    self.text = text
+    self.pos = 0
+
+  def _peek(self) -> str:
+    """Get the current char, the text ending here means the value is incomplete."""
+    if self.pos >= len(self.text):
+      raise _Incomplete()
+    return self.text[self.pos]
+
+  def _expect(self, char: str) -> None:
+    """Consume a specific char."""
+    if self._peek() != char:
+      raise _Invalid()
+    self.pos += 1
+
+  def skip_whitespace(self) -> None:
+    """Consume whitespace, refusing endless runs of it."""
+    start = self.pos
+    while self.pos < len(self.text) and self.text[self.pos] in WHITESPACE:
+      self.pos += 1
+    if self.pos - start > MAX_WHITESPACE:
+      raise _Invalid()
+
+  def parse(self, schema: Dict[str, Any]) -> None:
+    """Parse a value matching the schema.
+    Args:
+      schema (Dict[str, Any]): schema of the value.
+    """
+    self.skip_whitespace()
+    if "anyOf" in schema:
+      return self._parse_any(schema["anyOf"])
+
+    match schema.get("type"):
+      case "object":
+        self._parse_object(schema)
+      case "array":
+        self._parse_array(schema)
+      case "string":
+        self._parse_string(schema.get("enum"))
+      case "number":
+        self._parse_number(integer=False)
+      case "integer":
+        self._parse_number(integer=True)
+      case "boolean":
+        self._parse_any([{"const": "true"}, {"const": "false"}])
+      case "null":
+        self._parse_literal("null")
+      case None if "const" in schema:
+        self._parse_literal(schema["const"])
+      case _:
+        raise ValueError(f"Unsupported schema {schema}")
+
+  def _parse_any(self, options: List[Dict[str, Any]]) -> None:
+    """Parse a value matching at least one of the options."""
+    start = self.pos
+    incomplete = False
+    for option in options:
+      self.pos = start
+      try:
+        self.parse(option)
+        return
+      except _Incomplete:
+        incomplete = True
+      except _Invalid:
+        continue
+    self.pos = start
+    if incomplete:
+      raise _Incomplete()
+    raise _Invalid()
+
+  def _parse_literal(self, word: str) -> None:
+    """Parse a fixed word such as null."""
+    for char in word:
+      self._expect(char)
+
+  def _parse_string(self, enum: Optional[List[str]] = None) -> str:
+    """Parse a string, optionally restricted to some values.
+    Args:
+      enum (Optional[List[str]]): allowed values.
+    Returns:
+      str: parsed value.
+    """
+    allowed = [e.lower() for e in enum] if enum is not None else None
+    self._expect('"')
+    chars = []
+    try:
+      while True:
+        char = self._peek()
+        if char == '"':
+          self.pos += 1
+          break
+        if char == "\\":
+          self.pos += 1
+          escaped = self._peek()
+          if escaped == "u":
+            for _ in range(4):
+              self.pos += 1
+              if self._peek() not in "0123456789abcdefABCDEF":
+                raise _Invalid()
+          elif escaped not in '"\\/bfnrt':
+            raise _Invalid()
+          chars.append(escaped)
+        elif char in "\n\r":
+          raise _Invalid()
+        else:
+          chars.append(char)
+        self.pos += 1
+    except _Incomplete:
+      # A partial value must still lead to an allowed one
+      value = "".join(chars).lower()
+      if allowed is not None and not any(a.startswith(value) for a in allowed):
+        raise _Invalid()
+      raise
+
+    value = "".join(chars)
+    if allowed is not None and value.lower() not in allowed:
+      raise _Invalid()
+    return value
+
+  def _parse_digits(self) -> None:
+    """Parse at least one digit."""
+    if not self._peek().isdigit():
+      raise _Invalid()
+    while self._peek().isdigit():
+      self.pos += 1
+
+  def _parse_number(self, integer: bool) -> None:
+    """Parse a number, a number at the end of the text could still continue."""
+    if self._peek() == "-":
+      self.pos += 1
+    self._parse_digits()
+    if integer:
+      return
+    if self._peek() == ".":
+      self.pos += 1
+      self._parse_digits()
+    if self._peek() in "eE":
+      self.pos += 1
+      if self._peek() in "+-":
+        self.pos += 1
+      self._parse_digits()
+
+  def _parse_object(self, schema: Dict[str, Any]) -> None:
+    """Parse an object whose keys are the schema properties."""
+    properties = schema.get("properties", {})
+    required = set(schema.get("required", []))
+    seen = set()
+
+    self._expect("{")
+    self.skip_whitespace()
+    if self._peek() == "}":
+      if required - seen:
+        raise _Invalid()
+      self.pos += 1
+      return
+
+    while True:
+      self.skip_whitespace()
+      key = self._parse_string([k for k in properties if k not in seen])
+      key = next(k for k in properties if k.lower() == key.lower())
+      seen.add(key)
+      self.skip_whitespace()
+      self._expect(":")
+      self.parse(properties[key])
+      self.skip_whitespace()
+      char = self._peek()
+      if char == ",":
+        self.pos += 1
+      elif char == "}":
+        if required - seen:
+          raise _Invalid()
+        self.pos += 1
+        return
+      else:
+        raise _Invalid()
+
+  def _parse_array(self, schema: Dict[str, Any]) -> None:
+    """Parse an array whose items match the items schema."""
+    items = schema.get("items", {})
+    min_items = schema.get("minItems", 0)
+    count = 0
+
+    self._expect("[")
+    self.skip_whitespace()
+    if self._peek() == "]":
+      if min_items > 0:
+        raise _Invalid()
+      self.pos += 1
+      return
+
+    while True:
+      self.parse(items)
+      count += 1
+      self.skip_whitespace()
+      char = self._peek()
+      if char == ",":
+        self.pos += 1
+      elif char == "]":
+        if count < min_items:
+          raise _Invalid()
+        self.pos += 1
+        return
+      else:
+        raise _Invalid()
+
+
+def json_state(text: str, schema: Dict[str, Any]) -> str:
+  """Tell if a text is a complete value of the schema, a prefix of one, or neither.
+  Args:
+    text (str): generated text.
+    schema (Dict[str, Any]): schema the text must follow.
+  Returns:
+    str: one of COMPLETE, PARTIAL and INVALID.
+  """
+  parser = _SchemaParser(text)
+  try:
+    parser.parse(schema)
+    parser.skip_whitespace()
+  except _Incomplete:
+    return PARTIAL
+  except _Invalid:
+    return INVALID
+  # Nothing but whitespace may follow the value
+  return COMPLETE if parser.pos == len(text) else INVALID
+
+
+# Chars of JSON structure and numbers, tokens made of these can always be checked against the schema
+STRUCTURAL_CHARS = set('{}[]:,"-.0123456789eE' + WHITESPACE)
+# Most likely tokens checked at every step, the search widens when none of them fits
+SEARCH_SIZES = (32, 256, 2048)
+
+# Text every token of a tokenizer adds, and the tokens writing the structure of a schema
+_PIECES: Dict[Tuple[str, int], List[Optional[str]]] = {}
+_STRUCTURAL: Dict[Tuple[str, int, str], List[int]] = {}
+_TABLES_LOCK = threading.Lock()
+
+
+def token_pieces(tokenizer: PreTrainedTokenizer) -> List[Optional[str]]:
+  """Get the text every token adds to the output, built once per tokenizer.
+  Tokens are decoded after another one, as alone they lose their leading space.
+  Args:
+    tokenizer (PreTrainedTokenizer): tokenizer of the model.
+  Returns:
+    List[Optional[str]]: text of every token, None for the ones ending inside a character.
+  """
+  key = (tokenizer.name_or_path, len(tokenizer))
+  with _TABLES_LOCK:
+    pieces = _PIECES.get(key)
+    if pieces is None:
+      anchor = tokenizer.encode("a", add_special_tokens=False)[0]
+      base = tokenizer.decode([anchor], skip_special_tokens=True, clean_up_tokenization_spaces=False)
+      decoded = tokenizer.batch_decode(
+        [[anchor, token] for token in range(len(tokenizer))], skip_special_tokens=True, clean_up_tokenization_spaces=False
+      )
+      pieces = [text[len(base):] if text.startswith(base) and "\ufffd" not in text else None for text in decoded]
+      _PIECES[key] = pieces
+  return pieces
+
+
+def _schema_literals(schema: Any) -> List[str]:
+  """Collect the keys, enum values and constants of a schema as they appear in the JSON text."""
+  literals = ["null", "true", "false"]
+  if isinstance(schema, dict):
+    for key, value in schema.items():
+      if key == "properties":
+        literals.extend(json.dumps(k).lower() for k in value)
+      elif key == "enum":
+        literals.extend(json.dumps(v).lower() for v in value)
+      elif key == "const":
+        literals.append(str(value).lower())
+      literals.extend(_schema_literals(value))
+  elif isinstance(schema, list):
+    for item in schema:
+      literals.extend(_schema_literals(item))
+  return literals
+
+
+def structural_tokens(tokenizer: PreTrainedTokenizer, schema: Dict[str, Any]) -> List[int]:
+  """Get the tokens able to continue any prefix of the schema but free text, built once per tokenizer and schema.
+  Args:
+    tokenizer (PreTrainedTokenizer): tokenizer of the model.
+    schema (Dict[str, Any]): schema the output must follow.
+  Returns:
+    List[int]: tokens made of JSON structure, numbers or pieces of the keys and enum values.
+  """
+  pieces = token_pieces(tokenizer)
+  key = (tokenizer.name_or_path, len(tokenizer), json.dumps(schema, sort_keys=True))
+  with _TABLES_LOCK:
+    tokens = _STRUCTURAL.get(key)
+    if tokens is None:
+      literals = sorted(set(_schema_literals(schema)))
+      tokens = []
+      for token, piece in enumerate(pieces):
+        core = piece.strip(WHITESPACE).lower() if piece else ""
+        if core and (all(c in STRUCTURAL_CHARS for c in core) or any(core in literal for literal in literals)):
+          tokens.append(token)
+      _STRUCTURAL[key] = tokens
+  return tokens
+
+
+class JsonSchemaLogitsProcessor(LogitsProcessor):
+  """Mask the tokens that would make the generated text diverge from a JSON schema.
+  Candidates are checked by appending their text to the decoded output, so the output is decoded once per step.
+  """
+
+  def __init__(
+      self,
+      tokenizer: PreTrainedTokenizer,
+      schema: Dict[str, Any],
+      prompt_len: int,
+      eos_token_ids: List[int],
+      search_sizes: Tuple[int, ...] = SEARCH_SIZES
+    ) -> None:
+    """Initialize the processor.
+    Args:
+      tokenizer (PreTrainedTokenizer): tokenizer to decode the generated text.
+      schema (Dict[str, Any]): schema the output must follow.
+      prompt_len (int): length of the (padded) prompt in the input ids.
+      eos_token_ids (List[int]): tokens ending the generation.
+      search_sizes (Tuple[int, ...]): numbers of most likely tokens checked in turn, before the structural tokens.
+    """
+    self.tokenizer = tokenizer
+    self.schema = schema
+    self.prompt_len = prompt_len
+    self.eos_token_ids = eos_token_ids
+    self.search_sizes = search_sizes
+    self.pieces = token_pieces(tokenizer)
+    # State of the texts checked at the previous step for every row, one of them is the current output
+    self._checked: Dict[int, Dict[str, str]] = {}
+
+  def _state(self, text: str, checked: Dict[str, str]) -> str:
+    """Get the state of a text, parsing it only if not checked yet."""
+    state = checked.get(text)
+    if state is None:
+      state = json_state(text, self.schema)
+      checked[text] = state
+    return state
+
+  def _fitting(self, tokens: List[int], text: str, checked: Dict[str, str], seen: set) -> List[int]:
+    """Get the tokens continuing the text into a prefix or a value of the schema.
+    Args:
+      tokens (List[int]): candidate tokens.
+      text (str): generated text.
+      checked (Dict[str, str]): state of the texts already parsed.
+      seen (set): tokens already checked at this step, skipped.
+    Returns:
+      List[int]: fitting tokens.
+    """
+    allowed = []
+    for token in tokens:
+      if token in seen or token in self.eos_token_ids:
+        continue
+      seen.add(token)
+      piece = self.pieces[token] if token < len(self.pieces) else None
+      # Tokens adding no text would let the model loop without progress
+      if piece and self._state(text + piece, checked) != INVALID:
+        allowed.append(token)
+    return allowed
+
+  def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+    masked = torch.full_like(scores, float("-inf"))
+
+    for row in range(input_ids.shape[0]):
+      text = self.tokenizer.decode(
+        input_ids[row, self.prompt_len:].tolist(), skip_special_tokens=True, clean_up_tokenization_spaces=False
+      )
+      previous = self._checked.get(row, {})
+      checked = {text: previous[text]} if text in previous else {}
+
+      allowed = []
+      if self._state(text, checked) == PARTIAL:
+        finite = torch.isfinite(scores[row])
+        seen = set()
+        for size in self.search_sizes:
+          top = torch.topk(scores[row], min(size, scores.shape[-1])).indices
+          allowed = self._fitting(top[finite[top]].tolist(), text, checked, seen)
+          if allowed:
+            break
+        else:
+          # No likely token fits, the structure can still be written before giving up
+          structural = torch.tensor(
+            [t for t in structural_tokens(self.tokenizer, self.schema) if t < scores.shape[-1]], dtype=torch.long, device=scores.device
+          )
+          allowed = self._fitting(structural[finite[structural]].tolist(), text, checked, seen)
+      self._checked[row] = checked
+
+      # Once complete, or if no token fits, the only way out is ending
+      if not allowed:
+        allowed = self.eos_token_ids
+      masked[row, allowed] = scores[row, allowed]
+
+    return masked
+
+
+class JsonCompleteCriteria(StoppingCriteria):
+  """Stop generating as soon as the output is a complete value of the schema."""
+
+  def __init__(self, tokenizer: PreTrainedTokenizer, schema: Dict[str, Any], prompt_len: int) -> None:
+    """Initialize the criteria.
+    Args:
+      tokenizer (PreTrainedTokenizer): tokenizer to decode the generated text.
+      schema (Dict[str, Any]): schema the output must follow.
+      prompt_len (int): length of the (padded) prompt in the input ids.
+    """
+    self.tokenizer = tokenizer
+    self.schema = schema
+    self.prompt_len = prompt_len
+
+  def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs: Any) -> torch.BoolTensor:
+    done = [
+      json_state(self.tokenizer.decode(row[self.prompt_len:], skip_special_tokens=True), self.schema) == COMPLETE
+      for row in input_ids.tolist()
+    ]
+    return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
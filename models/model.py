@@ -1,33 +1,110 @@
+import copy
+import threading
+import time
 import torch
-from typing import List, Dict, Any
-from transformers import AutoTokenizer
-from models.registry import MODELS
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+from transformers import AutoTokenizer, BatchEncoding, DynamicCache, LogitsProcessorList, StoppingCriteriaList, TextIteratorStreamer
+from models.registry import MODELS, LOAD_STRATEGIES
+from models.batching import BatchScheduler
+from models.cache import PREFIX_CACHE, ResponseCache
+from models.constrained import JsonCompleteCriteria, JsonSchemaLogitsProcessor
+from models.stopping import BalancedJsonCriteria, StopOnStrings
+
+DEFAULT_MAX_NEW_TOKENS = 1000
+# Generation config fields changing the response, part of the response cache key
+DECODING_PARAMS = ["do_sample", "temperature", "top_p", "top_k", "repetition_penalty", "num_beams"]
+
+
+def make_usage(prompt_tokens: int = 0, generated_tokens: int = 0, latency: float = 0.0, cached: bool = False) -> Dict[str, Any]:
+  """Build the cost record of a single output.
+  Args:
+    prompt_tokens (int): tokens of the rendered prompt.
+    generated_tokens (int): tokens generated up to the end of the response.
+    latency (float): seconds the caller waited for the output.
+    cached (bool): true if the output came from the response cache.
+  Returns:
+    Dict[str, Any]: usage record.
+  """
+  return {"prompt_tokens": prompt_tokens, "generated_tokens": generated_tokens, "latency": latency, "cached": cached}
+
+
+def device_kind(device: str) -> str:
+  """Get the kind of device used to choose the load strategy.
+  Args:
+    device (str): device or device map, e.g. "auto", "cpu" or "cuda:0".
+  Returns:
+    str: device kind, e.g. "cuda" or "cpu".
+  """
+  if device == "auto":
+    return "cuda" if torch.cuda.is_available() else "cpu"
+  return device.split(":")[0]
 
 
 class ModelLoader:
   """Class wrapper around chosen llm model and tokenizer."""
 
-  def __init__(self, model_name: str, device: str = "cpu") -> None:
+  def __init__(self, model_name: str, device: str = "cpu", strategy: Optional[str] = None) -> None:
     """Load a model and its tokenizer.
     Args:
       model_name (str): name of the model to load.
       device (str): device where to load the model.
+      strategy (Optional[str]): load strategy to use instead of the registry ones for the device.
     """
 
     if model_name not in MODELS:
       raise ValueError(f"Unknown model '{model_name}'. Available: {list(MODELS.keys())}.")
     
-    model_id, init_model, prepare_text = MODELS[model_name]
+    model_id, strategies, prepare_text = MODELS[model_name]
+
+    kind = device_kind(device)
+    candidates = [strategy] if strategy else strategies.get(kind, [])
+    if not candidates:
+      raise ValueError(f"Model '{model_name}' has no load strategy for device '{kind}'.")
 
     print(f"Loading tokenizer and model: {model_name}.")
     self.tokenizer = AutoTokenizer.from_pretrained(model_id)
-    self.model = init_model(model_id, dtype="auto", device_map=device)
+
+    # Try the strategies in order, a missing export moves to the next one
+    self.load_strategy = None
+    for name in candidates:
+      if name not in LOAD_STRATEGIES:
+        raise ValueError(f"Unknown load strategy '{name}'. Available: {list(LOAD_STRATEGIES.keys())}.")
+      try:
+        self.model = LOAD_STRATEGIES[name](model_id, device)
+        self.load_strategy = name
+        break
+      except FileNotFoundError as e:
+        print(f"Skipping load strategy '{name}': {e}")
+    if self.load_strategy is None:
+      raise RuntimeError(f"No load strategy succeeded for '{model_name}' on '{kind}'.")
+    print(f"Loaded {model_name} with strategy '{self.load_strategy}'.")
 
     self.model_id = model_id
     self.model_name = model_name
     self.device = device
     self.prepare_text_fun = prepare_text
+    # Fast tokenizers can't be reconfigured while another thread uses them
+    self.tokenizer_lock = threading.Lock()
+    # A single generation or forward pass runs on the model at a time
+    self.model_lock = threading.RLock()
+
+
 
+class PendingBatch:
+  """Prompts of a batched call, with the responses found in the response cache and the ones left to generate."""
+
+  def __init__(self, texts: List[str], max_new_tokens: int) -> None:
+    """Initialize the batch with every prompt pending.
+    Args:
+      texts (List[str]): prompts rendered with the chat template.
+      max_new_tokens (int): generation budget.
+    """
+    self.texts = texts
+    self.max_new_tokens = max_new_tokens
+    self.outputs: List[str] = [""] * len(texts)
+    self.usage = [make_usage(cached=True) for _ in texts]
+    self.pending = list(range(len(texts)))
+    self.cache_keys: Optional[List[str]] = None
 
 
 class LLMTask:
@@ -36,21 +113,52 @@ class LLMTask:
   def __init__(
       self, 
       model_loader: ModelLoader,
-      system_prompt: str
+      system_prompt: str,
+      max_batch_size: int = 8,
+      use_prefix_cache: bool = True,
+      json_schema: Optional[Dict[str, Any]] = None,
+      generation: Optional[Dict[str, Any]] = None
     ) -> None:
     """Initialize LLM to be used.
     Args:
       model_loader (ModelLoader): model loader that handles loading model and tokenizer.
       system_prompt (str): describes in detail the task that the llm must do.
+      max_batch_size (int): maximum number of prompts passed to a single batched generate.
+      use_prefix_cache (bool): reuse the key/values of the system prompt across calls.
+      json_schema (Optional[Dict[str, Any]]): if given, decoding is constrained to json matching it.
+      generation (Optional[Dict[str, Any]]): generation budget of the task, with keys
+        max_new_tokens and stop, either "json" or a list of stop strings.
     """
     
     self.model = model_loader.model
     self.tokenizer = model_loader.tokenizer
+    self.tokenizer_lock = model_loader.tokenizer_lock
+    self.model_lock = model_loader.model_lock
     self.prepare_text_fun = model_loader.prepare_text_fun
     self.model_id = model_loader.model_id
     self.model_name = model_loader.model_name
     self.device = model_loader.model.device
+    # The same model id gives other outputs once quantized or cast, so caches keep the variants apart
+    self.model_variant = self._model_variant(model_loader)
     self.system_prompt = system_prompt
+    self.max_batch_size = max_batch_size
+    self.use_prefix_cache = use_prefix_cache
+    self.json_schema = json_schema
+
+    # Generation budget and stop criteria
+    if generation is None:
+      generation = {}
+    self.max_new_tokens = generation.get("max_new_tokens", DEFAULT_MAX_NEW_TOKENS)
+    self.stop = generation.get("stop")
+    # Generated tokens against the budget, to tune it
+    self.budget_stats = {"calls": 0, "tokens": 0, "max_tokens": 0, "budget_hits": 0}
+    self._stats_lock = threading.Lock()
+    # When set, single calls are batched with the ones of other sessions
+    self.scheduler: Optional[BatchScheduler] = None
+    # When set, responses are reused for prompts already seen with the same settings
+    self.response_cache: Optional[ResponseCache] = None
+    # Usage of every output of the last call, in order
+    self.last_usage: List[Dict[str, Any]] = []
 
   def change_system_prompt(self, new_prompt: str) -> None:
     """Change the system prompt to dynamically adjust the task based on intent.
@@ -73,37 +181,628 @@ class LLMTask:
                                 self.messages)
   
 
-  def generate(self, prompt: str, history: Any = None, max_new_tokens: int = 1000) -> str:
-    """Generate output given user prompt.
+  def _build_messages(self, history: Any = None) -> List[Dict[str, str]]:
+    """Build the conversation made of system prompt and optional history.
     Args:
-      prompt (str): user prompt after which the model generates.
-      max_new_tokens (str): maximum number of tokens to use to generate.
+      history (Any): previous exchanges to add after the system prompt.
     Returns:
-      str: generated response.
+      List[Dict[str, str]]: messages to prepare for the model.
     """
-    # Reset conversation
-    self.messages: List[Dict[str, str]] = [
-      {"role": "system", "content": self.system_prompt}
-    ]
-    # Add history if passed
+    messages = [{"role": "system", "content": self.system_prompt}]
     if history:
-      self.messages.extend(history)
-
-    text = self.prepare_text(prompt)
-    model_inputs = self.tokenizer([text], return_tensors="pt").to(self.device)
+      # Copy the dicts since some prepare functions edit them in place
+      messages.extend(dict(msg) for msg in history)
+    return messages
 
+  def _pad_token_id(self) -> int:
+    """Get the token used for padding, falling back to eos when missing."""
     pad_token_id = self.tokenizer.pad_token_id
     if pad_token_id is None:
-        pad_token_id = self.tokenizer.eos_token_id
+      pad_token_id = self.tokenizer.eos_token_id
+    return pad_token_id
+
+  def _eos_token_ids(self) -> List[int]:
+    """Get every token that ends the generation."""
+    eos = self.model.generation_config.eos_token_id
+    if eos is None:
+      eos = self.tokenizer.eos_token_id
+    return list(eos) if isinstance(eos, (list, tuple)) else [eos]
+
+  def _decoding_kwargs(self, prompt_len: int) -> Dict[str, Any]:
+    """Get generate arguments constraining and stopping the output.
+    Args:
+      prompt_len (int): length of the (padded) prompt.
+    Returns:
+      Dict[str, Any]: logits processor and stopping criteria, empty if none applies.
+    """
+    gen_kwargs = {}
+    criteria = []
+    if self.json_schema is not None:
+      processor = JsonSchemaLogitsProcessor(self.tokenizer, self.json_schema, prompt_len, self._eos_token_ids())
+      gen_kwargs["logits_processor"] = LogitsProcessorList([processor])
+      criteria.append(JsonCompleteCriteria(self.tokenizer, self.json_schema, prompt_len))
+    elif self.stop == "json":
+      criteria.append(BalancedJsonCriteria(self.tokenizer, prompt_len))
+
+    if isinstance(self.stop, list) and self.stop:
+      criteria.append(StopOnStrings(self.tokenizer, self.stop, prompt_len))
+
+    if criteria:
+      gen_kwargs["stopping_criteria"] = StoppingCriteriaList(criteria)
+    return gen_kwargs
+
+  def _count_generated(self, output_ids: List[int]) -> int:
+    """Count generated tokens up to the first eos, or the padding of a finished batch row.
+    Args:
+      output_ids (List[int]): ids generated after the prompt.
+    Returns:
+      int: number of generated tokens.
+    """
+    eos_ids = set(self._eos_token_ids())
+    pad_token_id = self._pad_token_id()
+    for i, token in enumerate(output_ids):
+      if token in eos_ids:
+        return i + 1
+      if token == pad_token_id:
+        return i
+    return len(output_ids)
+
+  def _record_budget(self, n_tokens: int, max_new_tokens: int) -> None:
+    """Track the generated tokens against the budget.
+    Args:
+      n_tokens (int): tokens generated by a call.
+      max_new_tokens (int): budget of the call.
+    """
+    with self._stats_lock:
+      self.budget_stats["calls"] += 1
+      self.budget_stats["tokens"] += n_tokens
+      self.budget_stats["max_tokens"] = max(self.budget_stats["max_tokens"], n_tokens)
+      if n_tokens >= max_new_tokens:
+        self.budget_stats["budget_hits"] += 1
+    if n_tokens >= max_new_tokens:
+      print(f"{self.model_name}: generation used the whole budget of {max_new_tokens} tokens")
+
+  def budget_report(self) -> Dict[str, Any]:
+    """Summarize the generated tokens against the budget.
+    Returns:
+      Dict[str, Any]: budget, calls, mean and max generated tokens and rate of calls hitting the budget.
+    """
+    with self._stats_lock:
+      stats = dict(self.budget_stats)
+    calls = stats["calls"]
+    return {
+      "max_new_tokens": self.max_new_tokens,
+      "calls": calls,
+      "mean_tokens": stats["tokens"] / calls if calls > 0 else 0.0,
+      "max_tokens": stats["max_tokens"],
+      "budget_hit_rate": stats["budget_hits"] / calls if calls > 0 else 0.0
+    }
 
-    with torch.no_grad():
-      generated_ids = self.model.generate(**model_inputs, max_new_tokens=max_new_tokens, pad_token_id=pad_token_id).cpu()
+  @staticmethod
+  def _model_variant(model_loader: ModelLoader) -> Dict[str, Any]:
+    """Describe how the weights of a model were loaded.
+    Args:
+      model_loader (ModelLoader): loader of the model.
+    Returns:
+      Dict[str, Any]: load strategy, dtype and quantization config.
+    """
+    model = model_loader.model
+    quantization = getattr(model.config, "quantization_config", None)
+    if quantization is not None and not isinstance(quantization, dict):
+      quantization = quantization.to_dict()
+    return {"load_strategy": model_loader.load_strategy, "dtype": str(model.dtype), "quantization": quantization}
+
+  def _system_prefix_ids(self) -> torch.Tensor:
+    """Get the tokens every prompt rendered with the current system prompt starts with.
+    Returns:
+      torch.Tensor: prefix token ids with shape (1, prefix_len).
+    """
+    # Render two different prompts, the shared part is the static prefix
+    text_a = self.prepare_text_fun("a", self.tokenizer, self._build_messages())
+    text_b = self.prepare_text_fun("b", self.tokenizer, self._build_messages())
+    with self.tokenizer_lock:
+      ids_a = self.tokenizer([text_a], return_tensors="pt").input_ids
+      ids_b = self.tokenizer([text_b], return_tensors="pt").input_ids
+
+    common = 0
+    for tok_a, tok_b in zip(ids_a[0].tolist(), ids_b[0].tolist()):
+      if tok_a != tok_b:
+        break
+      common += 1
+    # Drop the last shared token since it could merge with what follows
+    return ids_a[:, :max(common - 1, 0)]
+
+  def _prefix_entry(self) -> Optional[Tuple[torch.Tensor, Any]]:
+    """Get the ids and cached key/values of the system prompt prefix, computing them once.
+    Returns:
+      Optional[Tuple[torch.Tensor, Any]]: prefix ids and past key values, None if there is no prefix.
+    """
+    key = PREFIX_CACHE.make_key(self.model_id, self.device, self.system_prompt, self.model_variant)
+    entry = PREFIX_CACHE.get(key)
+    if entry is None:
+      prefix_ids = self._system_prefix_ids().to(self.device)
+      if prefix_ids.shape[1] == 0:
+        return None
+      with self.model_lock, torch.no_grad():
+        past_key_values = self.model(input_ids=prefix_ids, use_cache=True).past_key_values
+      PREFIX_CACHE.put(key, prefix_ids, past_key_values)
+      entry = (prefix_ids, past_key_values)
+    return entry
+
+  @staticmethod
+  def _share_past_key_values(past_key_values: Any, batch_size: int = 1) -> Any:
+    """Get key/values generation can extend without changing the cached ones.
+    Dynamic caches grow by concatenation, so new layers pointing to the cached tensors are enough,
+    other caches are written in place and are copied.
+    Args:
+      past_key_values (Any): cached key/values of a single prefix.
+      batch_size (int): rows the prefix is shared by.
+    Returns:
+      Any: key/values to pass to the model.
+    """
+    if isinstance(past_key_values, DynamicCache) and hasattr(past_key_values, "layers"):
+      shared = copy.copy(past_key_values)
+      shared.layers = []
+      for layer in past_key_values.layers:
+        layer = copy.copy(layer)
+        if batch_size > 1 and layer.is_initialized:
+          layer.keys = layer.keys.expand(batch_size, -1, -1, -1)
+          layer.values = layer.values.expand(batch_size, -1, -1, -1)
+        shared.layers.append(layer)
+      return shared
+    past_key_values = copy.deepcopy(past_key_values)
+    if batch_size > 1:
+      past_key_values.batch_repeat_interleave(batch_size)
+    return past_key_values
+
+  def _prefix_past_key_values(self, input_ids: torch.Tensor) -> Any:
+    """Get the cached key/values of the system prompt prefix for a single prompt.
+    Args:
+      input_ids (torch.Tensor): full input ids of the current prompt.
+    Returns:
+      Any: past key values to pass to generate, None if the prefix can't be used.
+    """
+    entry = self._prefix_entry()
+    if entry is None:
+      return None
+    prefix_ids, past_key_values = entry
+
+    # The prompt must strictly extend the cached prefix
+    prefix_len = prefix_ids.shape[1]
+    if input_ids.shape[1] <= prefix_len or not torch.equal(input_ids[0, :prefix_len], prefix_ids[0]):
+      return None
+    return self._share_past_key_values(past_key_values)
+
+  def _tokenize_prefixed_batch(self, texts: List[str]) -> Optional[Tuple[Any, Any]]:
+    """Tokenize a batch of prompts reusing the cached system prompt prefix.
+    The prefix is shared by every row and only the rest of the prompts is left padded,
+    so the padding sits between prefix and suffix and is masked out.
+    Args:
+      texts (List[str]): prepared prompts.
+    Returns:
+      Optional[Tuple[Any, Any]]: model inputs with prefix and padded suffixes, and the past key values of the prefix
+        expanded to the batch, None if some prompt does not extend the prefix.
+    """
+    entry = self._prefix_entry()
+    if entry is None:
+      return None
+    prefix_ids, past_key_values = entry
+    prefix = prefix_ids[0].tolist()
+    prefix_len = len(prefix)
+
+    with self.tokenizer_lock:
+      rows = self.tokenizer(texts)["input_ids"]
+    if any(len(ids) <= prefix_len or ids[:prefix_len] != prefix for ids in rows):
+      return None
+
+    width = max(len(ids) for ids in rows) - prefix_len
+    pad_token_id = self._pad_token_id()
+    input_ids, attention_mask = [], []
+    for ids in rows:
+      n_pad = width - (len(ids) - prefix_len)
+      input_ids.append(prefix + [pad_token_id] * n_pad + ids[prefix_len:])
+      attention_mask.append([1] * prefix_len + [0] * n_pad + [1] * (len(ids) - prefix_len))
+    model_inputs = BatchEncoding({"input_ids": torch.tensor(input_ids), "attention_mask": torch.tensor(attention_mask)})
+    return model_inputs.to(self.device), self._share_past_key_values(past_key_values, len(texts))
+
+  def _render(self, prompt: str, history: Any = None) -> str:
+    """Render a single prompt with the chat template.
+    Args:
+      prompt (str): user prompt after which the model generates.
+      history (Any): previous exchanges to add after the system prompt.
+    Returns:
+      str: text passed to the tokenizer.
+    """
+    # Reset conversation
+    self.messages: List[Dict[str, str]] = self._build_messages(history)
+    return self.prepare_text(prompt)
+
+  def _generation_params(self, max_new_tokens: int) -> Dict[str, Any]:
+    """Get every generation setting that changes the response, besides model and prompt.
+    Args:
+      max_new_tokens (int): generation budget.
+    Returns:
+      Dict[str, Any]: json serializable settings.
+    """
+    config = self.model.generation_config
+    return {
+      "model": self.model_variant,
+      "max_new_tokens": max_new_tokens,
+      "stop": self.stop,
+      "json_schema": self.json_schema,
+      "decoding": {name: getattr(config, name, None) for name in DECODING_PARAMS}
+    }
+
+  def _cache_keys(self, texts: List[str], max_new_tokens: int) -> List[str]:
+    """Get the response cache keys of rendered prompts.
+    Args:
+      texts (List[str]): prompts rendered with the chat template.
+      max_new_tokens (int): generation budget.
+    Returns:
+      List[str]: keys in the same order of the texts.
+    """
+    params = self._generation_params(max_new_tokens)
+    return [self.response_cache.make_key(self.model_id, text, params) for text in texts]
+
+  def _prepare_inputs(self, text: str) -> Tuple[Any, Dict[str, Any]]:
+    """Build model inputs and the extra generate arguments for a single prompt.
+    Args:
+      text (str): prompt rendered with the chat template.
+    Returns:
+      Tuple[Any, Dict[str, Any]]: model inputs and extra generate kwargs.
+    """
+    with self.tokenizer_lock:
+      model_inputs = self.tokenizer([text], return_tensors="pt").to(self.device)
+
+    gen_kwargs = self._decoding_kwargs(model_inputs.input_ids.shape[1])
+    if self.use_prefix_cache:
+      past_key_values = self._prefix_past_key_values(model_inputs.input_ids)
+      if past_key_values is not None:
+        gen_kwargs["past_key_values"] = past_key_values
+    return model_inputs, gen_kwargs
+
+  def generate(self, prompt: str, history: Any = None, max_new_tokens: Optional[int] = None) -> str:
+    """Generate output given user prompt.
+    Args:
+      prompt (str): user prompt after which the model generates.
+      max_new_tokens (Optional[int]): maximum number of tokens to use to generate, the task budget if None.
+    Returns:
+      str: generated response.
+    """
+    if max_new_tokens is None:
+      max_new_tokens = self.max_new_tokens
+    if self.scheduler is not None and not self.scheduler.is_worker():
+      return self.scheduler.generate(self, prompt, history, max_new_tokens)
+    start = time.perf_counter()
+    text = self._render(prompt, history)
+    if self.response_cache is not None:
+      cache_key = self._cache_keys([text], max_new_tokens)[0]
+      cached = self.response_cache.get(cache_key)
+      if cached is not None:
+        self.last_usage = [make_usage(latency=time.perf_counter() - start, cached=True)]
+        return cached
+    model_inputs, gen_kwargs = self._prepare_inputs(text)
+
+    with self.model_lock, torch.no_grad():
+      generated_ids = self.model.generate(**model_inputs, max_new_tokens=max_new_tokens, pad_token_id=self._pad_token_id(), **gen_kwargs).cpu()
 
     # Decode ids
     output_ids = generated_ids[0][len(model_inputs.input_ids[0]) :].tolist()
     content = self.tokenizer.decode(output_ids, skip_special_tokens=True)
+    n_generated = self._count_generated(output_ids)
+    self._record_budget(n_generated, max_new_tokens)
+    self.last_usage = [make_usage(model_inputs.input_ids.shape[1], n_generated, time.perf_counter() - start)]
+    if self.response_cache is not None:
+      self.response_cache.put(cache_key, content)
 
     return content
 
+  def generate_stream(self, prompt: str, history: Any = None, max_new_tokens: Optional[int] = None) -> Iterator[str]:
+    """Generate output given user prompt yielding text as soon as it is decoded.
+    The model is held for the whole generation, so scheduled batches wait for it to end.
+    Args:
+      prompt (str): user prompt after which the model generates.
+      history (Any): previous exchanges to add after the system prompt.
+      max_new_tokens (Optional[int]): maximum number of tokens to use to generate, the task budget if None.
+    Returns:
+      Iterator[str]: chunks of the generated response.
+    """
+    if max_new_tokens is None:
+      max_new_tokens = self.max_new_tokens
+    start = time.perf_counter()
+    model_inputs, gen_kwargs = self._prepare_inputs(self._render(prompt, history))
+    streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+    errors: List[Exception] = []
+
+    def run() -> None:
+      """Run generation in background, the streamer is fed token by token."""
+      try:
+        with self.model_lock, torch.no_grad():
+          generated_ids = self.model.generate(**model_inputs, max_new_tokens=max_new_tokens, pad_token_id=self._pad_token_id(), streamer=streamer, **gen_kwargs)
+        output_ids = generated_ids[0][model_inputs.input_ids.shape[1]:].tolist()
+        n_generated = self._count_generated(output_ids)
+        self._record_budget(n_generated, max_new_tokens)
+        self.last_usage = [make_usage(model_inputs.input_ids.shape[1], n_generated, time.perf_counter() - start)]
+      except Exception as e:
+        errors.append(e)
+        # Unblock the consumer
+        streamer.end()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    for chunk in streamer:
+      if chunk:
+        yield chunk
+    thread.join()
+
+    if errors:
+      raise errors[0]
+
+  def _length_buckets(self, texts: List[str], max_batch_size: int) -> List[List[int]]:
+    """Group prompts of similar token length to reduce padding waste.
+    Args:
+      texts (List[str]): prepared prompts.
+      max_batch_size (int): maximum size of a single bucket.
+    Returns:
+      List[List[int]]: indices of the texts in each bucket.
+    """
+    with self.tokenizer_lock:
+      lengths = [len(ids) for ids in self.tokenizer(texts, add_special_tokens=False)["input_ids"]]
+    order = sorted(range(len(texts)), key=lambda i: lengths[i])
+    return [order[i:i + max_batch_size] for i in range(0, len(order), max_batch_size)]
+
+  def _tokenize_batch(self, texts: List[str]) -> Any:
+    """Tokenize a batch of prompts with left padding so generation starts aligned.
+    Args:
+      texts (List[str]): prepared prompts.
+    Returns:
+      Any: padded model inputs on the model device.
+    """
+    with self.tokenizer_lock:
+      padding_side = self.tokenizer.padding_side
+      self.tokenizer.padding_side = "left"
+      if self.tokenizer.pad_token_id is None:
+        self.tokenizer.pad_token = self.tokenizer.eos_token
+      try:
+        model_inputs = self.tokenizer(texts, return_tensors="pt", padding=True)
+      finally:
+        self.tokenizer.padding_side = padding_side
+    return model_inputs.to(self.device)
+
+  def generate_batch(
+      self,
+      prompts: List[str],
+      histories: Optional[List[Any]] = None,
+      max_new_tokens: Optional[int] = None,
+      max_batch_size: Optional[int] = None
+    ) -> List[str]:
+    """Generate outputs for many prompts sharing the same system prompt.
+    Args:
+      prompts (List[str]): user prompts after which the model generates.
+      histories (Optional[List[Any]]): optional history for every prompt.
+      max_new_tokens (Optional[int]): maximum number of tokens to use to generate, the task budget if None.
+      max_batch_size (Optional[int]): override of the maximum batch size.
+    Returns:
+      List[str]: generated responses in the same order of the prompts.
+    """
+    if histories is None:
+      histories = [None] * len(prompts)
+    if len(histories) != len(prompts):
+      raise ValueError("prompts and histories must have the same length")
+    if max_new_tokens is None:
+      max_new_tokens = self.max_new_tokens
+    if self.scheduler is not None and not self.scheduler.is_worker():
+      return self.scheduler.generate_batch(self, prompts, histories, max_new_tokens, max_batch_size)
+
+    batch = self.start_batch(prompts, histories, max_new_tokens)
+    results = self.generate_texts([batch.texts[idx] for idx in batch.pending], max_new_tokens, max_batch_size)
+    return self.finish_batch(batch, results)
+
+  def start_batch(self, prompts: List[str], histories: List[Any], max_new_tokens: int) -> PendingBatch:
+    """Render the prompts of a batched call and answer the ones in the response cache.
+    Args:
+      prompts (List[str]): user prompts after which the model generates.
+      histories (List[Any]): history of every prompt.
+      max_new_tokens (int): generation budget.
+    Returns:
+      PendingBatch: rendered prompts, with the indices still to generate.
+    """
+    texts = [
+      self.prepare_text_fun(prompt, self.tokenizer, self._build_messages(history))
+      for prompt, history in zip(prompts, histories)
+    ]
+    batch = PendingBatch(texts, max_new_tokens)
+    if self.response_cache is not None:
+      start = time.perf_counter()
+      batch.cache_keys = self._cache_keys(texts, max_new_tokens)
+      cached = self.response_cache.get_many(batch.cache_keys)
+      batch.pending = [idx for idx in batch.pending if batch.cache_keys[idx] not in cached]
+      lookup_time = time.perf_counter() - start
+      for idx in range(len(texts)):
+        batch.outputs[idx] = cached.get(batch.cache_keys[idx], "")
+        batch.usage[idx]["latency"] = lookup_time
+    return batch
+
+  def generate_texts(self, texts: List[str], max_new_tokens: int, max_batch_size: Optional[int] = None) -> List[Tuple[str, Dict[str, Any]]]:
+    """Run the model on rendered prompts in length buckets, without touching the cache or the stats of the task.
+    Args:
+      texts (List[str]): prompts rendered with the chat template.
+      max_new_tokens (int): generation budget.
+      max_batch_size (Optional[int]): override of the maximum batch size.
+    Returns:
+      List[Tuple[str, Dict[str, Any]]]: response and usage of every text, in order.
+    """
+    if max_batch_size is None:
+      max_batch_size = self.max_batch_size
+    results: List[Any] = [None] * len(texts)
+    if not texts:
+      return results
+
+    for bucket in self._length_buckets(texts, max_batch_size):
+      bucket_texts = [texts[i] for i in bucket]
+      prefixed = self._tokenize_prefixed_batch(bucket_texts) if self.use_prefix_cache else None
+      if prefixed is not None:
+        model_inputs, past_key_values = prefixed
+      else:
+        model_inputs, past_key_values = self._tokenize_batch(bucket_texts), None
+      # With left padding every row has the prompt ending at the same position
+      input_len = model_inputs.input_ids.shape[1]
+      gen_kwargs = self._decoding_kwargs(input_len)
+      if past_key_values is not None:
+        gen_kwargs["past_key_values"] = past_key_values
+
+      start = time.perf_counter()
+      with self.model_lock, torch.no_grad():
+        generated_ids = self.model.generate(**model_inputs, max_new_tokens=max_new_tokens, pad_token_id=self._pad_token_id(), **gen_kwargs).cpu()
+      # Every row of the bucket waits for the whole bucket
+      bucket_time = time.perf_counter() - start
+      prompt_lens = model_inputs.attention_mask.sum(dim=1).tolist()
+
+      for row, idx in enumerate(bucket):
+        output_ids = generated_ids[row][input_len:].tolist()
+        content = self.tokenizer.decode(output_ids, skip_special_tokens=True)
+        usage = make_usage(int(prompt_lens[row]), self._count_generated(output_ids), bucket_time)
+        results[idx] = (content, usage)
+    return results
+
+  def finish_batch(self, batch: PendingBatch, results: List[Tuple[str, Dict[str, Any]]]) -> List[str]:
+    """Fill a batch with the generated responses, recording budget, usage and cache of the task.
+    Args:
+      batch (PendingBatch): batch started by start_batch.
+      results (List[Tuple[str, Dict[str, Any]]]): generate_texts results of the pending prompts, in order.
+    Returns:
+      List[str]: responses in the same order of the prompts.
+    """
+    for idx, (content, usage) in zip(batch.pending, results):
+      batch.outputs[idx] = content
+      batch.usage[idx] = usage
+      self._record_budget(usage["generated_tokens"], batch.max_new_tokens)
+    self.last_usage = batch.usage
+    if self.response_cache is not None and batch.pending:
+      self.response_cache.put_many({batch.cache_keys[idx]: batch.outputs[idx] for idx in batch.pending})
+    return batch.outputs
+
+  def _label_token_ids(self, labels: List[str]) -> List[List[int]]:
+    """Get the tokens of every label, which must differ to tell the labels apart.
+    Args:
+      labels (List[str]): candidate labels.
+    Returns:
+      List[List[int]]: token ids of each label.
+    """
+    label_ids = []
+    for label in labels:
+      with self.tokenizer_lock:
+        ids = self.tokenizer.encode(label, add_special_tokens=False)
+      if not ids:
+        raise ValueError(f"Label '{label}' is tokenized to an empty sequence.")
+      label_ids.append(ids)
+    if len(set(map(tuple, label_ids))) != len(label_ids):
+      raise ValueError(f"Labels {labels} have the same tokens for model '{self.model_name}'.")
+    return label_ids
+
+  def _continuation_log_probs(
+      self,
+      past_key_values: Any,
+      attention_mask: torch.Tensor,
+      last_positions: torch.Tensor,
+      label_ids: List[int]
+    ) -> torch.Tensor:
+    """Get the log probability of the tokens of a label after its first one, for every row of a batch.
+    Args:
+      past_key_values (Any): key/values of the prompts, left untouched.
+      attention_mask (torch.Tensor): attention mask of the prompts.
+      last_positions (torch.Tensor): position of the last token of every prompt.
+      label_ids (List[int]): tokens of the label, at least two.
+    Returns:
+      torch.Tensor: summed log probabilities with shape (batch,).
+    """
+    batch_size = attention_mask.shape[0]
+    n_inputs = len(label_ids) - 1
+    input_ids = torch.tensor([label_ids[:-1]] * batch_size, device=attention_mask.device)
+    mask = torch.cat([attention_mask, torch.ones_like(input_ids)], dim=-1)
+    positions = last_positions[:, None] + torch.arange(1, n_inputs + 1, device=attention_mask.device)[None, :]
+    with self.model_lock, torch.no_grad():
+      logits = self.model(
+        input_ids=input_ids,
+        attention_mask=mask,
+        position_ids=positions,
+        past_key_values=self._share_past_key_values(past_key_values)
+      ).logits
+    log_probs = torch.log_softmax(logits.float(), dim=-1)
+    targets = torch.tensor(label_ids[1:], device=log_probs.device)
+    return log_probs[:, torch.arange(n_inputs), targets].sum(dim=-1)
+
+  def score_labels(
+      self,
+      prompts: List[str],
+      labels: List[str],
+      histories: Optional[List[Any]] = None,
+      max_batch_size: Optional[int] = None
+    ) -> List[Dict[str, float]]:
+    """Score a closed set of labels by the probability of their whole token sequence.
+    A forward pass per batch scores the first token of every label, labels of more tokens
+    take another pass each over the key/values of the prompts.
+    Args:
+      prompts (List[str]): user prompts to classify.
+      labels (List[str]): candidate labels.
+      histories (Optional[List[Any]]): optional history for every prompt.
+      max_batch_size (Optional[int]): override of the maximum batch size.
+    Returns:
+      List[Dict[str, float]]: probability of every label for each prompt, normalized over the labels.
+        The usage of every prompt is left in last_usage.
+    """
+    if self.scheduler is not None and not self.scheduler.is_worker():
+      return self.scheduler.score_labels(self, prompts, labels, histories)
+    if histories is None:
+      histories = [None] * len(prompts)
+    if max_batch_size is None:
+      max_batch_size = self.max_batch_size
+    label_ids = self._label_token_ids(labels)
+    first_ids = [ids[0] for ids in label_ids]
+
+    texts = [
+      self.prepare_text_fun(prompt, self.tokenizer, self._build_messages(history))
+      for prompt, history in zip(prompts, histories)
+    ]
+
+    scores: List[Dict[str, float]] = [{} for _ in texts]
+    usage: List[Dict[str, Any]] = [make_usage() for _ in texts]
+    for bucket in self._length_buckets(texts, max_batch_size):
+      bucket_texts = [texts[i] for i in bucket]
+      prefixed = self._tokenize_prefixed_batch(bucket_texts) if self.use_prefix_cache else None
+      if prefixed is not None:
+        model_inputs, past_key_values = prefixed
+      else:
+        model_inputs, past_key_values = self._tokenize_batch(bucket_texts), None
+      # Positions must skip the padding like generate does
+      position_ids = (model_inputs.attention_mask.cumsum(-1) - 1).clamp(min=0)
+      # Only the suffix after the cached prefix runs through the model
+      start = past_key_values.get_seq_length() if past_key_values is not None else 0
+
+      bucket_start = time.perf_counter()
+      with self.model_lock, torch.no_grad():
+        output = self.model(
+          input_ids=model_inputs.input_ids[:, start:],
+          attention_mask=model_inputs.attention_mask,
+          position_ids=position_ids[:, start:],
+          past_key_values=past_key_values,
+          use_cache=True
+        )
+
+      # Log probability of every label: first token, then the rest over the key/values of the prompts
+      log_probs = torch.log_softmax(output.logits[:, -1, :].float(), dim=-1)
+      label_log_probs = log_probs[:, first_ids]
+      for j, ids in enumerate(label_ids):
+        if len(ids) > 1:
+          label_log_probs[:, j] += self._continuation_log_probs(output.past_key_values, model_inputs.attention_mask, position_ids[:, -1], ids)
 
+      probs = torch.softmax(label_log_probs, dim=-1).cpu()
+      # Every row of the bucket waits for the whole bucket, nothing is generated
+      bucket_time = time.perf_counter() - bucket_start
+      prompt_lens = model_inputs.attention_mask.sum(dim=1).tolist()
+      for row, idx in enumerate(bucket):
+        scores[idx] = {label: float(p) for label, p in zip(labels, probs[row])}
+        usage[idx] = make_usage(int(prompt_lens[row]), 0, bucket_time)
 
+    self.last_usage = usage
+    return scores
@@ -0,0 +1,142 @@
+import gc
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+import torch
+from models.cache import PREFIX_CACHE
+from models.model import ModelLoader
+
+# Model name, device and requested load strategy
+PoolKey = Tuple[str, str, Optional[str]]
+
+
+class _PoolEntry:
+  """Loader shared by the pool with the number of its users."""
+
+  def __init__(self) -> None:
+    self.loader: Optional[ModelLoader] = None
+    self.refs = 0
+    self.size = 0
+    # Held while loading so concurrent requests of the same model wait for it
+    self.lock = threading.Lock()
+
+
+class ModelPool:
+  """Process-wide pool sharing model loaders between agents with reference counting."""
+
+  def __init__(self, memory_budget: Optional[int] = None) -> None:
+    """Initialize the pool.
+    Args:
+      memory_budget (Optional[int]): bytes of loaded weights after which unused loaders are
+        evicted, least recently used first. Defaults to MODEL_POOL_MEMORY_GB, no limit if unset.
+    """
+    self.memory_budget = memory_budget
+    self._entries: "OrderedDict[PoolKey, _PoolEntry]" = OrderedDict()
+    self._lock = threading.Lock()
+
+  def _budget(self) -> Optional[int]:
+    """Get the memory budget in bytes, read from env when not given."""
+    if self.memory_budget is not None:
+      return self.memory_budget
+    value = os.getenv("MODEL_POOL_MEMORY_GB")
+    return int(float(value) * 1024 ** 3) if value else None
+
+  def acquire(self, model_name: str, device: str = "cpu", strategy: Optional[str] = None) -> ModelLoader:
+    """Get a shared loader, loading the model if nobody did yet.
+    Args:
+      model_name (str): name of the model to load.
+      device (str): device where to load the model.
+      strategy (Optional[str]): load strategy, None for the registry default.
+    Returns:
+      ModelLoader: shared loader, to give back with release.
+    """
+    key = (model_name, device, strategy)
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        entry = _PoolEntry()
+        self._entries[key] = entry
+      entry.refs += 1
+      self._entries.move_to_end(key)
+
+    try:
+      with entry.lock:
+        if entry.loader is None:
+          loader = ModelLoader(model_name, device, strategy)
+          entry.size = loader.model.get_memory_footprint()
+          entry.loader = loader
+    except Exception:
+      with self._lock:
+        entry.refs -= 1
+        if entry.refs == 0 and entry.loader is None:
+          self._entries.pop(key, None)
+      raise
+
+    with self._lock:
+      self._evict()
+    return entry.loader
+
+  def release(self, loader: ModelLoader) -> None:
+    """Give back a loader obtained with acquire.
+    Args:
+      loader (ModelLoader): loader to release.
+    """
+    with self._lock:
+      for entry in self._entries.values():
+        if entry.loader is loader:
+          entry.refs = max(entry.refs - 1, 0)
+          break
+      else:
+        raise ValueError(f"Loader of '{loader.model_name}' does not belong to the pool.")
+      self._evict()
+
+  def _evict(self, budget: Optional[int] = None) -> None:
+    """Drop unused loaders, least recently used first, until the budget is met. Lock must be held.
+    Args:
+      budget (Optional[int]): budget in bytes, the pool one if None.
+    """
+    if budget is None:
+      budget = self._budget()
+    if budget is None:
+      return
+
+    total = sum(entry.size for entry in self._entries.values() if entry.loader is not None)
+    evicted = False
+    for key in list(self._entries.keys()):
+      if total <= budget:
+        break
+      entry = self._entries[key]
+      if entry.refs == 0 and entry.loader is not None:
+        print(f"Evicting model {key[0]} from the pool.")
+        total -= entry.size
+        del self._entries[key]
+        # Cached prefixes hold key/values on the device of the model
+        PREFIX_CACHE.drop_model(entry.loader.model_id, entry.loader.model.device)
+        evicted = True
+
+    if evicted:
+      gc.collect()
+      if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+  def evict_unused(self) -> None:
+    """Drop every loader nobody is using."""
+    with self._lock:
+      self._evict(budget=0)
+
+  def stats(self) -> Dict[str, Any]:
+    """Get the loaded models with their users and size.
+    Returns:
+      Dict[str, Any]: pool usage.
+    """
+    with self._lock:
+      models = [
+        {"model": key[0], "device": key[1], "strategy": key[2], "refs": entry.refs, "bytes": entry.size}
+        for key, entry in self._entries.items() if entry.loader is not None
+      ]
+    return {"models": models, "bytes": sum(m["bytes"] for m in models), "budget": self._budget()}
+
+
+# Shared by every agent in the process
+MODEL_POOL = ModelPool()
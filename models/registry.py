@@ -1,40 +1,134 @@
-from typing import Any, Callable, Dict, Tuple
-from functools import partial
+from typing import Any, Callable, Dict, List, Tuple
+import os
+import torch
 from transformers import AutoModelForCausalLM, BitsAndBytesConfig
 
 from .utils import hf_prepare_text, gemma_prepare_text
 
-bnb_4bit = BitsAndBytesConfig(
+MODELS_DIR = os.path.dirname(os.path.abspath(__file__))
+# Pre-quantized exports, one folder per model id with "/" replaced by "--"
+QUANTIZED_DIR = os.path.join(MODELS_DIR, "quantized")
+
+
+def load_bnb_4bit(model_id: str, device_map: str) -> Any:
+  """Load the model in 4 bit with bitsandbytes, requires cuda.
+  Args:
+    model_id (str): hugging face model id.
+    device_map (str): device map passed to from_pretrained.
+  Returns:
+    Any: loaded model.
+  """
+  bnb_4bit = BitsAndBytesConfig(
     load_in_4bit=True
-)
+  )
+  return AutoModelForCausalLM.from_pretrained(model_id, trust_remote_code=True, dtype="auto", device_map=device_map, quantization_config=bnb_4bit)
+
+
+def load_bf16(model_id: str, device_map: str) -> Any:
+  """Load the model weights in bfloat16.
+  Args:
+    model_id (str): hugging face model id.
+    device_map (str): device map passed to from_pretrained.
+  Returns:
+    Any: loaded model.
+  """
+  return AutoModelForCausalLM.from_pretrained(model_id, trust_remote_code=True, dtype=torch.bfloat16, device_map=device_map)
+
+
+def _quantize_linear_int8(linear: torch.nn.Linear) -> torch.nn.Module:
+  """Quantize a linear layer to int8, from a float32 copy of its weights.
+  Args:
+    linear (torch.nn.Linear): layer in any floating dtype, left untouched since its weights may be tied.
+  Returns:
+    torch.nn.Module: dynamically quantized layer.
+  """
+  fp32 = torch.nn.Linear(linear.in_features, linear.out_features, bias=linear.bias is not None, device="meta")
+  fp32.weight = torch.nn.Parameter(linear.weight.detach().float(), requires_grad=False)
+  if linear.bias is not None:
+    fp32.bias = torch.nn.Parameter(linear.bias.detach().float(), requires_grad=False)
+  fp32.qconfig = torch.ao.quantization.default_dynamic_qconfig
+  return torch.ao.nn.quantized.dynamic.Linear.from_float(fp32)
+
+
+def load_int8_dynamic(model_id: str, device_map: str) -> Any:
+  """Load the model on cpu and quantize its linear layers to int8 with torch dynamic quantization.
+  The weights are loaded in bfloat16 and every linear layer goes through float32 on its own, so the
+  peak memory is about the bfloat16 model, twice the int8 one, instead of the float32 model.
+  Args:
+    model_id (str): hugging face model id.
+    device_map (str): ignored, dynamic quantization only runs on cpu.
+  Returns:
+    Any: loaded model.
+  """
+  model = AutoModelForCausalLM.from_pretrained(model_id, trust_remote_code=True, dtype=torch.bfloat16, device_map="cpu", low_cpu_mem_usage=True)
+  for parent in list(model.modules()):
+    for name, child in list(parent.named_children()):
+      if type(child) is torch.nn.Linear:
+        # Replacing the layer frees its bfloat16 weights before the next one is converted
+        setattr(parent, name, _quantize_linear_int8(child))
+  # Quantized layers take float32 activations, the rest of the model is small next to them
+  return model.float()
+
+
+def quantized_path(model_id: str) -> str:
+  """Get the folder where the pre-quantized export of a model is expected.
+  Args:
+    model_id (str): hugging face model id.
+  Returns:
+    str: folder of the export.
+  """
+  return os.path.join(QUANTIZED_DIR, model_id.replace("/", "--"))
+
+
+def load_prequantized(model_id: str, device_map: str) -> Any:
+  """Load pre-quantized safetensors, the quantization config is read from the export.
+  Args:
+    model_id (str): hugging face model id.
+    device_map (str): device map passed to from_pretrained.
+  Returns:
+    Any: loaded model.
+  """
+  path = quantized_path(model_id)
+  if not os.path.isdir(path):
+    raise FileNotFoundError(f"No pre-quantized export of '{model_id}' in {path}")
+  return AutoModelForCausalLM.from_pretrained(path, trust_remote_code=True, dtype="auto", device_map=device_map)
+
+
+LOAD_STRATEGIES: Dict[str, Callable[[str, str], Any]] = {
+  "bnb_4bit": load_bnb_4bit,
+  "bf16": load_bf16,
+  "int8_dynamic": load_int8_dynamic,
+  "prequantized": load_prequantized
+}
 
 # To access llama and gemma, must accept terms of service at the following pages:
 # https://huggingface.co/google/gemma-2-9b-it
 # https://huggingface.co/meta-llama/Llama-3.1-8B-Instruct
 
 
-# The tuple contains the model name, a partial function with the model specific 
-# arguments, the method to prepare the input text
-MODELS: Dict[str, Tuple[str, Callable[..., Any], Callable[..., Any]]] = {
+# The tuple contains the model name, the load strategies to try in order for every
+# device kind, the method to prepare the input text.
+# A missing pre-quantized export makes the loader move to the next strategy.
+MODELS: Dict[str, Tuple[str, Dict[str, List[str]], Callable[..., Any]]] = {
     "qwen3": (
       "Qwen/Qwen3-4B-Instruct-2507",
-      partial(AutoModelForCausalLM.from_pretrained, trust_remote_code=True, quantization_config=bnb_4bit),
+      {"cuda": ["bnb_4bit"], "cpu": ["prequantized", "bf16"]},
       hf_prepare_text
     ),
     "mistral": (
       "mistralai/Mistral-7B-Instruct-v0.3",
-      partial(AutoModelForCausalLM.from_pretrained, trust_remote_code=True, quantization_config=bnb_4bit),
+      {"cuda": ["bnb_4bit"], "cpu": ["prequantized", "int8_dynamic"]},
       hf_prepare_text
     ),
     # Gated models
     "llama3": (
       "meta-llama/Meta-Llama-3.1-8B-Instruct",
-      partial(AutoModelForCausalLM.from_pretrained, trust_remote_code=True, quantization_config=bnb_4bit),
+      {"cuda": ["bnb_4bit"], "cpu": ["prequantized", "int8_dynamic"]},
       hf_prepare_text
     ),
     "gemma": (
       "google/gemma-2-9b-it",
-      partial(AutoModelForCausalLM.from_pretrained, trust_remote_code=True, quantization_config=bnb_4bit),
+      {"cuda": ["bnb_4bit"], "cpu": ["prequantized", "int8_dynamic"]},
       gemma_prepare_text
     )
-}
\ No newline at end of file
+}
@@ -0,0 +1,135 @@
+import torch
+from typing import Any, Dict, List, Optional
+from transformers import PreTrainedTokenizer, StoppingCriteria
+
+
+class StopOnStrings(StoppingCriteria):
+  """Stop generating once the output contains one of the stop strings after some text.
+  A stop string ending in the last token spans at most as many tokens as it has chars, so only a
+  trailing window of tokens is decoded at every step.
+  """
+
+  def __init__(self, tokenizer: PreTrainedTokenizer, stop_strings: List[str], prompt_len: int) -> None:
+    """Initialize the criteria.
+    Args:
+      tokenizer (PreTrainedTokenizer): tokenizer to decode the generated text.
+      stop_strings (List[str]): strings ending the output, e.g. ")" for dm actions.
+      prompt_len (int): length of the (padded) prompt in the input ids.
+    """
+    self.tokenizer = tokenizer
+    self.stop_strings = stop_strings
+    self.prompt_len = prompt_len
+    # One more token than the longest stop, the first token of a window may lose its leading space
+    self.window = max((len(stop) for stop in stop_strings), default=0) + 1
+    # Position of the first token with some text for every row, None while the output is blank
+    self._content_start: Dict[int, Optional[int]] = {}
+
+  def _find_content_start(self, row: List[int]) -> Optional[int]:
+    """Get the position of the first token after which the output is not blank."""
+    if not self.tokenizer.decode(row[self.prompt_len:], skip_special_tokens=True).strip():
+      return None
+    for end in range(self.prompt_len + 1, len(row) + 1):
+      if self.tokenizer.decode(row[self.prompt_len:end], skip_special_tokens=True).strip():
+        return end - 1
+    return None
+
+  def _is_done(self, idx: int, row: List[int]) -> bool:
+    """Check if a stop string appears in the last window of a row, after some text."""
+    start = self._content_start.get(idx)
+    if start is None:
+      # Leading whitespace is ignored so "\n" does not stop an empty output
+      start = self._find_content_start(row)
+      self._content_start[idx] = start
+      if start is None:
+        return False
+
+    window_start = max(start, len(row) - self.window)
+    text = self.tokenizer.decode(row[window_start:], skip_special_tokens=True)
+    if window_start == start:
+      text = text.lstrip()
+    return any(stop in text for stop in self.stop_strings)
+
+  def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs: Any) -> torch.BoolTensor:
+    done = [self._is_done(idx, row) for idx, row in enumerate(input_ids.tolist())]
+    return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+class _BracketState:
+  """Depth of the brackets of a text read a piece at a time, ignoring those in strings."""
+
+  def __init__(self) -> None:
+    self.depth = 0
+    self.opened = False
+    self.in_string = False
+    self.escaped = False
+    self.closed = False
+
+  def feed(self, text: str) -> bool:
+    """Read more text.
+    Args:
+      text (str): text following the one already read.
+    Returns:
+      bool: true if a bracket was opened and all of them are closed.
+    """
+    for char in text:
+      if self.closed:
+        break
+      if self.in_string:
+        if self.escaped:
+          self.escaped = False
+        elif char == "\\":
+          self.escaped = True
+        elif char == '"':
+          self.in_string = False
+      elif char == '"':
+        self.in_string = True
+      elif char in "[{":
+        self.depth += 1
+        self.opened = True
+      elif char in "]}":
+        self.depth -= 1
+        if self.opened and self.depth <= 0:
+          self.closed = True
+    return self.closed
+
+
+class BalancedJsonCriteria(StoppingCriteria):
+  """Stop generating once the first json object or list in the output is closed.
+  The bracket depth of every row is kept between steps, so only the new tokens are decoded.
+  """
+
+  def __init__(self, tokenizer: PreTrainedTokenizer, prompt_len: int) -> None:
+    """Initialize the criteria.
+    Args:
+      tokenizer (PreTrainedTokenizer): tokenizer to decode the generated text.
+      prompt_len (int): length of the (padded) prompt in the input ids.
+    """
+    self.tokenizer = tokenizer
+    self.prompt_len = prompt_len
+    # Bracket state and number of tokens read for every row
+    self._states: Dict[int, _BracketState] = {}
+    self._read: Dict[int, int] = {}
+
+  @staticmethod
+  def is_closed(text: str) -> bool:
+    """Check if the brackets opened in the text are all closed, ignoring those in strings.
+    Args:
+      text (str): generated text.
+    Returns:
+      bool: true if a bracket was opened and all of them are closed.
+    """
+    return _BracketState().feed(text)
+
+  def _is_done(self, idx: int, row: List[int]) -> bool:
+    """Read the tokens of a row generated since the previous step."""
+    state = self._states.setdefault(idx, _BracketState())
+    read = self._read.get(idx, self.prompt_len)
+    # Brackets, quotes and backslashes are whole tokens or ascii bytes of one, so new tokens decode apart
+    if len(row) > read:
+      state.feed(self.tokenizer.decode(row[read:], skip_special_tokens=True))
+      self._read[idx] = len(row)
+    return state.closed
+
+  def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs: Any) -> torch.BoolTensor:
+    done = [self._is_done(idx, row) for idx, row in enumerate(input_ids.tolist())]
+    return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
@@ -0,0 +1,250 @@
+import argparse
+import json
+import threading
+import time
+import uuid
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+from dotenv import load_dotenv
+from agent.agent import DialogueAgent, DEFAULT_DEVICE, DEFAULT_MODELS, DEFAULT_N_EXCHANGES
+from data.kb import KnowledgeBase
+from models.batching import BatchScheduler
+from models.pool import MODEL_POOL
+from models.utils import login_to_hub
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8000
+# Seconds after which a session without requests is closed
+SESSION_IDLE_TIMEOUT = 30 * 60
+# Seconds between two checks for idle sessions
+SESSION_REAP_INTERVAL = 60
+
+
+class Session:
+  """Conversation of a single user, with its own dialogue state and history."""
+
+  def __init__(self, agent: DialogueAgent) -> None:
+    self.agent = agent
+    self.last_used = time.monotonic()
+    # A user sends one message at a time, the agent is not reentrant
+    self.lock = threading.Lock()
+
+
+class SessionManager:
+  """Create and serve sessions sharing knowledge base, model pool and batch scheduler."""
+
+  def __init__(self, idle_timeout: float = SESSION_IDLE_TIMEOUT, reap_interval: float = SESSION_REAP_INTERVAL) -> None:
+    """Initialize the shared resources and start closing idle sessions in background.
+    Args:
+      idle_timeout (float): seconds after which an unused session is closed.
+      reap_interval (float): seconds between two checks for idle sessions.
+    """
+    self.idle_timeout = idle_timeout
+    self.reap_interval = reap_interval
+    self.kb = KnowledgeBase()
+    self.scheduler = BatchScheduler()
+    self.sessions: Dict[str, Session] = {}
+    self._lock = threading.Lock()
+    # Idle sessions hold models of the pool, so they are closed even if no request arrives
+    self._stopped = threading.Event()
+    self._reaper = threading.Thread(target=self._reap, name="session-reaper", daemon=True)
+    self._reaper.start()
+
+  def create(self) -> str:
+    """Start a new session.
+    Returns:
+      str: id of the session.
+    """
+    agent = DialogueAgent(
+      DEFAULT_MODELS,
+      DEFAULT_DEVICE,
+      DEFAULT_N_EXCHANGES,
+      parallel_intents=True,
+      kb=self.kb,
+      scheduler=self.scheduler
+    )
+    session_id = uuid.uuid4().hex
+    with self._lock:
+      self.sessions[session_id] = Session(agent)
+    return session_id
+
+  def get(self, session_id: str) -> Optional[Session]:
+    """Get a session marking it as used."""
+    with self._lock:
+      session = self.sessions.get(session_id)
+    if session is not None:
+      session.last_used = time.monotonic()
+    return session
+
+  def close(self, session_id: str) -> bool:
+    """Close a session giving its models back to the pool.
+    Returns:
+      bool: false if the session did not exist.
+    """
+    with self._lock:
+      session = self.sessions.pop(session_id, None)
+    if session is None:
+      return False
+    with session.lock:
+      session.agent.close()
+    return True
+
+  def _close_idle(self) -> None:
+    """Close the sessions unused for longer than the idle timeout."""
+    now = time.monotonic()
+    with self._lock:
+      idle = [sid for sid, s in self.sessions.items() if now - s.last_used > self.idle_timeout]
+    for session_id in idle:
+      print(f"Closing idle session {session_id}")
+      self.close(session_id)
+
+  def _reap(self) -> None:
+    """Close idle sessions every reap interval until the manager is stopped."""
+    while not self._stopped.wait(self.reap_interval):
+      try:
+        self._close_idle()
+      except Exception as e:
+        print(f"Closing idle sessions failed: {e}")
+
+  def stop(self) -> None:
+    """Stop closing idle sessions."""
+    self._stopped.set()
+
+  def stats(self) -> Dict[str, Any]:
+    """Get sessions, loaded models and batching stats."""
+    with self._lock:
+      n_sessions = len(self.sessions)
+    return {"sessions": n_sessions, "pool": MODEL_POOL.stats(), "batching": self.scheduler.report()}
+
+
+class DialogueRequestHandler(BaseHTTPRequestHandler):
+  """JSON endpoints of the server.
+  POST /sessions                  -> {"session_id": ...}
+  POST /sessions/<id>/chat        {"message": ...} -> {"response": ...}
+  POST /sessions/<id>/reset       clear history and dialogue state
+  DELETE /sessions/<id>           close the session
+  GET /stats                      sessions, model pool and batching stats
+  """
+
+  manager: SessionManager
+
+  def _send_json(self, status: HTTPStatus, data: dict) -> None:
+    """Write a json response."""
+    body = json.dumps(data).encode("utf-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _read_json(self) -> dict:
+    """Read the json body of the request, empty if missing."""
+    length = int(self.headers.get("Content-Length", 0))
+    if length == 0:
+      return {}
+    return json.loads(self.rfile.read(length).decode("utf-8"))
+
+  def _route(self) -> Tuple[Optional[str], Optional[str]]:
+    """Split /sessions/<id>/<action> into session id and action."""
+    parts = [p for p in self.path.split("/") if p]
+    session_id = parts[1] if len(parts) > 1 else None
+    action = parts[2] if len(parts) > 2 else None
+    return session_id, action
+
+  def _session_or_404(self, session_id: Optional[str]) -> Optional[Session]:
+    """Get the session, answering 404 if it does not exist."""
+    session = self.manager.get(session_id) if session_id else None
+    if session is None:
+      self._send_json(HTTPStatus.NOT_FOUND, {"error": f"Unknown session '{session_id}'"})
+    return session
+
+  def do_GET(self) -> None:
+    if self.path == "/stats":
+      self._send_json(HTTPStatus.OK, self.manager.stats())
+    else:
+      self._send_json(HTTPStatus.NOT_FOUND, {"error": "Not found"})
+
+  def do_POST(self) -> None:
+    if not self.path.startswith("/sessions"):
+      self._send_json(HTTPStatus.NOT_FOUND, {"error": "Not found"})
+      return
+
+    session_id, action = self._route()
+    if session_id is None:
+      try:
+        session_id = self.manager.create()
+      except Exception as e:
+        print(f"Creating a session failed: {e!r}")
+        self._send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "The session could not be created"})
+        return
+      self._send_json(HTTPStatus.CREATED, {"session_id": session_id})
+      return
+
+    session = self._session_or_404(session_id)
+    if session is None:
+      return
+
+    match action:
+      case "chat":
+        try:
+          message = self._read_json().get("message")
+        except json.JSONDecodeError:
+          message = None
+        if not isinstance(message, str) or not message.strip():
+          self._send_json(HTTPStatus.BAD_REQUEST, {"error": "Body must be {\"message\": <text>}"})
+          return
+        try:
+          with session.lock:
+            response = session.agent.chat(message)
+        except Exception as e:
+          print(f"Session {session_id}: chat failed: {e!r}")
+          self._send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "The agent failed to answer"})
+          return
+        self._send_json(HTTPStatus.OK, {"response": response})
+      case "reset":
+        try:
+          with session.lock:
+            session.agent.clear_history()
+        except Exception as e:
+          print(f"Session {session_id}: reset failed: {e!r}")
+          self._send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "The session could not be reset"})
+          return
+        self._send_json(HTTPStatus.OK, {"reset": True})
+      case _:
+        self._send_json(HTTPStatus.NOT_FOUND, {"error": f"Unknown action '{action}'"})
+
+  def do_DELETE(self) -> None:
+    session_id, action = self._route()
+    if not self.path.startswith("/sessions") or session_id is None or action is not None:
+      self._send_json(HTTPStatus.NOT_FOUND, {"error": "Not found"})
+    elif self.manager.close(session_id):
+      self._send_json(HTTPStatus.OK, {"closed": session_id})
+    else:
+      self._send_json(HTTPStatus.NOT_FOUND, {"error": f"Unknown session '{session_id}'"})
+
+
+def main() -> None:
+  """Serve the agent to many users at once."""
+  parser = argparse.ArgumentParser(description="Multi-session dialogue server.")
+  parser.add_argument("--host", type=str, default=DEFAULT_HOST, help="Address to listen on.")
+  parser.add_argument("--port", "-p", type=int, default=DEFAULT_PORT, help="Port to listen on.")
+  args = parser.parse_args()
+
+  load_dotenv()
+  login_to_hub()
+
+  DialogueRequestHandler.manager = SessionManager()
+  server = ThreadingHTTPServer((args.host, args.port), DialogueRequestHandler)
+  print(f"Serving on http://{args.host}:{args.port}")
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    print("Closing...")
+  finally:
+    DialogueRequestHandler.manager.stop()
+    server.server_close()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,41 @@
+import os
+import sys
+import threading
+
+import pytest
+
+# Tests import the packages of the repository root like the scripts do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORDS = "<pad> <eos> system user assistant the a b c game is good bad play rust portal what tell me about hello world yes no".split()
+
+
+class TinyLoader:
+  """Loader of a small random llama with a word level tokenizer."""
+
+  def __init__(self, torch, transformers, tokenizers):
+    tok = tokenizers.Tokenizer(tokenizers.models.WordLevel({w: i for i, w in enumerate(WORDS)}, unk_token="a"))
+    tok.pre_tokenizer = tokenizers.pre_tokenizers.Whitespace()
+    self.tokenizer = transformers.PreTrainedTokenizerFast(
+      tokenizer_object=tok, pad_token="<pad>", eos_token="<eos>", model_input_names=["input_ids", "attention_mask"]
+    )
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(
+      vocab_size=len(WORDS), hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=4,
+      num_key_value_heads=2, pad_token_id=0, eos_token_id=1, initializer_range=1.0
+    )
+    self.model = transformers.LlamaForCausalLM(config).eval()
+    self.model.generation_config.do_sample = False
+    self.tokenizer_lock = threading.Lock()
+    self.model_lock = threading.RLock()
+    self.prepare_text_fun = lambda prompt, tokenizer, messages: " ".join(m["content"] for m in messages) + " user " + prompt + " assistant"
+    self.model_id = self.model_name = "tiny-llama"
+    self.load_strategy = "fp32"
+
+
+@pytest.fixture(scope="session")
+def tiny_loader():
+  torch = pytest.importorskip("torch")
+  transformers = pytest.importorskip("transformers")
+  tokenizers = pytest.importorskip("tokenizers")
+  return TinyLoader(torch, transformers, tokenizers)
@@ -0,0 +1,57 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from models.batching import BatchScheduler, _Request
+from models.model import PendingBatch, make_usage
+
+
+class FakeTask:
+  """Task answering with the upper case prompt, with its own cache and stats."""
+
+  def __init__(self, cached=None):
+    self.model = "shared-model"
+    self.system_prompt = "system"
+    self.json_schema = None
+    self.stop = None
+    self.max_batch_size = 8
+    self.cached = cached or {}
+    self.generated = []
+    self.last_usage = []
+
+  def start_batch(self, prompts, histories, max_new_tokens):
+    batch = PendingBatch(list(prompts), max_new_tokens)
+    batch.pending = [idx for idx, prompt in enumerate(prompts) if prompt not in self.cached]
+    for idx, prompt in enumerate(prompts):
+      batch.outputs[idx] = self.cached.get(prompt, "")
+    return batch
+
+  def generate_texts(self, texts, max_new_tokens, max_batch_size=None):
+    self.generated.append(list(texts))
+    return [(text.upper(), make_usage(len(text), 1, 0.1)) for text in texts]
+
+  def finish_batch(self, batch, results):
+    for idx, (content, usage) in zip(batch.pending, results):
+      batch.outputs[idx] = content
+      batch.usage[idx] = usage
+    self.last_usage = batch.usage
+    return batch.outputs
+
+
+def test_group_runs_once_and_every_task_keeps_its_stats():
+  scheduler = BatchScheduler()
+  first, second = FakeTask(), FakeTask(cached={"b": "cached b"})
+  group = [
+    _Request(first, "generate", ["a"], [None], {"max_new_tokens": 8, "max_batch_size": None}),
+    _Request(second, "generate", ["b", "c"], [None, None], {"max_new_tokens": 8, "max_batch_size": None}),
+  ]
+  scheduler._run_group(group)
+
+  assert group[0].future.result() == ["A"]
+  assert group[1].future.result() == ["cached b", "C"]
+  # A single batched call for the prompts missing from the caches
+  assert first.generated == [["a", "c"]]
+  assert [u["cached"] for u in second.last_usage] == [True, False]
+  assert first.last_usage[0]["prompt_tokens"] == 1
+  assert scheduler.report()["batches"] == 1
@@ -0,0 +1,51 @@
+import json
+import os
+from eval.evaluator import EvalCheckpoint
+
+
+def write_checkpoint(path: str, records: list, fingerprint: str = "run") -> EvalCheckpoint:
+  checkpoint = EvalCheckpoint(path, fingerprint=fingerprint)
+  checkpoint.append(records)
+  checkpoint.close()
+  return checkpoint
+
+
+def test_records_round_trip(tmp_path):
+  path = str(tmp_path / "ckpt" / "nlu.jsonl")
+  records = [{"idx": i, "prediction": f"p{i}"} for i in range(3)]
+  checkpoint = write_checkpoint(path, records)
+  assert not checkpoint.is_stale()
+  assert list(checkpoint.records()) == records
+
+
+def test_other_fingerprint_is_stale(tmp_path):
+  path = str(tmp_path / "nlu.jsonl")
+  write_checkpoint(path, [{"idx": 0}], fingerprint="old")
+  assert EvalCheckpoint(path, fingerprint="new").is_stale()
+
+
+def test_half_written_record_is_dropped(tmp_path):
+  path = str(tmp_path / "nlu.jsonl")
+  checkpoint = write_checkpoint(path, [{"idx": 0}, {"idx": 1}])
+  with open(path, "ab") as f:
+    f.write(b'{"idx": 2, "predic')
+  size = os.path.getsize(path)
+
+  assert list(checkpoint.records()) == [{"idx": 0}, {"idx": 1}]
+  assert os.path.getsize(path) < size
+
+  # Records appended after the recovery start on a clean line
+  checkpoint.append([{"idx": 2}])
+  checkpoint.close()
+  assert list(checkpoint.records()) == [{"idx": 0}, {"idx": 1}, {"idx": 2}]
+
+
+def test_complete_line_with_bad_json_is_dropped(tmp_path):
+  path = str(tmp_path / "nlu.jsonl")
+  checkpoint = write_checkpoint(path, [{"idx": 0}])
+  with open(path, "ab") as f:
+    f.write(b'{"idx": \n' + json.dumps({"idx": 1}).encode() + b"\n")
+
+  assert list(checkpoint.records()) == [{"idx": 0}]
+  with open(path, "rb") as f:
+    assert f.read().endswith(b'{"idx": 0}\n')
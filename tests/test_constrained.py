@@ -0,0 +1,77 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from models.constrained import COMPLETE, INVALID, PARTIAL, JsonSchemaLogitsProcessor, json_state
+
+SCHEMA = {
+  "type": "object",
+  "properties": {
+    "intent": {"type": "string", "enum": ["get_wishlist", "get_game_info"]},
+    "slots": {"type": "object", "properties": {"title": {"anyOf": [{"type": "string"}, {"type": "null"}]}}, "required": ["title"]},
+  },
+  "required": ["intent", "slots"],
+}
+
+
+class CharTokenizer:
+  """Tokenizer with a token for every char and a few longer pieces."""
+
+  name_or_path = "char-tokenizer"
+  eos_token_id = 0
+
+  def __init__(self, vocab):
+    self.vocab = ["<eos>"] + vocab
+
+  def __len__(self):
+    return len(self.vocab)
+
+  def encode(self, text, add_special_tokens=False):
+    return [self.vocab.index(char) for char in text]
+
+  def decode(self, ids, skip_special_tokens=True, clean_up_tokenization_spaces=False):
+    return "".join(self.vocab[i] for i in ids if not (skip_special_tokens and i == 0))
+
+  def batch_decode(self, sequences, **kwargs):
+    return [self.decode(ids, **kwargs) for ids in sequences]
+
+
+@pytest.mark.parametrize("text, state", [
+  ('{"intent": "get_wishlist", "slots": {"title": null}}', COMPLETE),
+  ('{"intent": "GET_WISHLIST", "slots": {"title": "Rust"}}  ', COMPLETE),
+  ('{"intent": "get_', PARTIAL),
+  ('{"intent": "get_wishlist", "slots": {"title": nu', PARTIAL),
+  ('', PARTIAL),
+  ('{"intent": "buy_game"', INVALID),
+  ('{"intent": "get_wishlist", "slots": {}}', INVALID),
+  ('{"intent": "get_wishlist", "slots": {"title": null}} extra', INVALID),
+  ('{"intent": "get_wishlist",' + " " * 40, INVALID),
+])
+def test_json_state(text, state):
+  assert json_state(text, SCHEMA) == state
+
+
+def test_processor_masks_diverging_tokens():
+  tokenizer = CharTokenizer(list('{}":, abcdefghijklmnopqrstuvwxyz_') + ['{"intent": "', "hello"])
+  processor = JsonSchemaLogitsProcessor(tokenizer, SCHEMA, prompt_len=0, eos_token_ids=[0])
+  prefix = tokenizer.vocab.index('{"intent": "')
+  input_ids = torch.tensor([[prefix]])
+  scores = torch.zeros(1, len(tokenizer))
+  out = processor(input_ids, scores)
+  allowed = {tokenizer.vocab[i] for i in torch.isfinite(out[0]).nonzero().flatten().tolist()}
+  assert allowed == {"g", "G"} & set(tokenizer.vocab)
+
+
+def test_processor_widens_search_before_ending():
+  tokenizer = CharTokenizer([chr(c) for c in range(32, 127)])
+  processor = JsonSchemaLogitsProcessor(tokenizer, SCHEMA, prompt_len=0, eos_token_ids=[0], search_sizes=(4,))
+  input_ids = torch.tensor([tokenizer.encode('{"intent": "get_wishlist"')])
+  scores = torch.zeros(1, len(tokenizer))
+  # The likeliest tokens are letters, only "," can follow
+  for char in "abcd":
+    scores[0, tokenizer.vocab.index(char)] = 10.0
+  out = processor(input_ids, scores)
+  allowed = [tokenizer.vocab[i] for i in torch.isfinite(out[0]).nonzero().flatten().tolist()]
+  assert "," in allowed
+  assert "<eos>" not in allowed
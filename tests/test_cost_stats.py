@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from eval.evaluator import Evaluator
+
+
+def make_infos(latencies: list) -> list:
+  return [{"latency": latency, "prompt_tokens": 10, "generated_tokens": 5} for latency in latencies]
+
+
+def test_latency_percentiles():
+  latencies = [i / 1000 for i in range(1, 101)]
+  stats = Evaluator._cost_stats(make_infos(latencies))
+  latency = stats["latency_ms"]
+  assert latency["mean"] == pytest.approx(50.5)
+  assert latency["p50"] == pytest.approx(np.percentile(range(1, 101), 50))
+  assert latency["p95"] == pytest.approx(95.05)
+  assert latency["p99"] == pytest.approx(99.01)
+  assert latency["p50"] <= latency["p95"] <= latency["p99"]
+
+
+def test_token_counts_and_speed():
+  stats = Evaluator._cost_stats(make_infos([0.5, 1.5]))
+  assert stats["count"] == 2
+  assert stats["prompt_tokens"] == 20
+  assert stats["generated_tokens"] == 10
+  assert stats["mean_generated_tokens"] == 5
+  assert stats["tokens_per_sec"] == pytest.approx(5.0)
+
+
+def test_zero_latency_has_no_speed():
+  stats = Evaluator._cost_stats(make_infos([0.0]))
+  assert stats["tokens_per_sec"] == 0.0
+  assert stats["latency_ms"]["p99"] == 0.0
@@ -0,0 +1,52 @@
+import pytest
+from data.fuzzy import TrigramIndex, canonical_title, trigrams
+from data.kb import FUZZY_MIN_SCORE
+
+TITLES = ["portal", "portal 2", "terraria", "far cry 5", "far cry 4", "final fantasy vii", "the witcher 3 wild hunt"]
+
+
+@pytest.fixture(scope="module")
+def index():
+  return TrigramIndex(TITLES)
+
+
+def test_canonical_title():
+  assert canonical_title("final fantasy vii") == "final fantasy 7"
+  assert canonical_title("rocky  ii") == "rocky 2"
+
+
+def test_trigrams_are_distinct_and_padded():
+  grams = trigrams("aaaa")
+  assert len(grams) == len(set(grams))
+  assert "  a" in grams and "aa " in grams
+
+
+def test_exact_title_scores_one(index):
+  title, score = index.search("terraria", k=1)[0]
+  assert title == "terraria"
+  assert score == pytest.approx(1.0)
+
+
+@pytest.mark.parametrize("query, expected", [
+  ("terarria", "terraria"),
+  ("portall", "portal"),
+  ("the witcher 3", "the witcher 3 wild hunt"),
+  ("final fantasy 7", "final fantasy vii"),
+  ("far  cry 5", "far cry 5")
+])
+def test_misspelled_title_ranks_first(index, query, expected):
+  title, score = index.search(query)[0]
+  assert title == expected
+  assert score >= FUZZY_MIN_SCORE
+
+
+def test_results_sorted_and_limited(index):
+  results = index.search("far cry", k=3)
+  assert len(results) == 3
+  scores = [score for _, score in results]
+  assert scores == sorted(scores, reverse=True)
+  assert {title for title, _ in results[:2]} == {"far cry 5", "far cry 4"}
+
+
+def test_no_shared_trigrams(index):
+  assert index.search("zzqqxx") == []
@@ -0,0 +1,80 @@
+import threading
+import pytest
+import agent.agent as agent_module
+from agent.agent import COMPONENTS, DialogueAgent
+
+# Seconds to wait for a build before calling it a deadlock
+BUILD_TIMEOUT = 10
+
+
+class FakeComponent:
+  def __init__(self, loader, prompt, **kwargs):
+    self.loader = loader
+    self.llm = None
+    self.kwargs = kwargs
+
+
+class FakeKB:
+  pass
+
+
+@pytest.fixture
+def lazy_agent(monkeypatch):
+  """Agent loading in background with every model, component and the knowledge base faked."""
+  monkeypatch.setattr(agent_module.MODEL_POOL, "acquire", lambda name, device: f"loader {name}")
+  monkeypatch.setattr(agent_module.MODEL_POOL, "release", lambda loader: None)
+  monkeypatch.setattr(agent_module, "KnowledgeBase", FakeKB)
+  monkeypatch.setattr(agent_module.RuleNLU, "from_kb", classmethod(lambda cls, kb: ("rules", kb)))
+  for name in ["Preproc", "NLU", "DM", "NLG", "SA"]:
+    monkeypatch.setattr(agent_module, name, FakeComponent)
+  dialogue_agent = DialogueAgent({"default": "tiny", "dm": "rule_based"}, "cpu", lazy=True)
+  yield dialogue_agent
+  dialogue_agent.close()
+
+
+def build_in_thread(fn):
+  """Run a build in a thread, failing instead of hanging if it deadlocks."""
+  result = {}
+  thread = threading.Thread(target=lambda: result.setdefault("value", fn()), daemon=True)
+  thread.start()
+  thread.join(BUILD_TIMEOUT)
+  assert not thread.is_alive(), "component build deadlocked"
+  return result["value"]
+
+
+def test_lazy_nlu_builds_rules_from_kb(lazy_agent):
+  nlu = build_in_thread(lambda: lazy_agent.nlu)
+  assert nlu.kwargs["rule_nlu"] == ("rules", lazy_agent.kb)
+  assert isinstance(lazy_agent.kb, FakeKB)
+
+
+def test_lazy_agent_builds_every_component(lazy_agent):
+  components = build_in_thread(lambda: [getattr(lazy_agent, name) for name in COMPONENTS])
+  assert isinstance(components[0], FakeKB)
+  # The rule based dm needs no model, the others share the default one
+  assert lazy_agent.dm.loader.__class__.__name__ == "RuleBasedDM"
+  assert {lazy_agent.preproc.loader, lazy_agent.nlu.loader, lazy_agent.nlg.loader, lazy_agent.sa.loader} == {"loader tiny"}
+  assert lazy_agent.loaders == {"tiny": "loader tiny"}
+
+
+def test_concurrent_first_use_builds_once(lazy_agent):
+  barrier = threading.Barrier(len(COMPONENTS) * 2)
+
+  def touch(name):
+    barrier.wait()
+    return getattr(lazy_agent, name)
+
+  results = {}
+  threads = [threading.Thread(target=lambda name=name, i=i: results.setdefault((name, i), touch(name)), daemon=True) for name in COMPONENTS for i in range(2)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join(BUILD_TIMEOUT)
+  assert not any(thread.is_alive() for thread in threads), "component build deadlocked"
+  for name in COMPONENTS:
+    assert results[(name, 0)] is results[(name, 1)] is getattr(lazy_agent, name)
+
+
+def test_unknown_component(lazy_agent):
+  with pytest.raises(ValueError):
+    lazy_agent._component("tts")
@@ -0,0 +1,49 @@
+import json
+from agent.nlg import NLG
+from eval.evaluator import BatchRunner
+
+PROMPT = {"prompt": {"main": "main", "get_wishlist": "wishlist", "discover_game": "discover"}}
+
+
+class FakeLLM:
+  """Answer every input with the system prompt it was generated with."""
+
+  def __init__(self):
+    self.system_prompt = PROMPT["prompt"]["main"]
+    self.last_usage = []
+
+  def change_system_prompt(self, system_prompt):
+    self.system_prompt = system_prompt
+
+  def generate(self, prompt):
+    return self.system_prompt
+
+  def generate_batch(self, prompts):
+    self.last_usage = [{} for _ in prompts]
+    return [self.system_prompt for _ in prompts]
+
+
+def make_nlg():
+  nlg = NLG.__new__(NLG)
+  nlg.prompt = PROMPT
+  nlg.llm = FakeLLM()
+  nlg.last_usage = []
+  return nlg
+
+
+def test_every_intent_group_runs_with_its_prompt():
+  nlg = make_nlg()
+  samples = [{"intent": intent, "input": {"idx": i}} for i, intent in enumerate(["get_wishlist", "discover_game"] * 3)]
+  runner = BatchRunner(
+    lambda batch: nlg.eval_generate_batch(batch[0]["intent"], [json.dumps(s["input"]) for s in batch]),
+    batch_size=2,
+    group_key=lambda sample: sample["intent"]
+  )
+  preds = runner.run(samples)
+  assert preds == [f"main\n{PROMPT['prompt'][s['intent']]}" for s in samples]
+
+
+def test_single_generation_sets_the_prompt():
+  nlg = make_nlg()
+  assert nlg.eval_generate("discover_game", "{}") == "main\ndiscover"
+  assert nlg.eval_generate("get_wishlist", "{}") == "main\nwishlist"
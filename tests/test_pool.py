@@ -0,0 +1,77 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from models import pool as pool_module
+from models.cache import PREFIX_CACHE
+from models.pool import ModelPool
+
+GB = 1024 ** 3
+
+
+class FakeModel:
+  device = "cpu"
+
+  def __init__(self, size):
+    self.size = size
+
+  def get_memory_footprint(self):
+    return self.size
+
+
+class FakeLoader:
+  """Loader of a model of 1 GB, without weights."""
+
+  def __init__(self, model_name, device, strategy=None):
+    self.model_name = model_name
+    self.model_id = f"org/{model_name}"
+    self.model = FakeModel(GB)
+
+
+@pytest.fixture(autouse=True)
+def fake_loader(monkeypatch):
+  monkeypatch.setattr(pool_module, "ModelLoader", FakeLoader)
+  PREFIX_CACHE.clear()
+  yield
+  PREFIX_CACHE.clear()
+
+
+def loaded(pool):
+  return [m["model"] for m in pool.stats()["models"]]
+
+
+def test_loaders_are_shared_and_counted():
+  pool = ModelPool(memory_budget=4 * GB)
+  first = pool.acquire("a")
+  assert pool.acquire("a") is first
+  assert pool.stats()["models"][0]["refs"] == 2
+
+
+def test_least_recently_used_unused_loader_is_evicted():
+  pool = ModelPool(memory_budget=2 * GB)
+  a, b = pool.acquire("a"), pool.acquire("b")
+  pool.release(a)
+  pool.release(b)
+  # "a" is used again, so "b" is the least recently used
+  pool.release(pool.acquire("a"))
+  pool.acquire("c")
+  assert loaded(pool) == ["a", "c"]
+
+
+def test_loaders_in_use_are_never_evicted():
+  pool = ModelPool(memory_budget=1 * GB)
+  pool.acquire("a")
+  pool.acquire("b")
+  assert loaded(pool) == ["a", "b"]
+
+
+def test_eviction_drops_cached_prefixes():
+  pool = ModelPool(memory_budget=1 * GB)
+  pool.release(pool.acquire("a"))
+  PREFIX_CACHE.put(PREFIX_CACHE.make_key("org/a", "cpu", "system"), "ids", "kv")
+  PREFIX_CACHE.put(PREFIX_CACHE.make_key("org/b", "cpu", "system"), "ids", "kv")
+  pool.acquire("b")
+  assert loaded(pool) == ["b"]
+  assert PREFIX_CACHE.get(PREFIX_CACHE.make_key("org/a", "cpu", "system")) is None
+  assert PREFIX_CACHE.get(PREFIX_CACHE.make_key("org/b", "cpu", "system")) is not None
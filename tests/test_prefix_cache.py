@@ -0,0 +1,31 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from models.cache import PREFIX_CACHE
+from models.model import LLMTask
+
+SYSTEM_PROMPT = "system the game is good play"
+PROMPTS = ["tell me about rust", "what is portal", "hello", "tell me about the good game what is rust play"]
+
+
+def run(loader, use_prefix_cache):
+  PREFIX_CACHE.clear()
+  task = LLMTask(loader, SYSTEM_PROMPT, use_prefix_cache=use_prefix_cache, generation={"max_new_tokens": 6})
+  return task, task.generate_batch(PROMPTS), task.score_labels(PROMPTS, ["yes", "no", "good"]), [task.generate(p) for p in PROMPTS]
+
+
+def test_batched_prefix_matches_full_prompts(tiny_loader):
+  _, batch, scores, single = run(tiny_loader, use_prefix_cache=False)
+  task, prefixed_batch, prefixed_scores, prefixed_single = run(tiny_loader, use_prefix_cache=True)
+
+  assert prefixed_batch == batch == single
+  assert prefixed_single == single
+  for expected, got in zip(scores, prefixed_scores):
+    assert got == pytest.approx(expected, abs=1e-5)
+
+  # Generation never extends the cached prefix
+  key = PREFIX_CACHE.make_key(task.model_id, task.device, SYSTEM_PROMPT, task.model_variant)
+  prefix_ids, past_key_values = PREFIX_CACHE.get(key)
+  assert past_key_values.get_seq_length() == prefix_ids.shape[1]
@@ -0,0 +1,33 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+pytest.importorskip("accelerate")
+
+from models.registry import load_int8_dynamic
+
+
+@pytest.fixture(scope="module")
+def bf16_checkpoint(tmp_path_factory):
+  """Tiny llama with tied embeddings saved in bfloat16, like most released checkpoints."""
+  config = transformers.LlamaConfig(
+    vocab_size=64, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+    num_attention_heads=4, num_key_value_heads=2, tie_word_embeddings=True
+  )
+  torch.manual_seed(0)
+  path = str(tmp_path_factory.mktemp("tiny_llama"))
+  transformers.LlamaForCausalLM(config).to(torch.bfloat16).save_pretrained(path)
+  return path
+
+
+def test_int8_dynamic_matches_quantizing_the_float32_model(bf16_checkpoint):
+  reference = transformers.AutoModelForCausalLM.from_pretrained(bf16_checkpoint, dtype=torch.float32, device_map="cpu")
+  reference = torch.ao.quantization.quantize_dynamic(reference, {torch.nn.Linear}, dtype=torch.qint8)
+  model = load_int8_dynamic(bf16_checkpoint, "auto")
+
+  assert not any(type(module) is torch.nn.Linear for module in model.modules())
+  # The embeddings tied to the quantized head are kept
+  assert model.model.embed_tokens.weight.shape == (64, 32)
+  input_ids = torch.randint(0, 64, (2, 7))
+  with torch.no_grad():
+    assert torch.equal(model(input_ids).logits, reference(input_ids).logits)
@@ -0,0 +1,108 @@
+import pytest
+
+from agent.rule_nlu import RuleNLU, TitleTrie, refers_to_earlier_turn
+from agent.dst import intent_schemas
+
+TITLES = ["terraria", "portal", "portal 2", "far cry 5", "the division", "metal gear solid", "rust", "stardew valley", "plants vs zombies"]
+TERMS = ["RPG", "AAA", "level", "adventure game", "roguelike", "speedrun"]
+FRIENDS = ["Alex", "FieryGamer"]
+PUBLISHERS = ["ubisoft", "bethesda softworks", "activision"]
+DEVELOPERS = ["ubisoft montreal", "bethesda game studios", "re logic"]
+
+
+def state(intent, **slots):
+  return {"intent": intent, "slots": {slot: slots.get(slot) for slot in intent_schemas[intent]}}
+
+
+# Wordings written apart from the templates of eval/generation/nlu.py, so they measure how the rules generalize
+HELD_OUT = [
+  ("Could you put Portal 2 on my wish list?", state("add_to_wishlist", title="Portal 2")),
+  ("please bookmark Stardew Valley in my saved games", state("add_to_wishlist", title="Stardew Valley")),
+  ("wishlist Far Cry 5", state("add_to_wishlist", title="Far Cry 5")),
+  ("get rid of Rust from my saved games", state("remove_from_wishlist", title="Rust")),
+  ("I'd like to drop The Division from the wishlist", state("remove_from_wishlist", title="The Division")),
+  ("what's in my wishlist?", state("get_wishlist")),
+  ("pull up my saved list", state("get_wishlist")),
+  ("which games did I bookmark", state("get_wishlist")),
+  ("What games does Alex own?", state("get_friend_games", name="Alex")),
+  ("show me FieryGamer's library", state("get_friend_games", name="FieryGamer")),
+  ("has Alex got any suggestions", state("get_friend_games", name="Alex")),
+  ("what does the word roguelike stand for", state("get_term_explained", term="roguelike")),
+  ("describe AAA in video games", state("get_term_explained", term="AAA")),
+  ("what's the meaning of speedrun", state("get_term_explained", term="speedrun")),
+  ("what is an RPG", state("get_term_explained", term="RPG")),
+  ("tell me about adventure game", state("get_term_explained", term="adventure game")),
+  ("How much is Far Cry 5?", state("get_game_info", title="Far Cry 5", info="price")),
+  ("Show me Terraria's reviews", state("get_game_info", title="Terraria", info="review")),
+  ("give me the age rating for Metal Gear Solid", state("get_game_info", title="Metal Gear Solid", info="required_age")),
+  ("what are the platforms of Portal", state("get_game_info", title="Portal", info="platform")),
+  ("tell me everything about Stardew Valley", state("get_game_info", title="Stardew Valley")),
+  ("look up Plants vs Zombies", state("get_game_info", title="Plants vs Zombies")),
+  ("Which is better, Terraria or Rust?", state("compare_games", title1="Terraria", title2="Rust")),
+  ("compare plants vs zombies and portal by price", state("compare_games", title1="plants vs zombies", title2="portal", criteria="price")),
+  ("how does Portal 2 compare to Portal", state("compare_games", title1="Portal 2", title2="Portal")),
+  ("compare the ratings of Rust and The Division", state("compare_games", title1="Rust", title2="The Division", criteria="review")),
+  ("recommend me some indie games like Stardew Valley for linux", state("discover_game", genre="indie", similar_title="Stardew Valley", platform="linux")),
+  ("got any multiplayer games under $20?", state("discover_game", mode="multiplayer", price=20.0)),
+  ("give me rpg games developed by Bethesda", state("discover_game", genre="rpg", developer="Bethesda")),
+  ("suggest games published by Activision that came out in 2015", state("discover_game", publisher="Activision", release_year=2015)),
+  ("I need strategy games rated for age 16", state("discover_game", genre="strategy", required_age=16)),
+  ("find me games like plants vs zombies", state("discover_game", similar_title="plants vs zombies")),
+  # Not sure without the llm
+  ("What is the price of Terraria and show me my wishlist", None),
+  ("add it to my wishlist", None),
+  ("remove Hollow Knight from my list", None),
+  ("What is Mark playing?", None),
+  ("what does yolo mean", None),
+  ("compare the first one and Rust", None),
+  ("games like Portal and Terraria", None),
+  ("find games developed by Nintendo", None),
+  ("what is the weather like", None),
+]
+# Share of the answerable held out wordings the rules must answer
+MIN_COVERAGE = 0.9
+
+
+@pytest.fixture(scope="module")
+def rules():
+  return RuleNLU(TITLES, TERMS, FRIENDS, PUBLISHERS, DEVELOPERS)
+
+
+def test_held_out_precision(rules):
+  wrong = [(text, rules.parse(text), expected) for text, expected in HELD_OUT if rules.parse(text) not in (None, expected)]
+  assert wrong == []
+
+
+def test_held_out_coverage(rules):
+  answerable = [text for text, expected in HELD_OUT if expected is not None]
+  answered = [text for text in answerable if rules.parse(text) is not None]
+  assert len(answered) / len(answerable) >= MIN_COVERAGE
+
+
+@pytest.mark.parametrize("text", [text for text, expected in HELD_OUT if expected is None])
+def test_unsure_requests_go_to_llm(rules, text):
+  assert rules.parse(text) is None
+
+
+def test_captured_title_must_be_known(rules):
+  assert rules.parse("Add Terraria and show me my wishlist to my wishlist") is None
+  assert rules.parse("What is the price of Terrarias") is None
+
+
+def test_title_trie_longest_match():
+  trie = TitleTrie(["portal", "portal 2", "far cry 5"])
+  assert trie.longest_match(["portal", "2", "and"]) == 2
+  assert trie.longest_match(["far", "cry"]) == 0
+  assert "Portal 2" in trie
+  assert "Portal 3" not in trie
+
+
+@pytest.mark.parametrize("text, refers", [
+  ("add it to my wishlist", True),
+  ("compare the first one with Rust", True),
+  ("what about both of them", True),
+  ("Add Terraria to my wishlist", False),
+  ("What does RPG mean?", False),
+])
+def test_refers_to_earlier_turn(text, refers):
+  assert refers_to_earlier_turn(text) == refers
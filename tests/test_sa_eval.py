@@ -0,0 +1,37 @@
+from eval.sa import SA_Evaluator
+
+
+class FakeSA:
+  """SA answering positive when scoring and a raw generation otherwise."""
+
+  def __init__(self, scoring):
+    self.scoring = scoring
+    self.llm = None
+    self.last_usage = []
+
+  def classify(self, reviews):
+    self.last_usage = [{"mode": "scoring"} for _ in reviews]
+    return [{"label": "positive", "probs": {"positive": 1.0}} for _ in reviews]
+
+  def generate_batch(self, reviews, validate=True):
+    self.last_usage = [{"mode": "generation"} for _ in reviews]
+    return ['"negative"' for _ in reviews]
+
+
+def make_evaluator(scoring):
+  # Skip the constructor, which runs the whole test set
+  evaluator = SA_Evaluator.__new__(SA_Evaluator)
+  evaluator.component = FakeSA(scoring)
+  evaluator.prompt = {"prompt": "classify"}
+  evaluator.test_set = [{"review": "great game", "annotation": "positive"}]
+  return evaluator
+
+
+def test_predict_batch_runs_the_mode_of_the_component():
+  samples = [{"review": "great game"}, {"review": "bad game"}]
+  assert make_evaluator(True).predict_batch(samples) == [("positive", {"mode": "scoring"})] * 2
+  assert make_evaluator(False).predict_batch(samples) == [('"negative"', {"mode": "generation"})] * 2
+
+
+def test_modes_have_different_fingerprints():
+  assert make_evaluator(True).state_fingerprint() != make_evaluator(False).state_fingerprint()
@@ -0,0 +1,48 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from models.cache import PREFIX_CACHE
+from models.model import LLMTask
+
+SYSTEM_PROMPT = "system the game is good play"
+PROMPTS = ["tell me about rust", "hello", "tell me about the good game what is rust play"]
+# The first two labels share their first token
+LABELS = ["good game", "good play yes", "bad"]
+
+
+def sequence_log_prob(loader, text, label):
+  """Log probability of a label after a prompt, with a forward pass on the whole text."""
+  prompt_ids = loader.tokenizer(text).input_ids
+  label_ids = loader.tokenizer.encode(label, add_special_tokens=False)
+  with torch.no_grad():
+    logits = loader.model(input_ids=torch.tensor([prompt_ids + label_ids])).logits[0]
+  log_probs = torch.log_softmax(logits.float(), dim=-1)
+  return sum(float(log_probs[len(prompt_ids) - 1 + i, token]) for i, token in enumerate(label_ids))
+
+
+@pytest.mark.parametrize("use_prefix_cache", [False, True])
+def test_labels_sharing_first_token_are_scored_on_all_tokens(tiny_loader, use_prefix_cache):
+  PREFIX_CACHE.clear()
+  task = LLMTask(tiny_loader, SYSTEM_PROMPT, use_prefix_cache=use_prefix_cache)
+  scores = task.score_labels(PROMPTS, LABELS)
+
+  for prompt, got in zip(PROMPTS, scores):
+    text = task.prepare_text_fun(prompt, task.tokenizer, task._build_messages())
+    expected = torch.softmax(torch.tensor([sequence_log_prob(tiny_loader, text, label) for label in LABELS]), dim=-1)
+    assert [got[label] for label in LABELS] == pytest.approx(expected.tolist(), abs=1e-4)
+  assert scores[0]["good game"] != scores[0]["good play yes"]
+
+
+def test_labels_with_the_same_tokens_are_refused(tiny_loader):
+  task = LLMTask(tiny_loader, SYSTEM_PROMPT)
+  with pytest.raises(ValueError):
+    task.score_labels(PROMPTS, ["good", "good"])
+
+
+def test_scoring_records_usage(tiny_loader):
+  task = LLMTask(tiny_loader, SYSTEM_PROMPT)
+  task.score_labels(PROMPTS, LABELS)
+  assert len(task.last_usage) == len(PROMPTS)
+  assert all(u["prompt_tokens"] > 0 and u["generated_tokens"] == 0 and u["latency"] > 0 for u in task.last_usage)
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+from data.query import GameQueryEngine
+from data.similarity import GameVectorIndex
+from data.kb import SIMILAR_MIN_GENRE_OVERLAP
+
+
+def make_database() -> pd.DataFrame:
+  """Small dataset, the first game is the reference one."""
+  games = [
+    ("Portal", ["Action", "Puzzle"], ["Single-player"], ["puzzle", "sci-fi"]),
+    ("Portal 2", ["Action", "Puzzle"], ["Single-player", "Multi-player"], ["puzzle", "sci-fi", "co-op"]),
+    ("The Witness", ["Puzzle", "Indie"], ["Single-player"], ["puzzle"]),
+    ("Doom", ["Action"], ["Single-player"], ["sci-fi", "shooter"]),
+    ("Farming Life", ["Simulation"], ["Single-player"], ["sci-fi"]),
+    ("Cooking Life", ["Simulation"], ["Multi-player"], ["cozy"])
+  ]
+  return pd.DataFrame({
+    "name": [g[0] for g in games],
+    "name_normalized": [g[0].lower() for g in games],
+    "genres": [g[1] for g in games],
+    "categories": [g[2] for g in games],
+    "tags": [g[3] for g in games],
+    "release_date": ["2010-01-01"] * len(games),
+    "price": [10.0] * len(games),
+    "required_age": [0] * len(games),
+    "windows": [True] * len(games),
+    "mac": [False] * len(games),
+    "linux": [False] * len(games),
+    "publishers_normalized": ["valve"] * len(games),
+    "developers_normalized": ["valve"] * len(games)
+  })
+
+
+def test_genre_overlap():
+  engine = GameQueryEngine(make_database())
+  np.testing.assert_allclose(engine.genre_overlap(0), [1.0, 1.0, 0.5, 0.5, 0.0, 0.0])
+
+
+def test_similar_games_share_genres():
+  database = make_database()
+  engine = GameQueryEngine(database)
+  index = GameVectorIndex.from_database(database, engine)
+  positions = engine.filter(exclude_title="portal")
+  positions = positions[engine.genre_overlap(0)[positions] >= SIMILAR_MIN_GENRE_OVERLAP]
+  similar = index.similar(0, k=10, candidates=positions)
+  # Farming Life shares a tag with Portal but none of its genres
+  assert similar.tolist()[0] == 1
+  assert set(similar.tolist()) == {1, 2, 3}
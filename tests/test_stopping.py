@@ -0,0 +1,97 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from models.stopping import BalancedJsonCriteria, StopOnStrings
+
+
+class CharTokenizer:
+  """Tokenizer with a token for every printable char."""
+
+  def encode(self, text):
+    return [ord(char) for char in text]
+
+  def decode(self, ids, skip_special_tokens=True):
+    return "".join(chr(i) for i in ids)
+
+
+@pytest.mark.parametrize("text, closed", [
+  ('{"a": [1, 2]}', True),
+  ('{"a": "}"', False),
+  ('{"a": "\\"}"}', True),
+  ('no json here', False),
+  ('[[1], [2]', False),
+])
+def test_balanced_json_is_closed(text, closed):
+  assert BalancedJsonCriteria.is_closed(text) == closed
+
+
+def test_balanced_json_criteria_per_row():
+  tokenizer = CharTokenizer()
+  rows = ["x{}", "x{"]
+  input_ids = torch.tensor([tokenizer.encode(rows[0]), tokenizer.encode(rows[1]) + [ord(" ")]])
+  criteria = BalancedJsonCriteria(tokenizer, prompt_len=1)
+  assert criteria(input_ids, None).tolist() == [True, False]
+
+
+def test_stop_on_strings_ignores_leading_whitespace():
+  tokenizer = CharTokenizer()
+  criteria = StopOnStrings(tokenizer, ["\n", ")"], prompt_len=0)
+  input_ids = torch.tensor([tokenizer.encode("\n   "), tokenizer.encode("a(b)"), tokenizer.encode("abc ")])
+  assert criteria(input_ids, None).tolist() == [False, True, False]
+
+
+class CountingTokenizer(CharTokenizer):
+  """Char tokenizer counting the tokens it decodes."""
+
+  def __init__(self):
+    self.decoded = 0
+
+  def decode(self, ids, skip_special_tokens=True):
+    self.decoded += len(ids)
+    return super().decode(ids, skip_special_tokens)
+
+
+def run_steps(criteria, tokenizer, prompt, output):
+  """Call the criteria after every generated token, like generate does, until it stops."""
+  ids = tokenizer.encode(prompt)
+  for char in output:
+    ids.append(ord(char))
+    if criteria(torch.tensor([ids]), None)[0]:
+      return "".join(chr(i) for i in ids[len(prompt):])
+  return None
+
+
+def reference_stop(output, stop_strings):
+  """Shortest prefix of the output whose text after leading whitespace has a stop string."""
+  for end in range(1, len(output) + 1):
+    text = output[:end].lstrip()
+    if text and any(stop in text for stop in stop_strings):
+      return output[:end]
+  return None
+
+
+@pytest.mark.parametrize("output", ["\n\n  do(x)\nrest", "  \n", "say hi\nthere", "a" * 300 + ")", "\n)"])
+def test_stop_on_strings_matches_full_decoding(output):
+  stops = ["\n", ")"]
+  tokenizer = CharTokenizer()
+  assert run_steps(StopOnStrings(tokenizer, stops, prompt_len=3), tokenizer, "abc", output) == reference_stop(output, stops)
+
+
+@pytest.mark.parametrize("output", ['{"a": [1, {"b": "}]"}]} tail', '  [1, [2, "\\"]"]] x', "no json " * 50])
+def test_balanced_json_matches_full_decoding(output):
+  tokenizer = CharTokenizer()
+  expected = next((output[:end] for end in range(1, len(output) + 1) if BalancedJsonCriteria.is_closed(output[:end])), None)
+  assert run_steps(BalancedJsonCriteria(tokenizer, prompt_len=2), tokenizer, "p:", output) == expected
+
+
+def test_decoding_per_step_does_not_grow_with_the_output():
+  steps = 400
+  tokenizer = CountingTokenizer()
+  run_steps(StopOnStrings(tokenizer, ["<stop>"], prompt_len=1), tokenizer, "p", "x" * steps)
+  assert tokenizer.decoded <= steps * (len("<stop>") + 1) + 2
+
+  tokenizer = CountingTokenizer()
+  run_steps(BalancedJsonCriteria(tokenizer, prompt_len=1), tokenizer, "p", "{" + "x" * steps)
+  assert tokenizer.decoded == steps + 1